@@ -11,7 +11,6 @@
 import config
 
 import cv2
-import einops
 import gradio as gr
 import numpy as np
 import torch
@@ -19,7 +18,7 @@ import random
 import os
 
 from pytorch_lightning import seed_everything
-from annotator.util import resize_image, HWC3
+from annotator.util import resize_image, HWC3, get_device
 from annotator.uniformer_base import UniformerDetector
 from annotator.hed import HEDdetector
 from annotator.canny import CannyDetector
@@ -33,16 +32,20 @@ import cvlib as cv
 
 from utils import create_model, load_state_dict
 from lib.ddim_hacked import DDIMSampler
+from lib.placement import plan_placement, format_plan
+from lib.image_encoder import samples_to_uint8
+from lib.preprocess import prepare_hint, zero_hint
+from lib.region import crop_sample
+from lib.inversion import InversionCache
 
-from safetensors.torch import load_file as stload
-from collections import OrderedDict
+device = get_device(config.device)
 
-apply_uniformer = UniformerDetector()
-apply_midas = MidasDetector()
+apply_uniformer = UniformerDetector(device=device)
+apply_midas = MidasDetector(device=device)
 apply_canny = CannyDetector()
-apply_hed = HEDdetector()
+apply_hed = HEDdetector(device=device)
 model_outpainting = Outpainter()
-apply_openpose = OpenposeDetector()
+apply_openpose = OpenposeDetector(device=device)
 model_grayscale = GrayscaleConverter()
 model_blur = Blurrer()
 model_inpainting = Inpainter()
@@ -72,12 +75,51 @@ def blur(img, res, ksize):
     return result
 
 
+def hed_sketch(img, res):
+    detected_map = HWC3(apply_hed(resize_image(img, res)))
+    # sketch the hed image
+    retry = 0
+    cnt = 0
+    while retry == 0:
+        threshold_value = np.random.randint(110, 160)
+        kernel_size = 3
+        alpha = 1.5
+        beta = 50
+        binary_image = cv2.threshold(detected_map, threshold_value, 255, cv2.THRESH_BINARY)[1]
+        inverted_image = cv2.bitwise_not(binary_image)
+        smoothed_image = cv2.GaussianBlur(inverted_image, (kernel_size, kernel_size), 0)
+        sketch_image = cv2.convertScaleAbs(smoothed_image, alpha=alpha, beta=beta)
+        if np.sum(sketch_image < 5) > 0.005 * sketch_image.shape[0] * sketch_image.shape[1] or cnt == 5:
+            retry = 1
+        else:
+            cnt += 1
+    return sketch_image
+
+
 def inpainting(img, res, height_top_mask, height_down_mask, width_left_mask, width_right_mask):
     img = resize_image(HWC3(img), res)
     result = model_inpainting(img, height_top_mask, height_down_mask, width_left_mask, width_right_mask)
     return result
 
-model = create_model('./models/cldm_v15_unicontrol.yaml').cpu()
+
+def inpainting_hole(H, W, height_top_mask, height_down_mask, width_left_mask, width_right_mask):
+    # the rectangle Inpainter blanks out, as a [H, W] mask
+    hole = np.zeros((H, W), dtype=bool)
+    hole[int(H / 100.0 * float(height_top_mask)):int(H / 100.0 * float(height_down_mask)),
+         int(W / 100.0 * float(width_left_mask)):int(W / 100.0 * float(width_right_mask))] = True
+    return hole
+
+
+def outpainting_hole(H, W, height_top_extended, height_down_extended, width_left_extended, width_right_extended):
+    # everything but the image on the Outpainter canvas, once the canvas is resized back to [H, W]
+    top, down = int(H / 100.0 * float(height_top_extended)), int(H / 100.0 * float(height_down_extended))
+    left, right = int(W / 100.0 * float(width_left_extended)), int(W / 100.0 * float(width_right_extended))
+    new_H, new_W = H + top + down, W + left + right
+    hole = np.ones((H, W), dtype=bool)
+    hole[int(np.ceil(top * H / new_H)):(top + H) * H // new_H,
+         int(np.ceil(left * W / new_W)):(left + W) * W // new_W] = False
+    return hole
+
 # model_url = 'https://huggingface.co/Robert001/UniControl-Model/resolve/main/unicontrol_v1.1.ckpt'
 model_url = 'https://huggingface.co/Robert001/UniControl-Model/resolve/main/unicontrol_v1.1.st'
 
@@ -89,11 +131,30 @@ if not os.path.exists(model_path):
     from basicsr.utils.download_util import load_file_from_url
     load_file_from_url(model_url, model_dir=ckpts_path)
 
-model_dict = OrderedDict(stload(model_path, device='cpu'))
-model.load_state_dict(model_dict, strict=False)
-# model.load_state_dict(load_state_dict(model_path, location='cuda'), strict=False)
-model = model.cuda()
+model = create_model('./models/cldm_v15_unicontrol.yaml', precision=config.precision, device=device, ckpt_path=model_path)
+if config.channels_last:
+    model.to_channels_last()
+if config.memory_budget_gb > 0:
+    plan = plan_placement(model, config.memory_budget_gb * 2 ** 30,
+                          resolution=config.plan_resolution, num_samples=config.plan_num_samples)
+    print(format_plan(plan))
+    model.apply_placement(plan['placement'], device, window=plan['window'])
+elif config.stream_window > 0:
+    model.enable_weight_streaming(device, window=config.stream_window)
+else:
+    model = model.to(device)
+# after placement: the fused kernel is built and checked on the device it runs on
+if config.fuse_norm_act:
+    model.fuse_norm_act(device=device)
+if config.quantize_int8:
+    model.quantize_int8()
+model.parallel_control = config.parallel_control
+if config.cond_cache_size:
+    model.enable_cond_cache(config.cond_cache_size, table_path=config.task_table)
+if config.compile:
+    model.enable_compile(buckets=config.compile_buckets, tasks=list(model.mapping_task), cache_dir=config.compile_cache_dir)
 ddim_sampler = DDIMSampler(model)
+inversion_cache = InversionCache(ddim_sampler, max_size=config.inversion_cache_size)
 
 task_to_name = {'hed': 'control_hed', 'canny': 'control_canny', 'seg': 'control_seg', 'segbase': 'control_seg',
                 'depth': 'control_depth', 'normal': 'control_normal', 'openpose': 'control_openpose',
@@ -121,16 +182,12 @@ def process_canny(input_image, prompt, a_prompt, n_prompt, num_samples, image_re
         else:
             detected_map = 255 - img
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        control = prepare_hint(detected_map, num_samples, device)
 
         if seed == -1:
             seed = random.randint(0, 65535)
         seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
         task = 'canny'
         task_dic = {}
         task_dic['name'] = task_to_name[task]
@@ -141,25 +198,18 @@ def process_canny(input_image, prompt, a_prompt, n_prompt, num_samples, image_re
                 "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
                 "task": task_dic}
 
-        un_cond = {"c_concat": [control * 0] if guess_mode else [control],
+        un_cond = {"c_concat": [zero_hint(control)] if guess_mode else [control],
                    "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else ([strength] * 13)
         samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
                                                      shape, cond, verbose=False, eta=eta,
                                                      unconditional_guidance_scale=scale,
                                                      unconditional_conditioning=un_cond)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0,
-                                                                                                           255).astype(
-            np.uint8)
+        x_samples = samples_to_uint8(x_samples)
 
         results = [x_samples[i] for i in range(num_samples)]
     return [255 - detected_map] + results
@@ -179,17 +229,12 @@ def process_hed(input_image, prompt, a_prompt, n_prompt, num_samples, image_reso
 
         detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_LINEAR)
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        control = prepare_hint(detected_map, num_samples, device)
 
         if seed == -1:
             seed = random.randint(0, 65535)
         seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         task = 'hed'
         task_dic = {}
         task_dic['name'] = task_to_name[task]
@@ -200,25 +245,18 @@ def process_hed(input_image, prompt, a_prompt, n_prompt, num_samples, image_reso
                 "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
                 "task": task_dic}
 
-        un_cond = {"c_concat": [control * 0] if guess_mode else [control],
+        un_cond = {"c_concat": [zero_hint(control)] if guess_mode else [control],
                    "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else ([strength] * 13)
         samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
                                                      shape, cond, verbose=False, eta=eta,
                                                      unconditional_guidance_scale=scale,
                                                      unconditional_conditioning=un_cond)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0,
-                                                                                                           255).astype(
-            np.uint8)
+        x_samples = samples_to_uint8(x_samples)
 
         results = [x_samples[i] for i in range(num_samples)]
     return [detected_map] + results
@@ -238,16 +276,12 @@ def process_depth(input_image, prompt, a_prompt, n_prompt, num_samples, image_re
 
         detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_LINEAR)
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        control = prepare_hint(detected_map, num_samples, device)
 
         if seed == -1:
             seed = random.randint(0, 65535)
         seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
         task = 'depth'
         task_dic = {}
         task_dic['name'] = task_to_name[task]
@@ -257,12 +291,10 @@ def process_depth(input_image, prompt, a_prompt, n_prompt, num_samples, image_re
                 "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
                 "task": task_dic}
 
-        un_cond = {"c_concat": [control * 0] if guess_mode else [control],
+        un_cond = {"c_concat": [zero_hint(control)] if guess_mode else [control],
                    "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else (
                     [strength] * 13)
         samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
@@ -270,13 +302,8 @@ def process_depth(input_image, prompt, a_prompt, n_prompt, num_samples, image_re
                                                      unconditional_guidance_scale=scale,
                                                      unconditional_conditioning=un_cond)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0,
-                                                                                                           255).astype(
-            np.uint8)
+        x_samples = samples_to_uint8(x_samples)
 
         results = [x_samples[i] for i in range(num_samples)]
     return [detected_map] + results
@@ -297,16 +324,12 @@ def process_normal(input_image, prompt, a_prompt, n_prompt, num_samples, image_r
 
         detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_LINEAR)
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        control = prepare_hint(detected_map, num_samples, device)
 
         if seed == -1:
             seed = random.randint(0, 65535)
         seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
         task = 'normal'
         task_dic = {}
         task_dic['name'] = task_to_name[task]
@@ -316,12 +339,10 @@ def process_normal(input_image, prompt, a_prompt, n_prompt, num_samples, image_r
                 "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
                 "task": task_dic}
 
-        un_cond = {"c_concat": [control * 0] if guess_mode else [control],
+        un_cond = {"c_concat": [zero_hint(control)] if guess_mode else [control],
                    "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else (
                     [strength] * 13)
         samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
@@ -329,13 +350,8 @@ def process_normal(input_image, prompt, a_prompt, n_prompt, num_samples, image_r
                                                      unconditional_guidance_scale=scale,
                                                      unconditional_conditioning=un_cond)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0,
-                                                                                                           255).astype(
-            np.uint8)
+        x_samples = samples_to_uint8(x_samples)
 
         results = [x_samples[i] for i in range(num_samples)]
     return [detected_map] + results
@@ -355,16 +371,12 @@ def process_pose(input_image, prompt, a_prompt, n_prompt, num_samples, image_res
 
         detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_NEAREST)
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        control = prepare_hint(detected_map, num_samples, device)
 
         if seed == -1:
             seed = random.randint(0, 65535)
         seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
         task = 'openpose'
         task_dic = {}
         task_dic['name'] = task_to_name[task]
@@ -374,12 +386,10 @@ def process_pose(input_image, prompt, a_prompt, n_prompt, num_samples, image_res
                 "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
                 "task": task_dic}
 
-        un_cond = {"c_concat": [control * 0] if guess_mode else [control],
+        un_cond = {"c_concat": [zero_hint(control)] if guess_mode else [control],
                    "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else (
                     [strength] * 13)
         samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
@@ -387,13 +397,8 @@ def process_pose(input_image, prompt, a_prompt, n_prompt, num_samples, image_res
                                                      unconditional_guidance_scale=scale,
                                                      unconditional_conditioning=un_cond)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0,
-                                                                                                           255).astype(
-            np.uint8)
+        x_samples = samples_to_uint8(x_samples)
 
         results = [x_samples[i] for i in range(num_samples)]
     return [detected_map] + results
@@ -413,16 +418,12 @@ def process_seg(input_image, prompt, a_prompt, n_prompt, num_samples, image_reso
 
         detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_NEAREST)
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        control = prepare_hint(detected_map, num_samples, device)
 
         if seed == -1:
             seed = random.randint(0, 65535)
         seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
         task = 'seg'
         task_dic = {}
         task_dic['name'] = task_to_name[task]
@@ -432,12 +433,10 @@ def process_seg(input_image, prompt, a_prompt, n_prompt, num_samples, image_reso
         cond = {"c_concat": [control],
                 "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
                 "task": task_dic}
-        un_cond = {"c_concat": [control * 0] if guess_mode else [control],
+        un_cond = {"c_concat": [zero_hint(control)] if guess_mode else [control],
                    "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else (
                     [strength] * 13)
         samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
@@ -445,13 +444,8 @@ def process_seg(input_image, prompt, a_prompt, n_prompt, num_samples, image_reso
                                                      unconditional_guidance_scale=scale,
                                                      unconditional_conditioning=un_cond)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0,
-                                                                                                           255).astype(
-            np.uint8)
+        x_samples = samples_to_uint8(x_samples)
 
         results = [x_samples[i] for i in range(num_samples)]
     return [detected_map] + results
@@ -584,17 +578,12 @@ def process_bbox(input_image, prompt, a_prompt, n_prompt, num_samples, image_res
 
         detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_LINEAR)
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        control = prepare_hint(detected_map, num_samples, device)
 
         if seed == -1:
             seed = random.randint(0, 65535)
         seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         task = 'bbox'
         task_dic = {}
         task_dic['name'] = task_to_name[task]
@@ -605,12 +594,10 @@ def process_bbox(input_image, prompt, a_prompt, n_prompt, num_samples, image_res
                 "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
                 "task": task_dic}
 
-        un_cond = {"c_concat": [control * 0] if guess_mode else [control],
+        un_cond = {"c_concat": [zero_hint(control)] if guess_mode else [control],
                    "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else (
                     [strength] * 13)
         samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
@@ -618,13 +605,8 @@ def process_bbox(input_image, prompt, a_prompt, n_prompt, num_samples, image_res
                                                      unconditional_guidance_scale=scale,
                                                      unconditional_conditioning=un_cond)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0,
-                                                                                                           255).astype(
-            np.uint8)
+        x_samples = samples_to_uint8(x_samples)
 
         results = [x_samples[i] for i in range(num_samples)]
     return [detected_map] + results
@@ -643,17 +625,12 @@ def process_outpainting(input_image, prompt, a_prompt, n_prompt, num_samples, im
 
         detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_LINEAR)
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        control = prepare_hint(detected_map, num_samples, device)
 
         if seed == -1:
             seed = random.randint(0, 65535)
         seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         task = 'outpainting'
         task_dic = {}
         task_dic['name'] = task_to_name[task]
@@ -664,26 +641,24 @@ def process_outpainting(input_image, prompt, a_prompt, n_prompt, num_samples, im
                 "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
                 "task": task_dic}
 
-        un_cond = {"c_concat": [control * 0] if guess_mode else [control],
+        un_cond = {"c_concat": [zero_hint(control)] if guess_mode else [control],
                    "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else (
                     [strength] * 13)
-        samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
-                                                     shape, cond, verbose=False, eta=eta,
-                                                     unconditional_guidance_scale=scale,
-                                                     unconditional_conditioning=un_cond)
-
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
+        if config.crop_to_region and condition_mode == True:
+            samples = crop_sample(ddim_sampler, control, outpainting_hole(H, W, height_top_extended, height_down_extended, width_left_extended, width_right_extended),
+                                  cond, un_cond, ddim_steps, margin=config.region_margin, eta=eta,
+                                  unconditional_guidance_scale=scale)
+        else:
+            samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
+                                                         shape, cond, verbose=False, eta=eta,
+                                                         unconditional_guidance_scale=scale,
+                                                         unconditional_conditioning=un_cond)
 
         x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0,
-                                                                                                           255).astype(
-            np.uint8)
+        x_samples = samples_to_uint8(x_samples)
 
         results = [x_samples[i] for i in range(num_samples)]
     return [detected_map] + results
@@ -697,42 +672,18 @@ def process_sketch(input_image, prompt, a_prompt, n_prompt, num_samples, image_r
         H, W, C = img.shape
 
         if condition_mode == True:
-            detected_map = apply_hed(resize_image(input_image, detect_resolution))
-            detected_map = HWC3(detected_map)
-
-            # sketch the hed image
-            retry = 0
-            cnt = 0
-            while retry == 0:
-                threshold_value = np.random.randint(110, 160)
-                kernel_size = 3
-                alpha = 1.5
-                beta = 50
-                binary_image = cv2.threshold(detected_map, threshold_value, 255, cv2.THRESH_BINARY)[1]
-                inverted_image = cv2.bitwise_not(binary_image)
-                smoothed_image = cv2.GaussianBlur(inverted_image, (kernel_size, kernel_size), 0)
-                sketch_image = cv2.convertScaleAbs(smoothed_image, alpha=alpha, beta=beta)
-                if np.sum(sketch_image < 5) > 0.005 * sketch_image.shape[0] * sketch_image.shape[1] or cnt == 5:
-                    retry = 1
-                else:
-                    cnt += 1
-            detected_map = sketch_image
+            detected_map = hed_sketch(input_image, detect_resolution)
         else:
             detected_map = img
 
         detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_LINEAR)
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        control = prepare_hint(detected_map, num_samples, device)
 
         if seed == -1:
             seed = random.randint(0, 65535)
         seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         task = 'hedsketch'
         task_dic = {}
         task_dic['name'] = task_to_name[task]
@@ -743,12 +694,10 @@ def process_sketch(input_image, prompt, a_prompt, n_prompt, num_samples, image_r
                 "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
                 "task": task_dic}
 
-        un_cond = {"c_concat": [control * 0] if guess_mode else [control],
+        un_cond = {"c_concat": [zero_hint(control)] if guess_mode else [control],
                    "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else (
                     [strength] * 13)
         samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
@@ -756,13 +705,8 @@ def process_sketch(input_image, prompt, a_prompt, n_prompt, num_samples, image_r
                                                      unconditional_guidance_scale=scale,
                                                      unconditional_conditioning=un_cond)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0,
-                                                                                                           255).astype(
-            np.uint8)
+        x_samples = samples_to_uint8(x_samples)
 
         results = [x_samples[i] for i in range(num_samples)]
     return [detected_map] + results
@@ -782,17 +726,12 @@ def process_colorization(input_image, prompt, a_prompt, n_prompt, num_samples, i
         else:
             detected_map = img
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        control = prepare_hint(detected_map, num_samples, device)
 
         if seed == -1:
             seed = random.randint(0, 65535)
         seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         task = 'grayscale'
         task_dic = {}
         task_dic['name'] = task_to_name[task]
@@ -803,26 +742,26 @@ def process_colorization(input_image, prompt, a_prompt, n_prompt, num_samples, i
                 "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
                 "task": task_dic}
 
-        un_cond = {"c_concat": [control * 0] if guess_mode else [control],
+        un_cond = {"c_concat": [zero_hint(control)] if guess_mode else [control],
                    "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else (
                     [strength] * 13)
-        samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
-                                                     shape, cond, verbose=False, eta=eta,
-                                                     unconditional_guidance_scale=scale,
-                                                     unconditional_conditioning=un_cond)
-
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
+        if config.inversion_strength > 0:
+            # start from the inverted source image instead of noise; repeated edits of it reuse the inversion
+            t_enc = max(1, int(config.inversion_strength * ddim_steps))
+            x_enc = inversion_cache.invert(img, cond, ddim_steps, t_enc)
+            samples = ddim_sampler.decode(x_enc, cond, t_enc, unconditional_guidance_scale=scale,
+                                          unconditional_conditioning=un_cond)
+        else:
+            samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
+                                                         shape, cond, verbose=False, eta=eta,
+                                                         unconditional_guidance_scale=scale,
+                                                         unconditional_conditioning=un_cond)
 
         x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0,
-                                                                                                           255).astype(
-            np.uint8)
+        x_samples = samples_to_uint8(x_samples)
 
         results = [x_samples[i] for i in range(num_samples)]
     return [detected_map] + results
@@ -841,17 +780,12 @@ def process_deblur(input_image, prompt, a_prompt, n_prompt, num_samples, image_r
 
         detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_LINEAR)
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        control = prepare_hint(detected_map, num_samples, device)
 
         if seed == -1:
             seed = random.randint(0, 65535)
         seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         task = 'blur'
         task_dic = {}
         task_dic['name'] = task_to_name[task]
@@ -861,26 +795,26 @@ def process_deblur(input_image, prompt, a_prompt, n_prompt, num_samples, image_r
         cond = {"c_concat": [control],
                 "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
                 "task": task_dic}
-        un_cond = {"c_concat": [control * 0] if guess_mode else [control],
+        un_cond = {"c_concat": [zero_hint(control)] if guess_mode else [control],
                    "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else (
                     [strength] * 13)
-        samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
-                                                     shape, cond, verbose=False, eta=eta,
-                                                     unconditional_guidance_scale=scale,
-                                                     unconditional_conditioning=un_cond)
-
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
+        if config.inversion_strength > 0:
+            # start from the inverted source image instead of noise; repeated edits of it reuse the inversion
+            t_enc = max(1, int(config.inversion_strength * ddim_steps))
+            x_enc = inversion_cache.invert(img, cond, ddim_steps, t_enc)
+            samples = ddim_sampler.decode(x_enc, cond, t_enc, unconditional_guidance_scale=scale,
+                                          unconditional_conditioning=un_cond)
+        else:
+            samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
+                                                         shape, cond, verbose=False, eta=eta,
+                                                         unconditional_guidance_scale=scale,
+                                                         unconditional_conditioning=un_cond)
 
         x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0,
-                                                                                                           255).astype(
-            np.uint8)
+        x_samples = samples_to_uint8(x_samples)
 
         results = [x_samples[i] for i in range(num_samples)]
     return [detected_map] + results
@@ -898,17 +832,12 @@ def process_inpainting(input_image, prompt, a_prompt, n_prompt, num_samples, ima
             detected_map = img
         detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_LINEAR)
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        control = prepare_hint(detected_map, num_samples, device)
 
         if seed == -1:
             seed = random.randint(0, 65535)
         seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         task = 'inpainting'
         task_dic = {}
         task_dic['name'] = task_to_name[task]
@@ -918,12 +847,63 @@ def process_inpainting(input_image, prompt, a_prompt, n_prompt, num_samples, ima
         cond = {"c_concat": [control],
                 "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
                 "task": task_dic}
-        un_cond = {"c_concat": [control * 0] if guess_mode else [control],
+        un_cond = {"c_concat": [zero_hint(control)] if guess_mode else [control],
+                   "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
+        shape = (4, H // 8, W // 8)
+
+        model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else (
+                    [strength] * 13)
+        if config.crop_to_region and condition_mode == True:
+            samples = crop_sample(ddim_sampler, control, inpainting_hole(H, W, h_ratio_t, h_ratio_d, w_ratio_l, w_ratio_r),
+                                  cond, un_cond, ddim_steps, margin=config.region_margin, eta=eta,
+                                  unconditional_guidance_scale=scale)
+        else:
+            samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
+                                                         shape, cond, verbose=False, eta=eta,
+                                                         unconditional_guidance_scale=scale,
+                                                         unconditional_conditioning=un_cond)
+
+        x_samples = model.decode_first_stage(samples)
+        x_samples = samples_to_uint8(x_samples)
+
+        results = [x_samples[i] for i in range(num_samples)]
+    return [detected_map] + results
+
+
+def process_sketch_depth(input_image, prompt, a_prompt, n_prompt, num_samples, image_resolution, detect_resolution,
+                         ddim_steps, guess_mode, strength, sketch_strength, depth_strength, scale, seed, eta):
+    with torch.no_grad():
+        input_image = HWC3(input_image)
+        img = resize_image(input_image, image_resolution)
+        H, W, C = img.shape
+
+        sketch_map = cv2.resize(hed_sketch(input_image, detect_resolution), (W, H), interpolation=cv2.INTER_LINEAR)
+        depth_map, _ = apply_midas(resize_image(input_image, detect_resolution))
+        depth_map = cv2.resize(HWC3(depth_map), (W, H), interpolation=cv2.INTER_LINEAR)
+        controls = [prepare_hint(sketch_map, num_samples, device), prepare_hint(depth_map, num_samples, device)]
+
+        if seed == -1:
+            seed = random.randint(0, 65535)
+        seed_everything(seed)
+
+        # both conditions go through one ControlNet batch and their residuals are summed into one UNet pass
+        task_dics = []
+        for task, task_strength in (('hedsketch', sketch_strength), ('depth', depth_strength)):
+            task_dic = {}
+            task_dic['name'] = task_to_name[task]
+            task_instruction = name_to_instruction[task_dic['name']]
+            task_dic['feature'] = model.get_learned_conditioning(task_instruction)[:, :1, :]
+            task_dic['strength'] = float(task_strength)
+            task_dics.append(task_dic)
+
+        cond = {"c_concat": controls,
+                "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)],
+                "task": task_dics}
+
+        un_cond = {"c_concat": [zero_hint(control) for control in controls] if guess_mode else controls,
                    "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else (
                     [strength] * 13)
         samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
@@ -931,16 +911,11 @@ def process_inpainting(input_image, prompt, a_prompt, n_prompt, num_samples, ima
                                                      unconditional_guidance_scale=scale,
                                                      unconditional_conditioning=un_cond)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         x_samples = model.decode_first_stage(samples)
-        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0,
-                                                                                                           255).astype(
-            np.uint8)
+        x_samples = samples_to_uint8(x_samples)
 
         results = [x_samples[i] for i in range(num_samples)]
-    return [detected_map] + results
+    return [sketch_map, depth_map] + results
 
 
 ############################################################################################################
@@ -1348,6 +1323,37 @@ with demo:
                    strength, scale, seed, eta, ksize, condition_mode]
             run_button.click(fn=process_deblur, inputs=ips, outputs=[result_gallery])
 
+        with gr.TabItem("Sketch + Depth"):
+            with gr.Row():
+                gr.Markdown("## UniControl Stable Diffusion with Sketch and Depth Maps Combined")
+            with gr.Row():
+                with gr.Column():
+                    input_image = gr.Image(source='upload', type="numpy")
+                    prompt = gr.Textbox(label="Prompt")
+                    run_button = gr.Button(label="Run")
+                    with gr.Accordion("Advanced options", open=False):
+                        num_samples = gr.Slider(label="Images", minimum=1, maximum=12, value=1, step=1)
+                        image_resolution = gr.Slider(label="Image Resolution", minimum=256, maximum=768, value=512,
+                                                     step=64)
+                        strength = gr.Slider(label="Control Strength", minimum=0.0, maximum=2.0, value=1.0, step=0.01)
+                        sketch_strength = gr.Slider(label="Sketch Weight", minimum=0.0, maximum=2.0, value=0.6, step=0.01)
+                        depth_strength = gr.Slider(label="Depth Weight", minimum=0.0, maximum=2.0, value=0.6, step=0.01)
+                        guess_mode = gr.Checkbox(label='Guess Mode', value=False)
+                        detect_resolution = gr.Slider(label="Detection Resolution", minimum=128, maximum=1024, value=512,
+                                                      step=1)
+                        ddim_steps = gr.Slider(label="Steps", minimum=1, maximum=100, value=20, step=1)
+                        scale = gr.Slider(label="Guidance Scale", minimum=0.1, maximum=30.0, value=9.0, step=0.1)
+                        seed = gr.Slider(label="Seed", minimum=-1, maximum=2147483647, step=1, randomize=True)
+                        eta = gr.Number(label="eta (DDIM)", value=0.0)
+                        a_prompt = gr.Textbox(label="Added Prompt", value='best quality, extremely detailed')
+                        n_prompt = gr.Textbox(label="Negative Prompt", value='longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality')
+                with gr.Column():
+                    result_gallery = gr.Gallery(label='Output', show_label=False, elem_id="gallery").style(grid=2,
+                                                                                                           height='auto')
+            ips = [input_image, prompt, a_prompt, n_prompt, num_samples, image_resolution, detect_resolution,
+                   ddim_steps, guess_mode, strength, sketch_strength, depth_strength, scale, seed, eta]
+            run_button.click(fn=process_sketch_depth, inputs=ips, outputs=[result_gallery])
+
 
     gr.Markdown('''### Tips
          -  Please pay attention to <u> Condition Extraction </u> option. 
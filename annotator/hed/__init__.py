@@ -21,7 +21,7 @@ import torch
 import numpy as np
 
 from einops import rearrange
-from annotator.util import annotator_ckpts_path
+from annotator.util import annotator_ckpts_path, get_device
 
 
 class DoubleConvBlock(torch.nn.Module):
@@ -64,21 +64,22 @@ class ControlNetHED_Apache2(torch.nn.Module):
 
 
 class HEDdetector:
-    def __init__(self):
+    def __init__(self, device=None):
+        self.device = get_device(device)
         remote_model_path = "https://huggingface.co/lllyasviel/Annotators/resolve/main/ControlNetHED.pth"
         modelpath = remote_model_path
         modelpath = os.path.join(annotator_ckpts_path, "ControlNetHED.pth")
         if not os.path.exists(modelpath):
             from basicsr.utils.download_util import load_file_from_url
             load_file_from_url(remote_model_path, model_dir=annotator_ckpts_path)
-        self.netNetwork = ControlNetHED_Apache2().float().cuda().eval()
-        self.netNetwork.load_state_dict(torch.load(modelpath))
+        self.netNetwork = ControlNetHED_Apache2().float().to(self.device).eval()
+        self.netNetwork.load_state_dict(torch.load(modelpath, map_location=self.device))
 
     def __call__(self, input_image):
         assert input_image.ndim == 3
         H, W, C = input_image.shape
         with torch.no_grad():
-            image_hed = torch.from_numpy(input_image.copy()).float().cuda()
+            image_hed = torch.from_numpy(input_image.copy()).float().to(self.device)
             image_hed = rearrange(image_hed, 'h w c -> 1 c h w')
             edges = self.netNetwork(image_hed)
             edges = [e.detach().cpu().numpy().astype(np.float32)[0, 0] for e in edges]
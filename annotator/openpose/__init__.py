@@ -29,7 +29,7 @@ hand_model_path = "https://huggingface.co/lllyasviel/ControlNet/resolve/main/ann
 
 
 class OpenposeDetector:
-    def __init__(self):
+    def __init__(self, device=None):
         body_modelpath = os.path.join(annotator_ckpts_path, "body_pose_model.pth")
         # hand_modelpath = os.path.join(annotator_ckpts_path, "hand_pose_model.pth")
 
@@ -38,8 +38,8 @@ class OpenposeDetector:
             load_file_from_url(body_model_path, model_dir=annotator_ckpts_path)
             # load_file_from_url(hand_model_path, model_dir=annotator_ckpts_path)
 
-        self.body_estimation = Body(body_modelpath)
-        # self.hand_estimation = Hand(hand_modelpath)
+        self.body_estimation = Body(body_modelpath, device=device)
+        # self.hand_estimation = Hand(hand_modelpath, device=device)
 
     def __call__(self, oriImg, hand=False):
         oriImg = oriImg[:, :, ::-1].copy()
@@ -21,14 +21,13 @@ from skimage.measure import label
 
 from .model import handpose_model
 from . import util
+from annotator.util import get_device
 
 class Hand(object):
-    def __init__(self, model_path):
-        self.model = handpose_model()
-        if torch.cuda.is_available():
-            self.model = self.model.cuda()
-            print('cuda')
-        model_dict = util.transfer(self.model, torch.load(model_path))
+    def __init__(self, model_path, device=None):
+        self.device = get_device(device)
+        self.model = handpose_model().to(self.device)
+        model_dict = util.transfer(self.model, torch.load(model_path, map_location='cpu'))
         self.model.load_state_dict(model_dict)
         self.model.eval()
 
@@ -50,9 +49,7 @@ class Hand(object):
             im = np.transpose(np.float32(imageToTest_padded[:, :, :, np.newaxis]), (3, 2, 0, 1)) / 256 - 0.5
             im = np.ascontiguousarray(im)
 
-            data = torch.from_numpy(im).float()
-            if torch.cuda.is_available():
-                data = data.cuda()
+            data = torch.from_numpy(im).float().to(self.device)
             # data = data.permute([2, 0, 1]).unsqueeze(0).float()
             with torch.no_grad():
                 output = self.model(data).cpu().numpy()
@@ -10,17 +10,17 @@ import os
 
 from annotator.uniformer.mmdet.apis import init_detector, inference_detector, show_result_pyplot
 from annotator.uniformer.mmdet.core.evaluation import get_palette
-from annotator.util import annotator_ckpts_path
+from annotator.util import annotator_ckpts_path, get_device
     
 # checkpoint_file = "https://huggingface.co/lllyasviel/ControlNet/resolve/main/annotator/ckpts/upernet_global_small.pth"
 
 
 class UniformerDetector:
-    def __init__(self):
+    def __init__(self, device=None):
         modelpath = os.path.join(annotator_ckpts_path, "cascade_mask_rcnn_3x_ms_hybrid_base.pth")
 
         config_file = os.path.join(os.path.dirname(annotator_ckpts_path), "uniformer", "exp", "cascade_mask_rcnn_3x_ms_hybrid_base", "config.py")
-        self.model = init_detector(config_file, modelpath).cuda()
+        self.model = init_detector(config_file, modelpath, device=str(get_device(device)))
 
     def __call__(self, img):
         result = inference_detector(self.model, img)
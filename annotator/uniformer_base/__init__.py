@@ -15,13 +15,13 @@
 import os
 from annotator.uniformer_base.mmseg.apis import init_segmentor, inference_segmentor, show_result_pyplot
 from annotator.uniformer_base.mmseg.core.evaluation import get_palette
-from annotator.util import annotator_ckpts_path
+from annotator.util import annotator_ckpts_path, get_device
 
 import pdb
 #checkpoint_file = "https://huggingface.co/Salesforce/UniControl/blob/main/annotator/ckpts/upernet_global_base.pth"
 checkpoint_file =  "https://storage.googleapis.com/sfr-unicontrol-data-research/annotator/ckpts/upernet_global_base.pth"
 class UniformerDetector:
-    def __init__(self):
+    def __init__(self, device=None):
         #modelpath = os.path.join(annotator_ckpts_path, "upernet_global_base.pth")
         #if not os.path.exists(modelpath):
         #    from basicsr.utils.download_util import load_file_from_url
@@ -29,7 +29,7 @@ class UniformerDetector:
         #    raise ValueError("wrong ckpt path")
         modelpath = checkpoint_file
         config_file = os.path.join(os.path.dirname(annotator_ckpts_path), "uniformer_base", "exp", "upernet_global_base", "config.py")
-        self.model = init_segmentor(config_file, modelpath).cuda()
+        self.model = init_segmentor(config_file, modelpath, device=str(get_device(device)))
 
     def __call__(self, img):
         result = inference_segmentor(self.model, img)
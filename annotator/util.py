@@ -11,10 +11,25 @@
 import numpy as np
 import cv2
 import os
+import torch
 
 annotator_ckpts_path = os.path.join(os.path.dirname(__file__), "ckpts")
 
 
+def get_device(device=None):
+    """
+    Resolve a device setting: None or "auto" picks CUDA, then MPS, then CPU.
+    """
+    if device is None or device == "auto":
+        if torch.cuda.is_available():
+            device = "cuda"
+        elif getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+            device = "mps"
+        else:
+            device = "cpu"
+    return torch.device(device)
+
+
 def HWC3(x):
     assert x.dtype == np.uint8
     if x.ndim == 2:
@@ -34,8 +49,8 @@ def HWC3(x):
         return y
 
 
-def resize_image(input_image, resolution):
-    H, W, C = input_image.shape
+def resize_shape(H, W, resolution):
+    """Size (H, W, scale) of resize_image: shorter side to `resolution`, both sides rounded to multiples of 64."""
     H = float(H)
     W = float(W)
     k = float(resolution) / min(H, W)
@@ -43,5 +58,10 @@ def resize_image(input_image, resolution):
     W *= k
     H = int(np.round(H / 64.0)) * 64
     W = int(np.round(W / 64.0)) * 64
+    return H, W, k
+
+
+def resize_image(input_image, resolution):
+    H, W, k = resize_shape(input_image.shape[0], input_image.shape[1], resolution)
     img = cv2.resize(input_image, (W, H), interpolation=cv2.INTER_LANCZOS4 if k > 1 else cv2.INTER_AREA)
     return img
@@ -10,31 +10,31 @@
 
 import config
 
-import cv2
-import einops
 import gradio as gr
 import numpy as np
 import torch
 import random
 import os
+import threading
 
-from annotator.util import resize_image, HWC3
+from annotator.util import resize_image, HWC3, get_device
 from utils import create_model
 from lib.ddim_hacked import DDIMSampler
+from lib.placement import plan_placement, format_plan
+from lib.tensor_store import TensorStore
+from lib.onnx_denoiser import OnnxDenoiser
+from lib.image_encoder import ImageEncoder, samples_to_uint8
+from lib.preprocess import prepare_hint, zero_hint
+from lib.upscale import latent_upscale, REFINE_MODES
+from lib.refiner import RefinerStage
+from lib.lora import LoRAManager
 
-from safetensors.torch import load_file as stload
-from collections import OrderedDict
-from diffusers import StableDiffusionXLImg2ImgPipeline
-from PIL import Image
+device = get_device(config.device)
 
-refiner = StableDiffusionXLImg2ImgPipeline.from_pretrained(
-    "stabilityai/stable-diffusion-xl-refiner-1.0",
-    torch_dtype=torch.float16,
-)
-refiner.to("cuda")
+# loaded on the first "sdxl" refinement
+refiner = RefinerStage(device)
 
 
-model = create_model("./models/cldm_v15_unicontrol.yaml").cpu()
 model_url = "https://huggingface.co/Robert001/UniControl-Model/resolve/main/unicontrol_v1.1.st"
 
 ckpts_path = "./"
@@ -46,14 +46,57 @@ if not os.path.exists(model_path):
 
     load_file_from_url(model_url, model_dir=ckpts_path)
 
-model_dict = OrderedDict(stload(model_path, device="cpu"))
-model.load_state_dict(model_dict, strict=False)
-# model.load_state_dict(load_state_dict(model_path, location='cuda'), strict=False)
-model = model.cuda()
-ddim_sampler = DDIMSampler(model)
+model = create_model("./models/cldm_v15_unicontrol.yaml", precision=config.precision, device=device, ckpt_path=model_path)
+if config.channels_last:
+    model.to_channels_last()
+if config.memory_budget_gb > 0:
+    plan = plan_placement(model, config.memory_budget_gb * 2 ** 30,
+                          resolution=config.plan_resolution, num_samples=config.plan_num_samples)
+    print(format_plan(plan))
+    model.apply_placement(plan["placement"], device, window=plan["window"])
+elif config.stream_window > 0:
+    model.enable_weight_streaming(device, window=config.stream_window)
+else:
+    model = model.to(device)
+# after placement: the fused kernel is built and checked on the device it runs on
+if config.fuse_norm_act:
+    model.fuse_norm_act(device=device)
+if config.quantize_int8:
+    model.quantize_int8()
+model.parallel_control = config.parallel_control
+if config.cond_cache_size:
+    model.enable_cond_cache(config.cond_cache_size, table_path=config.task_table)
+if config.compile:
+    if config.truncate_context:
+        # every rounded prompt length would be a bucket of its own, compiled on the first request that hits it
+        raise RuntimeError("truncate_context cannot be combined with compile, disable one of them")
+    model.enable_compile(buckets=config.compile_buckets, tasks=["control_hedsketch"], cache_dir=config.compile_cache_dir)
+ddim_sampler = DDIMSampler(model, denoiser=OnnxDenoiser(config.onnx_denoiser) if config.onnx_denoiser else None)
 
+store = None
+if config.model_variants:
+    if config.onnx_denoiser:
+        raise RuntimeError("model_variants have no effect with onnx_denoiser, its weights are baked into the exported graph")
+    if config.quantize_int8:
+        raise RuntimeError("model_variants cannot be swapped on an int8 quantized model, disable quantize_int8")
+    store = TensorStore()
+    store.add_checkpoint("default", model_path)
+    store.adopt(model, "default")
+    for name, path in config.model_variants.items():
+        store.add_checkpoint(name, path, base="default")
+lora = None
+if config.lora_adapters:
+    lora = LoRAManager(model, merge_after=config.lora_merge_after, max_merged=config.lora_max_merged,
+                       denoiser=ddim_sampler.denoiser)
+    for name, path in config.lora_adapters.items():
+        lora.add(name, path)
+# the base model serves one request at a time (and runs on whichever variant is bound); refinement
+# runs on the refiner's own worker, outside of this lock, overlapping with the next request
+model_lock = threading.Lock()
+encoder = ImageEncoder(config.output_format, config.output_quality)
 
-def process_sketch(
+
+def generate_sketch(
     input_image,
     prompt,
     a_prompt,
@@ -65,26 +108,27 @@ def process_sketch(
     scale,
     seed,
     eta,
+    refine=config.refine_mode,
+    variant="default",
+    style="none",
 ):
-    with torch.no_grad():
-        input_image = np.array(input_image)
-        # print all unique values of array
-        img = 255 - input_image
-        H, W, C = img.shape
-
-        detected_map = cv2.resize(img, (W, H), interpolation=cv2.INTER_LINEAR)
-
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, "b h w c -> b c h w").clone()
+    if config.distilled_steps:
+        # a distilled checkpoint samples as it was trained: its step count, deterministic DDIM, and guidance
+        # folded into the weights (a single conditional pass per step)
+        ddim_steps, eta, scale = config.distilled_steps, 0.0, 1.0
+    with torch.no_grad(), model_lock:
+        if store is not None:
+            store.bind(model, variant)
+        if lora is not None:
+            lora.activate(None if style == "none" else style)
+        # the sketch is drawn dark on white, the hint is light on black
+        control = prepare_hint(np.array(input_image), num_samples, device, invert=True)
+        H, W = control.shape[2:]
 
         if seed == -1:
             seed = random.randint(0, 65535)
         # seed_everything(seed)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
-
         task_dic = {}
         task_dic["name"] = "control_hedsketch"
         task_instruction = "sketch to image"
@@ -97,13 +141,14 @@ def process_sketch(
         }
 
         un_cond = {
-            "c_concat": [control * 0] if guess_mode else [control],
+            "c_concat": [zero_hint(control)] if guess_mode else [control],
             "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)],
         }
+        if config.truncate_context:
+            cond["context_lengths"] = model.get_context_lengths([prompt + ", " + a_prompt] * num_samples)
+            un_cond["context_lengths"] = model.get_context_lengths([n_prompt] * num_samples)
         shape = (4, H // 8, W // 8)
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=True)
         model.control_scales = (
             [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else ([strength] * 13)
         )
@@ -118,24 +163,34 @@ def process_sketch(
             unconditional_conditioning=un_cond,
         )
 
-        if config.save_memory:
-            model.low_vram_shift(is_diffusing=False)
+        if refine == "latent_upscale":
+            samples = latent_upscale(
+                ddim_sampler,
+                samples,
+                cond,
+                un_cond,
+                factor=config.latent_upscale_factor,
+                strength=config.latent_upscale_strength,
+                ddim_steps=ddim_steps,
+                guidance_scale=scale,
+            )
 
-        x_samples = model.decode_first_stage(samples)
-        x_samples = (
-            (einops.rearrange(x_samples, "b c h w -> b h w c") * 127.5 + 127.5)
-            .cpu()
-            .numpy()
-            .clip(0, 255)
-            .astype(np.uint8)
-        )
+        x_samples = samples_to_uint8(model.decode_first_stage(samples))
+        if refine == "sdxl":
+            refined = refiner.submit(x_samples, prompt, seed)
+
+    if refine != "sdxl":
+        return list(x_samples)
+    return list(x_samples) + refined.result()
+
+
+def process_sketch(*args):
+    return encoder.to_files(generate_sketch(*args))
 
-        result_image = [x_samples[i] for i in range(num_samples)][0]
-        result_image = Image.fromarray(result_image)
-        generator = torch.Generator("cuda").manual_seed(seed)
-        results = [result_image] + [refiner(prompt=prompt, generator=generator, image=result_image).images[0]]
 
-    return results
+def process_sketch_encoded(*args):
+    # for API clients: the encoded images as base64, without a round trip through image files
+    return encoder.to_json(generate_sketch(*args))
 
 
 demo = gr.Blocks()
@@ -160,10 +215,17 @@ with demo:
         strength = gr.Slider(label="Control Strength", minimum=0.0, maximum=2.0, value=1.0, step=0.01)
         guess_mode = gr.Checkbox(label="Guess Mode", value=False)
         detect_resolution = gr.Slider(label="HED Resolution", minimum=128, maximum=1024, value=512, step=1)
-        ddim_steps = gr.Slider(label="Steps", minimum=1, maximum=100, value=35, step=1)
-        scale = gr.Slider(label="Guidance Scale", minimum=0.1, maximum=30.0, value=9.0, step=0.1)
+        ddim_steps = gr.Slider(label="Steps", minimum=1, maximum=100, value=config.distilled_steps or 35, step=1,
+                               interactive=not config.distilled_steps)
+        scale = gr.Slider(label="Guidance Scale", minimum=0.1, maximum=30.0, value=1.0 if config.distilled_steps else 9.0,
+                          step=0.1, interactive=not config.distilled_steps)
         seed = gr.Slider(label="Seed", minimum=-1, maximum=2147483647, step=1, randomize=True)
-        eta = gr.Number(label="eta (DDIM)", value=0.0)
+        eta = gr.Number(label="eta (DDIM)", value=0.0, interactive=not config.distilled_steps)
+        refine = gr.Radio(label="Refine", choices=list(REFINE_MODES), value=config.refine_mode)
+        variant = gr.Dropdown(label="Model", choices=list(store.variants) if store is not None else ["default"],
+                              value="default", visible=store is not None)
+        if lora is not None:
+            style = gr.Dropdown(label="Style (LoRA)", choices=["none"] + list(lora.adapters), value="none")
         a_prompt = gr.Textbox(label="Added Prompt", value="best quality, extremely detailed")
         n_prompt = gr.Textbox(
             label="Negative Prompt",
@@ -182,6 +244,13 @@ with demo:
         seed,
         eta,
     ]
+    ips.append(refine)
+    ips.append(variant)
+    if lora is not None:
+        ips.append(style)
     run_button.click(fn=process_sketch, inputs=ips, outputs=[result_gallery])
+    api_button = gr.Button(visible=False)
+    api_button.click(fn=process_sketch_encoded, inputs=ips, outputs=[gr.JSON(visible=False)], api_name="sketch_encoded")
 
-demo.launch(server_name="0.0.0.0")
+# more than one request in flight, so the base model and the refiner work on different requests
+demo.queue(concurrency_count=config.request_concurrency).launch(server_name="0.0.0.0")
@@ -8,4 +8,97 @@
  * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
 '''
 
-save_memory = False
\ No newline at end of file
+# device for the model and the annotators: "auto" (CUDA, then MPS, then CPU), "cuda", "cuda:1", "mps" or "cpu";
+# the compute dtype is set by `precision` below
+device = "auto"
+
+# stream UNet / ControlNet blocks from host memory keeping `stream_window` blocks on the GPU,
+# text encoder and VAE are loaded only while they run (0 keeps the whole model resident)
+stream_window = 0
+
+# plan the placement of text encoder / VAE / ControlNet / UNet for this much GPU memory (GiB) at startup,
+# sized for `plan_resolution` and `plan_num_samples`; overrides `stream_window` (0 disables planning)
+memory_budget_gb = 0
+plan_resolution = 512
+plan_num_samples = 1
+
+# swap GroupNorm + SiLU pairs for the fused GroupNormSiLU at load time (inference only, needs torch.compile
+# for the fused kernel); keep off until measured faster than the eager ops on the target GPU and dtype
+fuse_norm_act = False
+
+# run the UNet, ControlNet and VAE in channels-last memory format
+channels_last = False
+
+# compute precision for UNet, ControlNet, VAE and text encoder: "fp32", "fp16", "bf16" or "auto"
+# ("auto" is bf16 on CPU and fp16 on GPU)
+precision = "fp32"
+
+# int8 dynamic quantization of the text encoder and attention / feed-forward linears (CPU and fp32 only)
+quantize_int8 = False
+
+# run the ControlNet concurrently with the UNet input/middle blocks (second CUDA stream or worker thread)
+parallel_control = False
+
+# extra checkpoints of the same architecture served next to the default one, name -> path;
+# identical tensors are shared and switching between them per request is a pointer swap
+model_variants = {}
+
+# path of a denoiser step exported with tool_export_onnx.py, run with onnxruntime instead of
+# eager PyTorch for guided sampling (CPU serving; the graph is fixed to the task it was exported for)
+onnx_denoiser = None
+
+# torch.compile the denoiser and VAE decoder, one static graph per (batch, resolution) bucket;
+# `compile_buckets` (num_samples, height, width) are compiled at startup and the inductor cache
+# is kept in `compile_cache_dir` so restarts do not recompile
+compile = False
+compile_buckets = [(1, 512, 512)]
+compile_cache_dir = "./compile_cache"
+
+# DDIM steps of a checkpoint written by tool_distill.py (0 for regular checkpoints); guidance is folded
+# into its weights, so it samples with a single conditional pass per step; steps, eta (0) and the guidance
+# scale (1) are fixed to what the student was trained for
+distilled_steps = 0
+
+# LRU cache of text encoder outputs (prompts, negative prompts, task instructions), number of strings kept;
+# the embeddings of the 13 task instructions are persisted in `task_table` (0 disables the cache)
+cond_cache_size = 256
+task_table = "./models/task_instructions.safetensors"
+
+# let cross attention attend only to the prompt tokens actually used (longest prompt of the batch, EOS
+# included) instead of all 77 padded positions; changes outputs slightly, as the padding tokens are dropped.
+# Not with `compile`: each rounded length would be a new graph
+truncate_context = False
+
+# encoding of the generated images: "png", "jpeg" or "webp", and the JPEG / WebP quality (0-100);
+# the gallery serves these files as they are, API clients get the bytes from the "sketch_encoded" endpoint
+output_format = "png"
+output_quality = 90
+
+# post-stage after sampling, per request in the UI: "none", "latent_upscale" (upscale the latent and
+# re-denoise part of the schedule with the same model, `latent_upscale_factor` / `latent_upscale_strength`)
+# or "sdxl" (the SDXL img2img refiner, a second model)
+refine_mode = "sdxl"
+latent_upscale_factor = 1.5
+latent_upscale_strength = 0.5
+
+# requests handled at the same time; the base model serves them one by one, so above 1 the next
+# request's sampling overlaps with the previous request's refinement
+request_concurrency = 2
+
+# inpainting / outpainting denoise only the bounding box of the region to fill plus `region_margin` pixels
+# of context and keep the rest of the image (its VAE reconstruction), instead of regenerating the whole canvas
+crop_to_region = False
+region_margin = 64
+
+# colorization / deblur start from the DDIM inversion of the source image, `inversion_strength` of the
+# schedule deep, instead of from noise (0 disables); inversions are kept for the last `inversion_cache_size`
+# (image, prompt, hint, steps) combinations, so iterating on the edits of one photo skips re-inverting it
+inversion_strength = 0.0
+inversion_cache_size = 8
+
+# LoRA style adapters for the UNet / ControlNet attention and feed-forward linears, name -> path, picked per
+# request; an adapter is merged into the weights once it makes up `lora_merge_after` of the last 32 requests
+# (no per-step cost), rarer ones run unmerged (no swap cost); merged weights are kept for `lora_max_merged` adapters
+lora_adapters = {}
+lora_merge_after = 4
+lora_max_merged = 2
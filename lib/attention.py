@@ -18,7 +18,7 @@ from torch import nn, einsum
 from einops import rearrange, repeat
 from typing import Optional, Any
 
-from lib.util import checkpoint
+from lib.util import checkpoint, GroupNorm32, LayerNorm32
 
 try:
     import xformers
@@ -100,7 +100,7 @@ def zero_module(module):
 
 
 def Normalize(in_channels):
-    return torch.nn.GroupNorm(num_groups=32, num_channels=in_channels, eps=1e-6, affine=True)
+    return GroupNorm32(num_groups=32, num_channels=in_channels, eps=1e-6, affine=True)
 
 
 class SpatialSelfAttention(nn.Module):
@@ -186,7 +186,7 @@ class CrossAttention(nn.Module):
 
         # force cast to fp32 to avoid overflowing
         if _ATTN_PRECISION == "fp32":
-            with torch.autocast(enabled=False, device_type='cuda'):
+            with torch.autocast(enabled=False, device_type='cuda' if x.is_cuda else 'cpu'):
                 q, k = q.float(), k.float()
                 sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
         else:
@@ -201,7 +201,7 @@ class CrossAttention(nn.Module):
             sim.masked_fill_(~mask, max_neg_value)
 
         # attention, what we cannot get enough of
-        sim = sim.softmax(dim=-1)
+        sim = sim.softmax(dim=-1).type(v.dtype)
 
         out = einsum('b i j, b j d -> b i d', sim, v)
         out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
@@ -275,9 +275,9 @@ class BasicTransformerBlock(nn.Module):
         self.ff = FeedForward(dim, dropout=dropout, glu=gated_ff)
         self.attn2 = attn_cls(query_dim=dim, context_dim=context_dim,
                               heads=n_heads, dim_head=d_head, dropout=dropout)  # is self-attn if context is none
-        self.norm1 = nn.LayerNorm(dim)
-        self.norm2 = nn.LayerNorm(dim)
-        self.norm3 = nn.LayerNorm(dim)
+        self.norm1 = LayerNorm32(dim)
+        self.norm2 = LayerNorm32(dim)
+        self.norm3 = LayerNorm32(dim)
         self.checkpoint = checkpoint
 
     def forward(self, x, context=None):
@@ -340,17 +340,21 @@ class SpatialTransformer(nn.Module):
             context = [context]
         b, c, h, w = x.shape
         x_in = x
+        # channels-last inputs are already laid out as b (h w) c, so the
+        # permute + reshape below are views instead of copies
+        memory_format = torch.channels_last if x.is_contiguous(memory_format=torch.channels_last) \
+            else torch.contiguous_format
         x = self.norm(x)
         if not self.use_linear:
             x = self.proj_in(x)
-        x = rearrange(x, 'b c h w -> b (h w) c').contiguous()
+        x = x.permute(0, 2, 3, 1).reshape(b, h * w, -1)
         if self.use_linear:
             x = self.proj_in(x)
         for i, block in enumerate(self.transformer_blocks):
             x = block(x, context=context[i])
         if self.use_linear:
             x = self.proj_out(x)
-        x = rearrange(x, 'b (h w) c -> b c h w', h=h, w=w).contiguous()
+        x = x.reshape(b, h, w, -1).permute(0, 3, 1, 2).contiguous(memory_format=memory_format)
         if not self.use_linear:
             x = self.proj_out(x)
         return x + x_in
@@ -0,0 +1,50 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+import os
+
+import torch
+
+
+def enable_compile_cache(cache_dir):
+    """
+    Persist inductor artifacts (FX graph cache, generated kernels, autotuning results) in `cache_dir`,
+    so a restart only re-traces with dynamo and loads the compiled graphs instead of recompiling them.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+
+
+class BucketedCompile(object):
+    """
+    torch.compile `fn` with static shapes, one graph per shape bucket given by `key_fn(*args, **kwargs)`.
+    Buckets are the warmed-up ones plus the first new keys seen, up to `max_buckets`; calls outside
+    them run eagerly, so unusual request shapes cannot trigger a recompilation storm.
+    Values that change between calls without changing the bucket must be tensor arguments of `fn`, and the
+    caller configures dynamo for static buckets (automatic_dynamic_shapes off, cache_size_limit >= max_buckets),
+    see ControlLDM.enable_compile.
+    """
+
+    def __init__(self, fn, key_fn, max_buckets=8, **compile_kwargs):
+        self.eager = fn
+        self.key_fn = key_fn
+        self.max_buckets = max_buckets
+        self.buckets = set()
+        self.compiled = torch.compile(fn, dynamic=False, **compile_kwargs)
+
+    def __call__(self, *args, **kwargs):
+        key = self.key_fn(*args, **kwargs)
+        if key not in self.buckets:
+            if len(self.buckets) >= self.max_buckets:
+                return self.eager(*args, **kwargs)
+            self.buckets.add(key)
+        return self.compiled(*args, **kwargs)
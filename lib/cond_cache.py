@@ -0,0 +1,96 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import torch
+
+from lib.tensor_store import tensor_hash
+
+
+def module_fingerprint(module, sample=4096):
+    """Cheap identity of a module's weights: hashes of the first `sample` elements of every parameter."""
+    h = hashlib.blake2b(digest_size=16)
+    for name, p in module.named_parameters():
+        h.update(name.encode())
+        h.update(tensor_hash(p.detach().reshape(-1)[:sample]).encode())
+    return h.hexdigest()
+
+
+class ConditioningCache(object):
+    """
+    LRU cache of text encoder outputs in front of LatentDiffusion.get_learned_conditioning.
+    Each unique string is encoded once: the misses of a call go through one batched forward, and the
+    result is a copy of the cached rows, never the rows themselves. Pinned strings (the task
+    instructions) are never evicted and can be persisted to disk with `save` / `load`.
+    Entries are dropped whenever the parameters of the text encoder are swapped (e.g. TensorStore.bind).
+    :param encode: list of strings -> [len, tokens, dim] tensor, the uncached encoder.
+    :param module: the text encoder, watched for parameter swaps.
+    """
+
+    def __init__(self, encode, module, max_size=256, pinned=()):
+        self.encode = encode
+        self.module = module
+        self.max_size = max_size
+        self.pinned = set(pinned)
+        self.entries = OrderedDict()
+        self.weights = None
+        self.hits = self.misses = 0
+
+    def _check_weights(self):
+        weights = tuple(id(p) for p in self.module.parameters())
+        if weights != self.weights:
+            self.entries.clear()
+            self.weights = weights
+
+    def __call__(self, texts):
+        if isinstance(texts, str):
+            texts = [texts]
+        self._check_weights()
+        missing = list(OrderedDict.fromkeys(text for text in texts if text not in self.entries))
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            for text, row in zip(missing, self.encode(missing).split(1)):
+                self.entries[text] = row
+        for text in texts:
+            self.entries.move_to_end(text)
+        rows = [self.entries[text] for text in texts]
+        self._evict()
+        # always a new tensor: callers may modify it in place without touching the cached rows
+        return torch.cat(rows)
+
+    def _evict(self):
+        evictable = [text for text in self.entries if text not in self.pinned]
+        for text in evictable[:max(0, len(evictable) - self.max_size)]:
+            del self.entries[text]
+
+    def save(self, path):
+        from safetensors.torch import save_file
+        self._check_weights()
+        self(sorted(self.pinned))
+        save_file({text: self.entries[text].detach().contiguous().cpu() for text in self.pinned}, path,
+                  metadata={'fingerprint': module_fingerprint(self.module)})
+
+    def load(self, path, device=None):
+        """Load a table written by `save`; it is ignored if it was written for other text encoder weights."""
+        from safetensors import safe_open
+        if not os.path.exists(path):
+            return False
+        self._check_weights()
+        with safe_open(path, framework='pt') as f:
+            if f.metadata().get('fingerprint') != module_fingerprint(self.module):
+                return False
+            for text in f.keys():
+                self.entries[text] = f.get_tensor(text).to(device)
+                self.pinned.add(text)
+        return True
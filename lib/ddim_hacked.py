@@ -15,20 +15,22 @@ import numpy as np
 from tqdm import tqdm
 
 from lib.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, \
-    extract_into_tensor
+    extract_into_tensor, to_channels_last
 
 
 class DDIMSampler(object):
-    def __init__(self, model, schedule="linear", **kwargs):
+    def __init__(self, model, schedule="linear", denoiser=None, **kwargs):
         super().__init__()
         self.model = model
+        # optional replacement for the guided apply_model call, e.g. lib.onnx_denoiser.OnnxDenoiser
+        self.denoiser = denoiser
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.device:
+                attr = attr.to(self.model.device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
@@ -107,6 +109,11 @@ class DDIMSampler(object):
                     print(f"Warning: Got {conditioning.shape[0]} conditionings but batch-size is {batch_size}")
 
         self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=verbose)
+        if getattr(self.model, 'channels_last', False):
+            # convert once here so no layout copies happen inside the step loop
+            conditioning = to_channels_last(conditioning)
+            unconditional_conditioning = to_channels_last(unconditional_conditioning)
+            x_T, x0, mask = to_channels_last(x_T), to_channels_last(x0), to_channels_last(mask)
         # sampling
         C, H, W = shape
         size = (batch_size, C, H, W)
@@ -143,6 +150,8 @@ class DDIMSampler(object):
         b = shape[0]
         if x_T is None:
             img = torch.randn(shape, device=device)
+            if getattr(self.model, 'channels_last', False):
+                img = img.contiguous(memory_format=torch.channels_last)
         else:
             img = x_T
 
@@ -189,6 +198,40 @@ class DDIMSampler(object):
 
         return img, intermediates
 
+    def guided_model_output(self, x, t, c, unconditional_guidance_scale=1., unconditional_conditioning=None):
+        """Classifier-free guided apply_model: one batched pass over the unconditional and conditional inputs."""
+        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
+            return self.model.apply_model(x, t, c)
+        if self.denoiser is not None:
+            return self.denoiser(x, t, c, unconditional_conditioning, unconditional_guidance_scale,
+                                 self.model.control_scales)
+        x_in = torch.cat([x] * 2)
+        t_in = torch.cat([t] * 2)
+        if isinstance(c, dict):
+            assert isinstance(unconditional_conditioning, dict)
+            c_in = dict()
+            for k in c:
+                if k == 'task':
+                    continue
+                if isinstance(c[k], list):
+                    c_in[k] = [torch.cat([
+                        unconditional_conditioning[k][i],
+                        c[k][i]]) for i in range(len(c[k]))]
+                else:
+                    c_in[k] = torch.cat([
+                        unconditional_conditioning[k],
+                        c[k]])
+            c_in['task'] = c['task']
+        elif isinstance(c, list):
+            c_in = list()
+            assert isinstance(unconditional_conditioning, list)
+            for i in range(len(c)):
+                c_in.append(torch.cat([unconditional_conditioning[i], c[i]]))
+        else:
+            c_in = torch.cat([unconditional_conditioning, c])
+        model_uncond, model_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
+        return model_uncond + unconditional_guidance_scale * (model_t - model_uncond)
+
     @torch.no_grad()
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
@@ -196,37 +239,7 @@ class DDIMSampler(object):
                       dynamic_threshold=None):
         b, *_, device = *x.shape, x.device
 
-        task_name = c['task']
-
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
-            model_output = self.model.apply_model(x, t, c)
-        else:
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([t] * 2)
-            if isinstance(c, dict):
-                assert isinstance(unconditional_conditioning, dict)
-                c_in = dict()
-                for k in c:
-                    if k == 'task':
-                        continue
-                    if isinstance(c[k], list):
-                        c_in[k] = [torch.cat([
-                            unconditional_conditioning[k][i],
-                            c[k][i]]) for i in range(len(c[k]))]
-                    else:
-                        c_in[k] = torch.cat([
-                            unconditional_conditioning[k],
-                            c[k]])
-            elif isinstance(c, list):
-                c_in = list()
-                assert isinstance(unconditional_conditioning, list)
-                for i in range(len(c)):
-                    c_in.append(torch.cat([unconditional_conditioning[i], c[i]]))
-            else:
-                c_in = torch.cat([unconditional_conditioning, c])
-            c_in['task'] = task_name
-            model_uncond, model_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
-            model_output = model_uncond + unconditional_guidance_scale * (model_t - model_uncond)
+        model_output = self.guided_model_output(x, t, c, unconditional_guidance_scale, unconditional_conditioning)
 
         if self.model.parameterization == "v":
             e_t = self.model.predict_eps_from_z_and_v(x, t, model_output)
@@ -269,39 +282,46 @@ class DDIMSampler(object):
 
     @torch.no_grad()
     def encode(self, x0, c, t_enc, use_original_steps=False, return_intermediates=None,
-               unconditional_guidance_scale=1.0, unconditional_conditioning=None, callback=None):
+               unconditional_guidance_scale=1.0, unconditional_conditioning=None, callback=None, start_step=0):
+        """
+        DDIM inversion: run the deterministic sampler backwards from the clean latent `x0` for `t_enc` steps,
+        so that `decode(x_encoded, c, t_enc, ...)` reconstructs `x0`. Takes the same (dict) conditioning as `sample`.
+        :param start_step: number of steps `x0` has already been inverted, to resume a shorter inversion.
+        :return: x_encoded and {'x_encoded', 'intermediate_steps', 'intermediates' if return_intermediates}.
+        """
         num_reference_steps = self.ddpm_num_timesteps if use_original_steps else self.ddim_timesteps.shape[0]
 
-        assert t_enc <= num_reference_steps
+        assert start_step <= t_enc <= num_reference_steps
         num_steps = t_enc
 
         if use_original_steps:
+            timesteps = np.arange(num_steps)
             alphas_next = self.alphas_cumprod[:num_steps]
             alphas = self.alphas_cumprod_prev[:num_steps]
         else:
+            timesteps = self.ddim_timesteps[:num_steps]
             alphas_next = self.ddim_alphas[:num_steps]
-            alphas = torch.tensor(self.ddim_alphas_prev[:num_steps])
+            alphas = torch.as_tensor(self.ddim_alphas_prev[:num_steps], dtype=alphas_next.dtype,
+                                     device=alphas_next.device)
 
         x_next = x0
         intermediates = []
         inter_steps = []
-        for i in tqdm(range(num_steps), desc='Encoding Image'):
-            t = torch.full((x0.shape[0],), i, device=self.model.device, dtype=torch.long)
-            if unconditional_guidance_scale == 1.:
-                noise_pred = self.model.apply_model(x_next, t, c)
+        for i in tqdm(range(start_step, num_steps), desc='Encoding Image'):
+            t = torch.full((x0.shape[0],), int(timesteps[i]), device=self.model.device, dtype=torch.long)
+            model_output = self.guided_model_output(x_next, t, c, unconditional_guidance_scale,
+                                                    unconditional_conditioning)
+            if self.model.parameterization == "v":
+                noise_pred = self.model.predict_eps_from_z_and_v(x_next, t, model_output)
             else:
-                assert unconditional_conditioning is not None
-                e_t_uncond, noise_pred = torch.chunk(
-                    self.model.apply_model(torch.cat((x_next, x_next)), torch.cat((t, t)),
-                                           torch.cat((unconditional_conditioning, c))), 2)
-                noise_pred = e_t_uncond + unconditional_guidance_scale * (noise_pred - e_t_uncond)
+                noise_pred = model_output
 
             xt_weighted = (alphas_next[i] / alphas[i]).sqrt() * x_next
             weighted_noise_pred = alphas_next[i].sqrt() * (
                     (1 / alphas_next[i] - 1).sqrt() - (1 / alphas[i] - 1).sqrt()) * noise_pred
-            x_next = xt_weighted + weighted_noise_pred
+            x_next = (xt_weighted + weighted_noise_pred).to(x0.dtype)
             if return_intermediates and i % (
-                    num_steps // return_intermediates) == 0 and i < num_steps - 1:
+                    max(1, num_steps // return_intermediates)) == 0 and i < num_steps - 1:
                 intermediates.append(x_next)
                 inter_steps.append(i)
             elif return_intermediates and i >= num_steps - 2:
@@ -35,6 +35,7 @@ from lib.distributions import normal_kl, DiagonalGaussianDistribution
 from lib.autoencoder import IdentityFirstStage, AutoencoderKL
 from lib.util import make_beta_schedule, extract_into_tensor, noise_like
 from lib.ddim import DDIMSampler
+from lib.cond_cache import ConditioningCache
 
 __conditioning_keys__ = {'concat': 'c_concat',
                          'crossattn': 'c_crossattn',
@@ -569,6 +570,7 @@ class LatentDiffusion(DDPM):
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None
+        self.cond_cache = None
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -662,6 +664,24 @@ class LatentDiffusion(DDPM):
         return self.scale_factor * z
 
     def get_learned_conditioning(self, c):
+        if self.cond_cache is not None and not self.cond_stage_trainable and \
+                (isinstance(c, str) or isinstance(c, list) and all(isinstance(t, str) for t in c)):
+            return self.cond_cache(c)
+        return self._encode_conditioning(c)
+
+    def enable_cond_cache(self, max_size=256, pinned=(), table_path=None):
+        """
+        Put a ConditioningCache in front of get_learned_conditioning for string conditioning.
+        :param pinned: strings that are never evicted.
+        :param table_path: file the pinned rows are loaded from, or encoded and written to if it is
+                           missing or was written for other text encoder weights.
+        """
+        self.cond_cache = ConditioningCache(self._encode_conditioning, self.cond_stage_model, max_size, pinned)
+        if table_path is not None and not self.cond_cache.load(table_path, self.device):
+            self.cond_cache.save(table_path)
+        return self
+
+    def _encode_conditioning(self, c):
         if self.cond_stage_forward is None:
             if hasattr(self.cond_stage_model, 'encode') and callable(self.cond_stage_model.encode):
                 c = self.cond_stage_model.encode(c)
@@ -829,11 +849,17 @@ class LatentDiffusion(DDPM):
             z = rearrange(z, 'b h w c -> b c h w').contiguous()
 
         z = 1. / self.scale_factor * z
-        return self.first_stage_model.decode(z)
+        return self.first_stage_model.decode(z.type(self.first_stage_dtype)).float()
 
     @torch.no_grad()
     def encode_first_stage(self, x):
-        return self.first_stage_model.encode(x)
+        return self.first_stage_model.encode(x.type(self.first_stage_dtype))
+
+    @property
+    def first_stage_dtype(self):
+        # dtype of the first stage's leading conv, i.e. what it expects as input
+        param = next(self.first_stage_model.parameters(), None)
+        return param.dtype if param is not None else torch.float32
 
     def shared_step(self, batch, **kwargs):
         x, c = self.get_input(batch, self.first_stage_key)
@@ -0,0 +1,116 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+import copy
+
+import numpy as np
+import torch
+
+from lib.util import make_ddim_timesteps
+
+
+def frozen_copy(model):
+    """A frozen copy of a ControlLDM sharing its VAE and text encoder, which distillation never trains."""
+    memo = {id(model.first_stage_model): model.first_stage_model, id(model.cond_stage_model): model.cond_stage_model}
+    teacher = copy.deepcopy(model, memo)
+    return teacher.eval().requires_grad_(False)
+
+
+class DistillationTrainer(object):
+    """
+    Distills a ControlLDM into a student of the same architecture that samples with few deterministic
+    DDIM steps (eta = 0) and a single conditional pass, so its checkpoint loads into the existing pipeline.
+
+    `guidance_step` (guidance distillation, Meng et al. 2023): the student's conditional prediction
+    matches the teacher's classifier-free guided prediction at `guidance_scale`, on random timesteps.
+    `progressive_step` (progressive distillation, Salimans & Ho 2022): one student DDIM step on the
+    `num_steps` grid of DDIMSampler matches two teacher DDIM steps; `next_round` makes the current
+    student the teacher for the next, halved, number of steps.
+
+    Both losses are on the epsilon prediction with truncated-SNR weighting max(1, (1 - a) / a), i.e. the
+    x0 error weighted by max(SNR, 1). The optimizer comes from `student.configure_optimizers`.
+    :param teacher: the model to distill, frozen (see frozen_copy).
+    :param student: the model being trained, initialized from the teacher.
+    """
+
+    def __init__(self, teacher, student, guidance_scale=9.0, num_steps=16, learning_rate=1e-5, train_unet=True):
+        self.teacher = teacher
+        self.student = student
+        self.guidance_scale = guidance_scale
+        self.teacher_guided = True
+        self.num_steps = num_steps
+        student.learning_rate = learning_rate
+        student.sd_locked = not train_unet
+        student.requires_grad_(False)
+        self.optimizer = student.configure_optimizers()
+        for group in self.optimizer.param_groups:
+            for p in group['params']:
+                p.requires_grad_(True)
+        self.alphas = student.alphas_cumprod.float()
+
+    def next_round(self, num_steps):
+        """Freeze the current student as the (single pass) teacher of a student sampling with `num_steps`."""
+        self.teacher = frozen_copy(self.student)
+        self.teacher_guided = False
+        self.num_steps = num_steps
+
+    def teacher_eps(self, x, t, cond, uncond):
+        if not self.teacher_guided:
+            return self.teacher.apply_model(x, t, cond)
+        c_in = {k: [torch.cat([u, c]) for u, c in zip(uncond[k], cond[k])] for k in ('c_concat', 'c_crossattn')}
+        c_in['task'] = cond['task']
+        eps_uncond, eps_cond = self.teacher.apply_model(torch.cat([x, x]), torch.cat([t, t]), c_in).chunk(2)
+        return eps_uncond + self.guidance_scale * (eps_cond - eps_uncond)
+
+    def ddim_step(self, x, eps, t, t_prev):
+        a, a_prev = self._alpha(t), self._alpha(t_prev)
+        x0 = (x - (1 - a).sqrt() * eps) / a.sqrt()
+        return a_prev.sqrt() * x0 + (1 - a_prev).sqrt() * eps
+
+    def _alpha(self, t):
+        return self.alphas.to(t.device)[t].view(-1, 1, 1, 1)
+
+    def _step(self, z0, t, cond, target):
+        noise = torch.randn_like(z0)
+        x = self.student.q_sample(z0, t, noise=noise)
+        with torch.no_grad():
+            eps_target = target(x, t)
+        eps = self.student.apply_model(x, t, cond)
+        a = self._alpha(t)
+        weight = torch.clamp((1 - a) / a, min=1.0)
+        loss = (weight * (eps.float() - eps_target.float()) ** 2).mean()
+        self.optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        self.optimizer.step()
+        return loss.item()
+
+    def guidance_step(self, z0, cond, uncond):
+        """One optimizer step of guidance distillation on a batch of latents `z0`."""
+        t = torch.randint(0, self.student.num_timesteps, (z0.shape[0],), device=z0.device).long()
+        return self._step(z0, t, cond, lambda x, t: self.teacher_eps(x, t, cond, uncond))
+
+    def progressive_step(self, z0, cond, uncond):
+        """One optimizer step of progressive distillation: one student step for two teacher steps."""
+        grid = make_ddim_timesteps('uniform', self.num_steps, self.student.num_timesteps, verbose=False)
+        grid_prev = np.concatenate([[0], grid[:-1]])
+        i = np.random.randint(0, len(grid), z0.shape[0])
+        t = torch.from_numpy(grid[i]).long().to(z0.device)
+        t_prev = torch.from_numpy(grid_prev[i]).long().to(z0.device)
+        t_mid = (t + t_prev) // 2
+
+        def target(x, t):
+            # two teacher DDIM steps t -> t_mid -> t_prev, then the eps that takes the student there in one
+            x_mid = self.ddim_step(x, self.teacher_eps(x, t, cond, uncond), t, t_mid)
+            x_prev = self.ddim_step(x_mid, self.teacher_eps(x_mid, t_mid, cond, uncond), t_mid, t_prev)
+            a, a_prev = self._alpha(t), self._alpha(t_prev)
+            ratio = ((1 - a_prev) / (1 - a)).sqrt()
+            x0 = (x_prev - ratio * x) / (a_prev.sqrt() - ratio * a.sqrt())
+            return (x - a.sqrt() * x0) / (1 - a).sqrt()
+        return self._step(z0, t, cond, target)
@@ -12,7 +12,7 @@ import torch
 import torch.nn as nn
 from torch.utils.checkpoint import checkpoint
 
-from transformers import T5Tokenizer, T5EncoderModel, CLIPTokenizer, CLIPTextModel
+from transformers import T5Tokenizer, T5EncoderModel, CLIPTokenizer, CLIPTokenizerFast, CLIPTextModel, CLIPTextConfig
 
 import open_clip
 from utils import default, count_params
@@ -96,18 +96,29 @@ class FrozenT5Embedder(AbstractEncoder):
 
 
 class FrozenCLIPEmbedder(AbstractEncoder):
-    """Uses the CLIP transformer encoder for text (from huggingface)"""
+    """
+    Uses the CLIP transformer encoder for text (from huggingface)
+    :param pretrained: load the pretrained weights of `version`; if False, only its config is read and the
+                       weights are left to the caller (e.g. a checkpoint that carries cond_stage_model.*).
+    """
     LAYERS = [
         "last",
         "pooled",
         "hidden"
     ]
-    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77,
-                 freeze=True, layer="last", layer_idx=None):  # clip-vit-base-patch32
+    def __init__(self, version="openai/clip-vit-large-patch14", device=None, max_length=77,
+                 freeze=True, layer="last", layer_idx=None, use_fast_tokenizer=True, pretrained=True):  # clip-vit-base-patch32
         super().__init__()
         assert layer in self.LAYERS
-        self.tokenizer = CLIPTokenizer.from_pretrained(version)
-        self.transformer = CLIPTextModel.from_pretrained(version)
+        self.tokenizer = (CLIPTokenizerFast if use_fast_tokenizer else CLIPTokenizer).from_pretrained(version)
+        if pretrained:
+            self.transformer = CLIPTextModel.from_pretrained(version)
+        else:
+            self.transformer = CLIPTextModel(CLIPTextConfig.from_pretrained(version))
+            embeddings = self.transformer.text_model.embeddings
+            if embeddings.position_ids.is_meta:
+                # built under utils.init_empty_weights: the position ids are not in every checkpoint, rebuild them
+                embeddings.position_ids = torch.arange(embeddings.position_ids.shape[-1], device='cpu').expand((1, -1))
         self.device = device
         self.max_length = max_length
         if freeze:
@@ -127,7 +138,8 @@ class FrozenCLIPEmbedder(AbstractEncoder):
     def forward(self, text):
         batch_encoding = self.tokenizer(text, truncation=True, max_length=self.max_length, return_length=True,
                                         return_overflowing_tokens=False, padding="max_length", return_tensors="pt")
-        tokens = batch_encoding["input_ids"].to(self.device)
+        # without an explicit device, follow wherever the transformer weights currently are
+        tokens = batch_encoding["input_ids"].to(self.device or self.transformer.device)
         outputs = self.transformer(input_ids=tokens, output_hidden_states=self.layer=="hidden")
         if self.layer == "last":
             z = outputs.last_hidden_state
@@ -140,6 +152,12 @@ class FrozenCLIPEmbedder(AbstractEncoder):
     def encode(self, text):
         return self(text)
 
+    def token_lengths(self, text):
+        """Number of tokens of each text, BOS and EOS included, as used by forward."""
+        batch_encoding = self.tokenizer(text, truncation=True, max_length=self.max_length, return_length=True,
+                                        return_overflowing_tokens=False, padding=False)
+        return torch.tensor(batch_encoding["length"])
+
 
 class FrozenOpenCLIPEmbedder(AbstractEncoder):
     """
@@ -0,0 +1,106 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+import atexit
+import base64
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import torch
+
+
+MIME_TYPES = {'jpeg': 'image/jpeg', 'webp': 'image/webp', 'png': 'image/png'}
+
+
+def samples_to_uint8(x_samples):
+    """
+    Decoder output in [-1, 1], [B, C, H, W], to uint8 [B, H, W, C] numpy images. Scaling, clipping and the
+    cast run where the samples are, so a quarter of the bytes is copied to the host.
+    """
+    x_samples = (x_samples * 127.5 + 127.5).clamp_(0, 255).to(torch.uint8)
+    return x_samples.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
+
+class ImageEncoder(object):
+    """
+    Encodes uint8 RGB images to JPEG / WebP / PNG on a thread pool (OpenCV releases the GIL while encoding).
+    :param format: "jpeg", "webp" or "png".
+    :param quality: JPEG / WebP quality, 0-100.
+    :param png_compression: zlib level for PNG, 0-9; low levels are much faster for a little larger files.
+    :param directory: where `to_files` writes, a fresh temporary directory (removed at exit) if None.
+    :param max_files: files kept in `directory`; older ones are deleted as new ones are written. Gradio copies
+                      the gallery files into its own cache when a request returns, so this only has to cover
+                      the requests in flight.
+    """
+
+    def __init__(self, format='png', quality=90, png_compression=1, num_threads=4, directory=None, max_files=256):
+        if format not in MIME_TYPES:
+            raise ValueError(f"unknown image format '{format}', expected one of {list(MIME_TYPES)}")
+        self.format = format
+        self.quality = quality
+        self.png_compression = png_compression
+        self.pool = ThreadPoolExecutor(num_threads, thread_name_prefix='image-encoder')
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='image-encoder-')
+            atexit.register(shutil.rmtree, directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_files = max_files
+        self.files = deque()
+        self.files_lock = threading.Lock()
+
+    @property
+    def mime_type(self):
+        return MIME_TYPES[self.format]
+
+    def _encode(self, image):
+        params = {'jpeg': [cv2.IMWRITE_JPEG_QUALITY, self.quality],
+                  'webp': [cv2.IMWRITE_WEBP_QUALITY, self.quality],
+                  'png': [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]}[self.format]
+        ok, buffer = cv2.imencode('.' + self.format, cv2.cvtColor(image, cv2.COLOR_RGB2BGR), params)
+        if not ok:
+            raise RuntimeError(f'could not encode a {image.shape} image as {self.format}')
+        return buffer.tobytes()
+
+    def encode(self, images):
+        """:return: the encoded bytes of every image, encoded concurrently."""
+        return list(self.pool.map(self._encode, images))
+
+    def to_files(self, images):
+        """
+        Encode `images` into files (e.g. for a gr.Gallery, which serves them as they are) and return their paths.
+        Only the last `max_files` files are kept.
+        """
+        paths = []
+        for data in self.encode(images):
+            fd, path = tempfile.mkstemp(suffix='.' + self.format, dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            paths.append(path)
+        with self.files_lock:
+            self.files.extend(paths)
+            keep = max(self.max_files, len(paths))  # never the files of this call
+            stale = [self.files.popleft() for _ in range(max(0, len(self.files) - keep))]
+        for path in stale:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return paths
+
+    def to_json(self, images):
+        """Encoded images for API clients: [{"mime_type": ..., "data": base64 bytes}, ...]."""
+        return [{'mime_type': self.mime_type, 'data': base64.b64encode(data).decode('ascii')}
+                for data in self.encode(images)]
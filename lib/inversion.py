@@ -0,0 +1,116 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from lib.tensor_store import tensor_hash
+
+
+def _first_row(cond):
+    # the source image is a single image: invert it under one row of the (repeated) conditioning
+    if cond is None:
+        return None
+    row = dict()
+    for k, v in cond.items():
+        if k == 'task':
+            row[k] = v
+        elif isinstance(v, list):
+            row[k] = [x[:1] for x in v]
+        else:
+            row[k] = v[:1]
+    return row
+
+
+def _cond_hash(h, cond):
+    for k in sorted(cond):
+        h.update(k.encode())
+        if k == 'task':
+            # one task dict, or a list of them for multi-condition conditioning
+            for task in cond[k] if isinstance(cond[k], (list, tuple)) else [cond[k]]:
+                h.update(str(task['name']).encode())
+                if 'strength' in task:
+                    h.update(tensor_hash(torch.as_tensor(task['strength'])).encode())
+            continue
+        for x in cond[k] if isinstance(cond[k], list) else [cond[k]]:
+            h.update(tensor_hash(x).encode())
+
+
+class InversionCache(object):
+    """
+    Content-addressed LRU of DDIM inversion trajectories, for repeated edits of the same source image.
+    A trajectory is the VAE latent of the image followed by the latent after every inversion step; it is
+    keyed by the image bytes, the conditioning (prompt embedding, hint, task), the number of DDIM steps and
+    the control scales, so any edit strength of a later request is a lookup, and a stronger one resumes
+    from the longest stored step. Entries are dropped whenever the model parameters are swapped.
+    :param sampler: the DDIMSampler (lib.ddim_hacked) of the ControlLDM.
+    :param storage: device the trajectories are kept on between requests.
+    """
+
+    def __init__(self, sampler, max_size=8, storage='cpu'):
+        self.sampler = sampler
+        self.max_size = max_size
+        self.storage = storage
+        self.entries = OrderedDict()
+        self.weights = None
+        self.hits = self.misses = 0
+
+    def _check_weights(self):
+        weights = tuple(id(p) for p in self.sampler.model.parameters())
+        if weights != self.weights:
+            self.entries.clear()
+            self.weights = weights
+
+    def key(self, image, cond, ddim_steps):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(tensor_hash(torch.from_numpy(np.ascontiguousarray(image))).encode())
+        _cond_hash(h, cond)
+        h.update(f'{ddim_steps}{tuple(self.sampler.model.control_scales or ())}'.encode())
+        return h.hexdigest()
+
+    def _encode_image(self, image):
+        model = self.sampler.model
+        x = torch.from_numpy(np.ascontiguousarray(image)).to(model.device)
+        x = x.permute(2, 0, 1)[None].float() / 127.5 - 1.0
+        return model.scale_factor * model.encode_first_stage(x).mode()
+
+    @torch.no_grad()
+    def invert(self, image, cond, ddim_steps, t_enc):
+        """
+        The inverted latent of `image` after `t_enc` of `ddim_steps` DDIM steps, ready for
+        `sampler.decode(x, cond, t_enc, ...)`. Inversion runs unguided, on the first row of `cond`.
+        :param image: uint8 [H, W, 3] source image, H and W multiples of 64.
+        :return: [B, 4, H / 8, W / 8], the inverted latent expanded to the batch of `cond`.
+        """
+        self._check_weights()
+        batch_size = cond['c_crossattn'][0].shape[0]
+        cond = _first_row(cond)
+        key = self.key(image, cond, ddim_steps)
+        trajectory = self.entries.get(key)
+        self.sampler.make_schedule(ddim_steps, ddim_eta=0.0, verbose=False)
+        if trajectory is not None and len(trajectory) > t_enc:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if trajectory is None:
+                trajectory = [self._encode_image(image).to(self.storage)]
+            start_step = len(trajectory) - 1
+            _, out = self.sampler.encode(trajectory[-1].to(self.sampler.model.device), cond, t_enc,
+                                         return_intermediates=t_enc, start_step=start_step)
+            trajectory = trajectory + [x.to(self.storage) for x in out.get('intermediates', [])]
+            self.entries[key] = trajectory
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        x = trajectory[t_enc].to(self.sampler.model.device)
+        return x.expand(batch_size, -1, -1, -1)
@@ -0,0 +1,173 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+from collections import OrderedDict, deque
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+from lib.attention import CrossAttention, MemoryEfficientCrossAttention, FeedForward
+from lib.compile import BucketedCompile
+from utils import load_state_dict
+
+
+def lora_targets(model):
+    """The linears LoRA adapters can patch: attention and feed-forward of the UNet and ControlNet, by name."""
+    targets = {}
+    for prefix in ('model.diffusion_model', 'control_model'):
+        for name, module in model.get_submodule(prefix).named_modules():
+            if isinstance(module, (CrossAttention, MemoryEfficientCrossAttention, FeedForward)):
+                for sub, linear in module.named_modules():
+                    if isinstance(linear, nn.Linear):
+                        targets[f'{prefix}.{name}.{sub}'] = linear
+    return targets
+
+
+def load_lora(path_or_state_dict):
+    """
+    Read a LoRA adapter: for every patched linear `<name>` (named as in the ControlLDM, e.g.
+    `model.diffusion_model.input_blocks.1.1.transformer_blocks.0.attn1.to_q`), `<name>.lora_down.weight`
+    [rank, in], `<name>.lora_up.weight` [out, rank] and optionally a scalar `<name>.alpha` (default rank).
+    :return: {name: (down, up, alpha / rank)}
+    """
+    state_dict = path_or_state_dict
+    if isinstance(path_or_state_dict, str):
+        state_dict = load_state_dict(path_or_state_dict)
+    layers = {}
+    for key, down in state_dict.items():
+        if not key.endswith('.lora_down.weight'):
+            continue
+        name = key[:-len('.lora_down.weight')]
+        up = state_dict[f'{name}.lora_up.weight']
+        rank = down.shape[0]
+        alpha = float(state_dict[f'{name}.alpha']) if f'{name}.alpha' in state_dict else rank
+        layers[name] = (down, up, alpha / rank)
+    return layers
+
+
+class LoRAManager(object):
+    """
+    Hot-swaps LoRA adapters on a ControlLDM, one adapter (or none) active at a time.
+    Two ways to apply an adapter:
+      unmerged - a forward hook adds the low-rank product to each patched linear; switching costs nothing,
+                 every step pays the extra matmuls.
+      merged   - the patched linears point at weight + scale * up @ down; no per-step cost, building the
+                 weights costs a full matmul per linear and their memory. The merged weights of the
+                 `max_merged` most recently used adapters are kept, so switching back to them is a pointer swap.
+    An adapter is merged once it accounts for at least `merge_after` of the last `window` activations,
+    i.e. the hottest adapters run merged and the long tail unmerged.
+    Merged weights are new tensors, never written into the base weights: those may be shared TensorStore
+    tensors. Merged entries are tied to the base tensors they were built from, so TensorStore.bind can still
+    be used to change the base variant before `activate`.
+    Not available with weight streaming, torch.compile, int8 quantization or an ONNX `denoiser`.
+    """
+
+    def __init__(self, model, merge_after=4, window=32, max_merged=2, denoiser=None):
+        if getattr(model, 'weight_streamer', None) is not None:
+            raise RuntimeError('LoRA adapters cannot be swapped on a model with weight streaming enabled')
+        if denoiser is not None:
+            raise RuntimeError('LoRA adapters have no effect with an ONNX denoiser, its weights are baked into the '
+                               'exported graph')
+        if isinstance(model.__dict__.get('denoise'), BucketedCompile):
+            raise RuntimeError('LoRA adapters cannot be swapped on a compiled model: hooks and weight swaps '
+                               'invalidate the compiled graphs and recompile them')
+        quantized = [name for name, module in model.named_modules() if isinstance(module, DynamicQuantizedLinear)]
+        if quantized:
+            raise RuntimeError(f'LoRA adapters need float linears, the model has {len(quantized)} int8 quantized '
+                               f'ones (e.g. {quantized[0]})')
+        self.model = model
+        self.targets = lora_targets(model)
+        self.merge_after = merge_after
+        self.max_merged = max_merged
+        self.adapters = {}
+        self.recent = deque(maxlen=window)
+        self.merged = OrderedDict()  # (adapter, base weight ids) -> {linear name: merged weight}
+        self.installed = {}          # linear name -> (base weight, merged weight) while an adapter is merged
+        self.unmerged = {}           # linear -> (down, up, scale) while an adapter runs unmerged
+        self.handles = []
+        self.active = None
+
+    def add(self, name, path_or_state_dict, scale=1.0):
+        """Register adapter `name`, its factors converted to the dtype and device of the linears they patch."""
+        layers = {}
+        for layer, (down, up, layer_scale) in load_lora(path_or_state_dict).items():
+            if layer not in self.targets:
+                raise ValueError(f"adapter [{name}]: '{layer}' is not an attention / feed-forward linear of the model")
+            weight = self.targets[layer].weight
+            if tuple(weight.shape) != (up.shape[0], down.shape[1]):
+                raise ValueError(f"adapter [{name}]: factors of '{layer}' do not match its {tuple(weight.shape)} weight")
+            layers[layer] = (down.to(weight.device, weight.dtype), up.to(weight.device, weight.dtype), layer_scale * scale)
+        self.adapters[name] = layers
+        return self
+
+    def _hook(self, module, inputs, output):
+        down, up, scale = self.unmerged[module]
+        return output + F.linear(F.linear(inputs[0], down), up) * scale
+
+    def _deactivate(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.unmerged = {}
+        for layer, (base, merged) in self.installed.items():
+            linear = self.targets[layer]
+            if linear._parameters['weight'] is merged:  # else a TensorStore.bind already replaced it
+                linear._parameters['weight'] = base
+        self.installed = {}
+        self.active = None
+
+    def _merged_key(self, name):
+        return name, tuple(id(self.targets[layer].weight) for layer in self.adapters[name])
+
+    def _merge(self, name):
+        key = self._merged_key(name)
+        if key not in self.merged:
+            merged = {}
+            for layer, (down, up, scale) in self.adapters[name].items():
+                weight = self.targets[layer].weight
+                delta = (up.float() @ down.float()) * scale
+                merged[layer] = nn.Parameter((weight.float() + delta).to(weight.dtype), requires_grad=False)
+            self.merged[key] = merged
+            while len(self.merged) > self.max_merged:
+                self.merged.popitem(last=False)
+        self.merged.move_to_end(key)
+        return self.merged[key]
+
+    def is_hot(self, name):
+        return sum(1 for recent in self.recent if recent == name) >= self.merge_after
+
+    @torch.no_grad()
+    def activate(self, name):
+        """
+        Make adapter `name` (None for the base model) the active one, merged or unmerged following its traffic.
+        :return: "merged", "unmerged" or None.
+        """
+        if name is not None and name not in self.adapters:
+            raise KeyError(f'unknown LoRA adapter [{name}], expected one of {list(self.adapters)}')
+        self.recent.append(name)
+        self._deactivate()
+        mode = None
+        if name is not None:
+            mode = 'merged' if self.is_hot(name) or self._merged_key(name) in self.merged else 'unmerged'
+        if mode == 'merged':
+            for layer, merged in self._merge(name).items():
+                linear = self.targets[layer]
+                self.installed[layer] = (linear._parameters['weight'], merged)
+                linear._parameters['weight'] = merged
+        elif mode == 'unmerged':
+            for layer, factors in self.adapters[name].items():
+                linear = self.targets[layer]
+                self.unmerged[linear] = factors
+                self.handles.append(linear.register_forward_hook(self._hook))
+        self.active = (name, mode)
+        return mode
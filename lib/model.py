@@ -17,6 +17,7 @@ from einops import rearrange
 from typing import Optional, Any
 
 from lib.attention import MemoryEfficientCrossAttention
+from lib.util import GroupNorm32, GroupNormSiLU, fuse_norm_silu
 
 try:
     import xformers
@@ -54,7 +55,7 @@ def nonlinearity(x):
 
 
 def Normalize(in_channels, num_groups=32):
-    return torch.nn.GroupNorm(num_groups=num_groups, num_channels=in_channels, eps=1e-6, affine=True)
+    return GroupNorm32(num_groups=num_groups, num_channels=in_channels, eps=1e-6, affine=True)
 
 
 class Upsample(nn.Module):
@@ -136,17 +137,27 @@ class ResnetBlock(nn.Module):
                                                     stride=1,
                                                     padding=0)
 
+    def fuse_norm_act(self, check=True, device=None):
+        # norm1/norm2 become GroupNormSiLU; forward then skips the separate nonlinearity
+        if isinstance(self.norm1, GroupNormSiLU):
+            return
+        self.norm1 = fuse_norm_silu(self.norm1, check=check, device=device)
+        self.norm2 = fuse_norm_silu(self.norm2, check=check, device=device)
+
     def forward(self, x, temb):
+        fused = isinstance(self.norm1, GroupNormSiLU)
         h = x
         h = self.norm1(h)
-        h = nonlinearity(h)
+        if not fused:
+            h = nonlinearity(h)
         h = self.conv1(h)
 
         if temb is not None:
             h = h + self.temb_proj(nonlinearity(temb))[:,:,None,None]
 
         h = self.norm2(h)
-        h = nonlinearity(h)
+        if not fused:
+            h = nonlinearity(h)
         h = self.dropout(h)
         h = self.conv2(h)
 
@@ -200,7 +211,7 @@ class AttnBlock(nn.Module):
         k = k.reshape(b,c,h*w) # b,c,hw
         w_ = torch.bmm(q,k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
         w_ = w_ * (int(c)**(-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
+        w_ = torch.nn.functional.softmax(w_.float(), dim=2).type(v.dtype)
 
         # attend to values
         v = v.reshape(b,c,h*w)
@@ -525,6 +536,14 @@ class Encoder(nn.Module):
                                         stride=1,
                                         padding=1)
 
+    def fuse_norm_act(self, check=True, device=None):
+        # the resnet blocks and norm_out + nonlinearity become GroupNormSiLU
+        for module in self.modules():
+            if isinstance(module, ResnetBlock):
+                module.fuse_norm_act(check=check, device=device)
+        if not isinstance(self.norm_out, GroupNormSiLU):
+            self.norm_out = fuse_norm_silu(self.norm_out, check=check, device=device)
+
     def forward(self, x):
         # timestep embedding
         temb = None
@@ -548,7 +567,8 @@ class Encoder(nn.Module):
 
         # end
         h = self.norm_out(h)
-        h = nonlinearity(h)
+        if not isinstance(self.norm_out, GroupNormSiLU):
+            h = nonlinearity(h)
         h = self.conv_out(h)
         return h
 
@@ -626,6 +646,14 @@ class Decoder(nn.Module):
                                         stride=1,
                                         padding=1)
 
+    def fuse_norm_act(self, check=True, device=None):
+        # the resnet blocks and norm_out + nonlinearity become GroupNormSiLU
+        for module in self.modules():
+            if isinstance(module, ResnetBlock):
+                module.fuse_norm_act(check=check, device=device)
+        if not isinstance(self.norm_out, GroupNormSiLU):
+            self.norm_out = fuse_norm_silu(self.norm_out, check=check, device=device)
+
     def forward(self, z):
         #assert z.shape[1:] == self.z_shape[1:]
         self.last_z_shape = z.shape
@@ -655,7 +683,8 @@ class Decoder(nn.Module):
             return h
 
         h = self.norm_out(h)
-        h = nonlinearity(h)
+        if not isinstance(self.norm_out, GroupNormSiLU):
+            h = nonlinearity(h)
         h = self.conv_out(h)
         if self.tanh_out:
             h = torch.tanh(h)
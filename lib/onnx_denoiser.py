@@ -0,0 +1,129 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+import json
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from lib.attention import MemoryEfficientCrossAttention
+
+
+INPUT_NAMES = ['x', 'timesteps', 'context', 'uncond_context', 'hint', 'uncond_hint',
+               'guidance_scale', 'control_scales']
+
+
+class CFGDenoiser(nn.Module):
+    """
+    One classifier-free guided denoiser call of a ControlLDM for a fixed task: ControlNet and UNet
+    on the concatenated [unconditional, conditional] batch, then the guidance combination of
+    DDIMSampler.p_sample_ddim. The guidance scale and the 13 control scales are inputs.
+    """
+
+    def __init__(self, model, task_name, task_feature):
+        super().__init__()
+        self.model = model
+        self.task_name = task_name
+        self.register_buffer('task_feature', task_feature)
+
+    def forward(self, x, timesteps, context, uncond_context, hint, uncond_hint, guidance_scale, control_scales):
+        cond = {'c_crossattn': [torch.cat([uncond_context, context])],
+                'c_concat': [torch.cat([uncond_hint, hint])],
+                'task': {'name': self.task_name, 'feature': self.task_feature}}
+        control_scales_before = self.model.control_scales
+        self.model.control_scales = list(control_scales.unbind(0))
+        try:
+            out = self.model.apply_model(torch.cat([x, x]), torch.cat([timesteps, timesteps]), cond)
+        finally:
+            self.model.control_scales = control_scales_before
+        model_uncond, model_t = out.chunk(2)
+        return model_uncond + guidance_scale * (model_t - model_uncond)
+
+
+def export_onnx(model, path, task_name, task_feature, batch_size=1, resolution=512, opset_version=17):
+    """
+    Trace the CFG denoiser step of `model` for `task_name` into an ONNX graph with dynamic batch and
+    latent / hint size. The task is baked in; its name is stored in the model metadata.
+    """
+    if any(isinstance(m, MemoryEfficientCrossAttention) for m in model.modules()):
+        raise RuntimeError('xformers attention cannot be exported, run the export without xformers installed')
+    parallel_control, model.parallel_control = model.parallel_control, False
+    denoiser = CFGDenoiser(model, task_name, task_feature).eval()
+    context_dim = task_feature.shape[-1]
+    h = w = resolution
+    args = (torch.randn(batch_size, model.channels, h // 8, w // 8),
+            torch.full((batch_size,), 999, dtype=torch.long),
+            torch.randn(batch_size, 77, context_dim),
+            torch.randn(batch_size, 77, context_dim),
+            torch.rand(batch_size, 3, h, w),
+            torch.rand(batch_size, 3, h, w),
+            torch.tensor([9.0]),
+            torch.ones(13))
+    dynamic_axes = {'x': {0: 'batch', 2: 'latent_height', 3: 'latent_width'},
+                    'timesteps': {0: 'batch'},
+                    'context': {0: 'batch'}, 'uncond_context': {0: 'batch'},
+                    'hint': {0: 'batch', 2: 'height', 3: 'width'},
+                    'uncond_hint': {0: 'batch', 2: 'height', 3: 'width'},
+                    'model_output': {0: 'batch', 2: 'latent_height', 3: 'latent_width'}}
+    try:
+        with torch.no_grad():
+            torch.onnx.export(denoiser, args, path, input_names=INPUT_NAMES, output_names=['model_output'],
+                              dynamic_axes=dynamic_axes, opset_version=opset_version, do_constant_folding=True)
+            reference = denoiser(*args)
+    finally:
+        model.parallel_control = parallel_control
+
+    import onnx
+    onnx_model = onnx.load(path, load_external_data=False)
+    meta = onnx_model.metadata_props.add()
+    meta.key, meta.value = 'unicontrol', json.dumps({'task': task_name, 'parameterization': model.parameterization})
+    onnx.save(onnx_model, path)
+    return args, reference
+
+
+class OnnxDenoiser(object):
+    """
+    onnxruntime runner for a graph written by `export_onnx`. Plugs into DDIMSampler(model, denoiser=...)
+    in place of the guided `model.apply_model` calls.
+    :param providers: onnxruntime execution providers, CPU by default.
+    :param num_threads: intra-op thread pool size, onnxruntime's default if None.
+    """
+
+    def __init__(self, path, providers=('CPUExecutionProvider',), num_threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, sess_options=options, providers=list(providers))
+        meta = json.loads(self.session.get_modelmeta().custom_metadata_map['unicontrol'])
+        self.task_name = meta['task']
+        self.parameterization = meta['parameterization']
+
+    def __call__(self, x, t, c, uc, guidance_scale, control_scales):
+        if isinstance(c['task'], (list, tuple)):
+            raise ValueError(f"multi-condition conditioning is not supported by the ONNX denoiser, it was exported "
+                             f"for the single task {self.task_name}")
+        if c['task']['name'] != self.task_name:
+            raise ValueError(f"the ONNX denoiser was exported for {self.task_name}, got {c['task']['name']}")
+        as_numpy = lambda tensor: tensor.detach().float().cpu().numpy()
+        inputs = {
+            'x': as_numpy(x),
+            'timesteps': t.detach().cpu().numpy().astype(np.int64),
+            'context': as_numpy(torch.cat(c['c_crossattn'], 1)),
+            'uncond_context': as_numpy(torch.cat(uc['c_crossattn'], 1)),
+            'hint': as_numpy(torch.cat(c['c_concat'], 1)),
+            'uncond_hint': as_numpy(torch.cat(uc['c_concat'], 1)),
+            'guidance_scale': np.array([guidance_scale], dtype=np.float32),
+            'control_scales': np.asarray([float(s) for s in control_scales], dtype=np.float32),
+        }
+        out, = self.session.run(['model_output'], inputs)
+        return torch.from_numpy(out).to(x.device, x.dtype)
@@ -23,18 +23,19 @@ from lib.util import (
     avg_pool_nd,
     zero_module,
     normalization,
+    fuse_norm_silu,
+    convert_module_to_dtype,
     timestep_embedding,
 )
 from lib.attention import SpatialTransformer
 from utils import exists
 
 
-# dummy replace
 def convert_module_to_f16(x):
-    pass
+    convert_module_to_dtype(x, th.float16)
 
 def convert_module_to_f32(x):
-    pass
+    convert_module_to_dtype(x, th.float32)
 
 
 ## go
@@ -283,6 +284,20 @@ class ResBlock(TimestepBlock):
             h = self.out_layers(h)
         return self.skip_connection(x) + h
 
+    def fuse_norm_act(self, check=True, device=None):
+        """
+        Replace the GroupNorm + SiLU pairs of this block with GroupNormSiLU.
+        Parameter names are unchanged, so state dicts load either way.
+        """
+        if not isinstance(self.in_layers[1], nn.SiLU):
+            return
+        self.in_layers[0] = fuse_norm_silu(self.in_layers[0], check=check, device=device)
+        self.in_layers[1] = nn.Identity()
+        if not self.use_scale_shift_norm:
+            # with scale/shift the norm output is modulated before the activation
+            self.out_layers[0] = fuse_norm_silu(self.out_layers[0], check=check, device=device)
+            self.out_layers[1] = nn.Identity()
+
 
 class AttentionBlock(nn.Module):
     """
@@ -744,22 +759,40 @@ class UNetModel(nn.Module):
             conv_nd(dims, model_channels, n_embed, 1),
             #nn.LogSoftmax(dim=1)  # change to cross_entropy and produce non-normalized logits
         )
+        if use_fp16:
+            self.convert_to_fp16()
+
+    def convert_to_dtype(self, dtype):
+        """
+        Convert the model to `dtype`. Normalization layers stay in float32 and
+        the output is returned in the dtype of the input.
+        """
+        self.apply(lambda l: convert_module_to_dtype(l, dtype))
+        self.dtype = dtype
 
     def convert_to_fp16(self):
         """
-        Convert the torso of the model to float16.
+        Convert the model to float16.
         """
-        self.input_blocks.apply(convert_module_to_f16)
-        self.middle_block.apply(convert_module_to_f16)
-        self.output_blocks.apply(convert_module_to_f16)
+        self.convert_to_dtype(th.float16)
 
     def convert_to_fp32(self):
         """
-        Convert the torso of the model to float32.
+        Convert the model to float32.
+        """
+        self.convert_to_dtype(th.float32)
+
+    def fuse_norm_act(self, check=True, device=None):
+        """
+        Fuse the GroupNorm + SiLU pairs of every ResBlock and of the output head.
+        Only meant for inference.
         """
-        self.input_blocks.apply(convert_module_to_f32)
-        self.middle_block.apply(convert_module_to_f32)
-        self.output_blocks.apply(convert_module_to_f32)
+        for module in self.modules():
+            if isinstance(module, ResBlock):
+                module.fuse_norm_act(check=check, device=device)
+        if isinstance(self.out[1], nn.SiLU):
+            self.out[0] = fuse_norm_silu(self.out[0], check=check, device=device)
+            self.out[1] = nn.Identity()
 
     def forward(self, x, timesteps=None, context=None, y=None,**kwargs):
         """
@@ -775,7 +808,7 @@ class UNetModel(nn.Module):
         ), "must specify y if and only if the model is class-conditional"
         hs = []
         t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-        emb = self.time_embed(t_emb)
+        emb = self.time_embed(t_emb.type(self.dtype))
 
         if self.num_classes is not None:
             assert y.shape[0] == x.shape[0]
@@ -789,8 +822,7 @@ class UNetModel(nn.Module):
         for module in self.output_blocks:
             h = th.cat([h, hs.pop()], dim=1)
             h = module(h, emb, context)
-        h = h.type(x.dtype)
         if self.predict_codebook_ids:
-            return self.id_predictor(h)
+            return self.id_predictor(h).type(x.dtype)
         else:
-            return self.out(h)
+            return self.out(h).type(x.dtype)
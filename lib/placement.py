@@ -0,0 +1,223 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+"""Plan where the ControlLDM submodules live under a device memory budget."""
+
+import weakref
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+from torch.utils._pytree import tree_flatten
+from torch.utils._python_dispatch import TorchDispatchMode
+
+
+# submodules the planner places, in the order they are demoted when the budget is exceeded
+DEMOTIONS = [
+    ("cond_stage_model", "cpu"),
+    ("first_stage_model.encoder", "offload"),
+    ("first_stage_model.decoder", "offload"),
+    ("control_model", "stream"),
+    ("model.diffusion_model", "stream"),
+]
+COMPONENTS = [name for name, _ in DEMOTIONS]
+
+# which submodules run in each phase of a request
+PHASES = {
+    "text": ["cond_stage_model"],
+    "encode": ["first_stage_model.encoder"],
+    "denoise": ["control_model", "model.diffusion_model"],
+    "decode": ["first_stage_model.decoder"],
+}
+
+
+def module_bytes(module):
+    tensors = {id(t): t for t in list(module.parameters()) + list(module.buffers())}
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+
+def stream_blocks(model, name):
+    """The blocks of a streamed diffusion model, in execution order."""
+    module = model.get_submodule(name)
+    blocks = list(module.input_blocks) + [module.middle_block]
+    if hasattr(module, "output_blocks"):
+        blocks += list(module.output_blocks)
+    return blocks
+
+
+class PeakMemory(TorchDispatchMode):
+    """Track the peak of live bytes allocated by the ops run under this mode (meta tensors included)."""
+
+    def __init__(self):
+        super().__init__()
+        self.live = 0
+        self.peak = 0
+
+    def _release(self, nbytes):
+        self.live -= nbytes
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        inputs = {id(t) for t in tree_flatten((args, kwargs))[0] if isinstance(t, torch.Tensor)}
+        for t in tree_flatten(out)[0]:
+            # views and in-place results do not allocate
+            if not isinstance(t, torch.Tensor) or id(t) in inputs or t._is_view():
+                continue
+            nbytes = t.numel() * t.element_size()
+            self.live += nbytes
+            self.peak = max(self.peak, self.live)
+            weakref.finalize(t, self._release, nbytes)
+        return out
+
+
+@contextmanager
+def meta_weights(module):
+    """Temporarily replace the parameters and buffers of `module` by meta tensors of the same shape."""
+    saved = []
+    for m in module.modules():
+        for name, p in m._parameters.items():
+            if p is not None:
+                saved.append((m._parameters, name, p))
+                m._parameters[name] = nn.Parameter(torch.empty_like(p, device="meta"), requires_grad=False)
+        for name, b in m._buffers.items():
+            if b is not None:
+                saved.append((m._buffers, name, b))
+                m._buffers[name] = torch.empty_like(b, device="meta")
+    try:
+        yield
+    finally:
+        for store, name, tensor in saved:
+            store[name] = tensor
+
+
+def measure_activation_bytes(module, fn):
+    """
+    Peak activation memory of `fn()` with the weights of `module` swapped for meta tensors, so nothing is
+    allocated or computed. Returns None if an op has no meta implementation (e.g. xformers kernels).
+    """
+    try:
+        with meta_weights(module), torch.no_grad(), PeakMemory() as tracker:
+            fn()
+    except (NotImplementedError, RuntimeError) as e:
+        print(f"placement: could not trace activations on meta ({type(e).__name__}: {e}), using an estimate")
+        return None
+    return tracker.peak
+
+
+def measure_footprints(model, resolution=512, num_samples=1, task="control_hedsketch", guidance=True):
+    """
+    Weight bytes of each planned submodule and activation peak of each phase at the given resolution and
+    batch. With classifier-free guidance the denoiser sees twice the batch (see DDIMSampler.p_sample_ddim).
+    """
+    diffusion_model = model.model.diffusion_model
+    attn2 = next(m for n, m in diffusion_model.named_modules() if n.endswith("attn2"))
+    context_dim = attn2.to_k.in_features
+    dtype = diffusion_model.dtype
+    H = W = resolution
+    b = num_samples * (2 if guidance else 1)
+    meta = dict(device="meta")
+
+    weights = {name: module_bytes(model.get_submodule(name)) for name in COMPONENTS}
+    blocks = {name: [module_bytes(block) for block in stream_blocks(model, name)]
+              for name in ("control_model", "model.diffusion_model")}
+
+    def denoise():
+        x = torch.empty(b, model.channels, H // 8, W // 8, **meta)
+        t = torch.zeros(b, dtype=torch.long, **meta)
+        cond = {"c_crossattn": [torch.empty(b, 77, context_dim, dtype=dtype, **meta)],
+                "c_concat": [torch.empty(b, 3, H, W, **meta)],
+                "task": {"name": task, "feature": torch.empty(1, 1, context_dim, **meta)}}
+        model.apply_model(x, t, cond)
+
+    def decode():
+        model.first_stage_model.decode(torch.empty(num_samples, 4, H // 8, W // 8, dtype=dtype, **meta))
+
+    def encode():
+        model.first_stage_model.encode(torch.empty(num_samples, 3, H, W, dtype=dtype, **meta))
+
+    def text():
+        model.cond_stage_model.transformer(input_ids=torch.zeros(2 * num_samples + 1, 77, dtype=torch.long, **meta))
+
+    element = torch.finfo(dtype).bits // 8
+    fallback = {
+        # the self-attention matrix at the highest resolution dominates the denoiser
+        "denoise": 3 * b * 8 * (H * W // 64) ** 2 * 4,
+        "decode": 4 * num_samples * 128 * H * W * element,
+        "encode": 4 * num_samples * 128 * H * W * element,
+        "text": 0,
+    }
+    fns = {"denoise": (model, denoise), "decode": (model.first_stage_model, decode),
+           "encode": (model.first_stage_model, encode), "text": (model.cond_stage_model, text)}
+    activations = {}
+    for phase, (module, fn) in fns.items():
+        measured = measure_activation_bytes(module, fn)
+        activations[phase] = fallback[phase] if measured is None else measured
+    return weights, blocks, activations
+
+
+def window_bytes(sizes, window):
+    """Largest total size of `window` consecutive blocks of a repeating cycle."""
+    n = len(sizes)
+    return max(sum(sizes[(i + k) % n] for k in range(window)) for i in range(n))
+
+
+def phase_peaks(placement, window, weights, blocks, activations):
+    resident = sum(weights[name] for name, where in placement.items() if where == "resident")
+    # embeddings, hint blocks and zero convs of a streamed model stay resident
+    resident += sum(weights[name] - sum(blocks[name]) for name in blocks if placement[name] == "stream")
+    cycle = [size for name in ("control_model", "model.diffusion_model") if placement[name] == "stream"
+             for size in blocks[name]]
+    streamed = window_bytes(cycle, min(window, len(cycle))) if cycle else 0
+    peaks = {}
+    for phase, names in PHASES.items():
+        loaded = sum(weights[name] for name in names if placement[name] == "offload")
+        on_device = any(placement[name] != "cpu" for name in names)
+        peaks[phase] = resident + loaded + (activations[phase] if on_device else 0)
+        if phase == "denoise":
+            peaks[phase] += streamed
+    return peaks
+
+
+def plan_placement(model, budget_bytes, resolution=512, num_samples=1, headroom=0.1, **kwargs):
+    """
+    Choose, for each submodule of a ControlLDM, whether it stays resident on the device, is offloaded to host
+    memory and loaded while it runs ("offload", text encoder / VAE), is streamed block by block ("stream",
+    ControlNet / UNet), or runs on the CPU ("cpu", text encoder). Submodules are demoted in the order of
+    DEMOTIONS until the peak of every phase fits in the budget; the streaming window is the largest that fits.
+    :param budget_bytes: device memory available to the model.
+    :param headroom: fraction of the budget kept free for the allocator and CUDA context.
+    :return: dict with the placement, streaming window, and the measured footprints.
+    """
+    weights, blocks, activations = measure_footprints(model, resolution, num_samples, **kwargs)
+    budget = int(budget_bytes * (1 - headroom))
+    placement = {name: "resident" for name in COMPONENTS}
+    max_window = sum(len(b) for b in blocks.values())
+    for step in [None] + DEMOTIONS:
+        if step is not None:
+            placement[step[0]] = step[1]
+        for window in range(max_window, 0, -1):
+            peaks = phase_peaks(placement, window, weights, blocks, activations)
+            if max(peaks.values()) <= budget:
+                return dict(placement=placement, window=window, peaks=peaks, budget=budget,
+                            weights=weights, activations=activations)
+            if "stream" not in placement.values():
+                break
+    raise RuntimeError(f"the model does not fit in {budget_bytes / 2 ** 30:.2f} GiB even when fully streamed "
+                       f"(peak {max(peaks.values()) / 2 ** 30:.2f} GiB at window 1)")
+
+
+def format_plan(plan):
+    gib = lambda n: f"{n / 2 ** 30:.2f} GiB"
+    lines = [f"placement plan (budget {gib(plan['budget'])}, streaming window {plan['window']}):"]
+    for name in COMPONENTS:
+        lines.append(f"  {name:28s} {plan['placement'][name]:9s} weights {gib(plan['weights'][name])}")
+    for phase, peak in plan["peaks"].items():
+        lines.append(f"  peak during {phase:8s} {gib(peak)} (activations {gib(plan['activations'][phase])})")
+    return "\n".join(lines)
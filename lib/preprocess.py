@@ -0,0 +1,45 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from annotator.util import HWC3, resize_shape
+
+
+def prepare_hint(image, num_samples, device, invert=False, resolution=None):
+    """
+    Turn a uint8 [H, W, C] hint image into the [num_samples, 3, H, W] float hint in [0, 1] the
+    ControlNet expects. The uint8 image is uploaded once; inversion, scaling and layout run on the
+    device, and the batch is a broadcast view of a single hint instead of `num_samples` copies.
+    :param invert: use 255 - image (e.g. a sketch drawn dark on white).
+    :param resolution: resize so the shorter side is `resolution`, with the sizes of annotator.util.resize_image;
+                       if None, only round both sides to multiples of 64.
+    """
+    image = HWC3(np.asarray(image))
+    H, W = image.shape[:2]
+    H_out, W_out, k = resize_shape(H, W, resolution if resolution is not None else min(H, W))
+    hint = torch.from_numpy(np.ascontiguousarray(image)).to(device, non_blocking=True)
+    hint = hint.permute(2, 0, 1)[None].float()
+    if invert:
+        hint = 255.0 - hint
+    if (H_out, W_out) != (H, W):
+        if k > 1:
+            hint = F.interpolate(hint, size=(H_out, W_out), mode='bicubic', align_corners=False, antialias=True)
+        else:
+            hint = F.interpolate(hint, size=(H_out, W_out), mode='area')
+    hint = (hint / 255.0).clamp_(0, 1)
+    return hint.expand(num_samples, -1, -1, -1)
+
+
+def zero_hint(hint):
+    """An all-zero hint shaped like `hint` (guess mode's unconditional hint), without allocating it."""
+    return hint.new_zeros(()).expand_as(hint)
@@ -0,0 +1,185 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+from functools import partial
+
+import torch
+import torch.nn as nn
+
+from lib.attention import CrossAttention, MemoryEfficientCrossAttention, FeedForward, GEGLU
+from lib.openaimodel import ResBlock
+
+
+# Structured pruning of the ControlNet trunk. The width of the residual stream is left alone, so the
+# zero conv shapes still match the UNet; what is pruned is internal to each block:
+#   ResBlock       - hidden channels between the two convs, in whole GroupNorm groups so the
+#                    statistics of the kept groups are unchanged,
+#   attention      - heads of the self / cross attention layers,
+#   FeedForward    - channels of the (GEGLU) hidden layer.
+# A pruned model is described by `widths`, module name -> number of kept groups / heads / channels,
+# which ControlNet(pruned_widths=...) applies at construction so the checkpoint loads as usual.
+
+ATTENTION = (CrossAttention, MemoryEfficientCrossAttention)
+
+
+def prunable_modules(control_model):
+    """Yield (name, module) for the ResBlocks, attention layers and feed-forwards of the ControlNet trunk."""
+    for name, module in control_model.named_modules():
+        if name.startswith(('input_blocks.', 'middle_block.')) and isinstance(module, (ResBlock, FeedForward) + ATTENTION):
+            yield name, module
+
+
+def module_units(module):
+    """:return: (number of prunable units, channels per unit) of a prunable module."""
+    if isinstance(module, ResBlock):
+        norm = module.out_layers[0]
+        return norm.num_groups, norm.num_channels // norm.num_groups
+    if isinstance(module, ATTENTION):
+        return module.heads, module.to_q.out_features // module.heads
+    return module.net[2].in_features, 1
+
+
+def get_widths(control_model):
+    return {name: module_units(module)[0] for name, module in prunable_modules(control_model)}
+
+
+def _unit_channels(units, size):
+    return (units[:, None] * size + torch.arange(size, device=units.device)).reshape(-1)
+
+
+def _select(layer, out_idx=None, in_idx=None):
+    """A new Linear / Conv2d with only output channels `out_idx` and input channels `in_idx` of `layer`."""
+    weight, bias = layer.weight, layer.bias
+    if out_idx is not None:
+        weight = weight[out_idx.to(weight.device)]
+        bias = bias[out_idx.to(bias.device)] if bias is not None else None
+    if in_idx is not None:
+        weight = weight[:, in_idx.to(weight.device)]
+    kwargs = dict(bias=bias is not None, device=weight.device, dtype=weight.dtype)
+    if isinstance(layer, nn.Linear):
+        new = nn.Linear(weight.shape[1], weight.shape[0], **kwargs)
+    elif isinstance(layer, nn.Conv2d):
+        new = nn.Conv2d(weight.shape[1], weight.shape[0], layer.kernel_size, layer.stride, layer.padding, **kwargs)
+    else:
+        raise TypeError(f'cannot prune {type(layer).__name__}')
+    with torch.no_grad():
+        new.weight.copy_(weight)
+        if bias is not None:
+            new.bias.copy_(bias)
+    new.requires_grad_(layer.weight.requires_grad)
+    return new
+
+
+def _select_norm(norm, groups):
+    size = norm.num_channels // norm.num_groups
+    idx = _unit_channels(groups, size).to(norm.weight.device)
+    new = type(norm)(len(groups), len(idx), eps=norm.eps, affine=norm.affine,
+                     device=norm.weight.device, dtype=norm.weight.dtype)
+    with torch.no_grad():
+        new.weight.copy_(norm.weight[idx])
+        new.bias.copy_(norm.bias[idx])
+    new.requires_grad_(norm.weight.requires_grad)
+    return new
+
+
+def prune_module(module, keep):
+    """
+    Keep only units `keep` (indices of GroupNorm groups / heads / hidden channels) of a prunable module,
+    in place. The module's input and output shapes do not change.
+    """
+    keep = torch.as_tensor(keep, dtype=torch.long).sort().values
+    if isinstance(module, ResBlock):
+        groups, size = module_units(module)
+        idx = _unit_channels(keep, size)
+        hidden = groups * size
+        module.in_layers[-1] = _select(module.in_layers[-1], out_idx=idx)
+        emb_idx = torch.cat([idx, idx + hidden]) if module.use_scale_shift_norm else idx
+        module.emb_layers[-1] = _select(module.emb_layers[-1], out_idx=emb_idx)
+        module.out_layers[0] = _select_norm(module.out_layers[0], keep)
+        module.out_layers[-1] = _select(module.out_layers[-1], in_idx=idx)
+    elif isinstance(module, ATTENTION):
+        _, dim_head = module_units(module)
+        idx = _unit_channels(keep, dim_head)
+        module.to_q = _select(module.to_q, out_idx=idx)
+        module.to_k = _select(module.to_k, out_idx=idx)
+        module.to_v = _select(module.to_v, out_idx=idx)
+        module.to_out[0] = _select(module.to_out[0], in_idx=idx)
+        module.heads = len(keep)
+    elif isinstance(module, FeedForward):
+        inner, _ = module_units(module)
+        project_in = module.net[0]
+        if isinstance(project_in, GEGLU):
+            project_in.proj = _select(project_in.proj, out_idx=torch.cat([keep, keep + inner]))
+        else:
+            project_in[0] = _select(project_in[0], out_idx=keep)
+        module.net[2] = _select(module.net[2], in_idx=keep)
+    else:
+        raise TypeError(f'cannot prune {type(module).__name__}')
+
+
+def apply_widths(control_model, widths):
+    """Shrink the modules of a freshly built ControlNet to `widths` (see get_widths); weights are loaded after."""
+    for name, width in widths.items():
+        module = control_model.get_submodule(name)
+        if width < module_units(module)[0]:
+            prune_module(module, torch.arange(width))
+
+
+class UnitScorer(object):
+    """
+    First-order (Taylor) importance of every prunable unit of a ControlNet for its zero conv outputs.
+    Run forward passes of the ControlNet with gradients enabled, call backward on
+    `output_energy(outs)`; for each unit the score accumulates, per sample, the square of
+    sum(activation * gradient) over the unit's channels and positions, i.e. the squared first-order
+    change of the zero conv output energy when the unit is removed.
+    """
+
+    def __init__(self, control_model):
+        self.scores = {}
+        self.handles = []
+        for name, module in prunable_modules(control_model):
+            if isinstance(module, ResBlock):
+                target = module.out_layers
+            elif isinstance(module, ATTENTION):
+                target = module.to_out
+            else:
+                target = module.net[2]
+            self.handles.append(target.register_forward_pre_hook(partial(self._capture, name, module_units(module))))
+
+    @staticmethod
+    def output_energy(outs, scales=None):
+        scales = scales or [1.0] * len(outs)
+        return sum(0.5 * (out.float() * scale).pow(2).sum() for out, scale in zip(outs, scales))
+
+    def _capture(self, name, units, _, inputs):
+        activation = inputs[0]
+        if not activation.requires_grad:
+            return
+
+        def accumulate(grad):
+            contribution = (activation.detach() * grad).float()
+            # [B, C, H, W] (ResBlock) or [B, N, C] (attention / feed-forward) -> [B, C]
+            contribution = contribution.sum((2, 3)) if contribution.dim() == 4 else contribution.sum(1)
+            contribution = contribution.reshape(contribution.shape[0], *units).sum(-1)
+            self.scores[name] = self.scores.get(name, 0) + contribution.pow(2).sum(0).cpu()
+        activation.register_hook(accumulate)
+
+    def select(self, keep_ratio):
+        """:return: module name -> indices of the `keep_ratio` highest scoring units (at least one)."""
+        keep = {}
+        for name, scores in self.scores.items():
+            k = max(1, int(round(len(scores) * keep_ratio)))
+            keep[name] = scores.topk(k).indices.sort().values
+        return keep
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
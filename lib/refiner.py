@@ -0,0 +1,54 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+class RefinerStage(object):
+    """
+    The SDXL img2img refiner as a stage of its own: the pipeline is loaded on first use, all samples of a
+    request are refined in one batched call, and calls run on a single worker thread, so the base model
+    can take the next request while the previous one is being refined.
+    """
+
+    def __init__(self, device, model_id="stabilityai/stable-diffusion-xl-refiner-1.0"):
+        self.device = torch.device(device)
+        self.model_id = model_id
+        self.pipeline = None
+        self.load_lock = threading.Lock()
+        self.worker = ThreadPoolExecutor(1, thread_name_prefix='refiner')
+
+    def load(self):
+        with self.load_lock:
+            if self.pipeline is None:
+                from diffusers import StableDiffusionXLImg2ImgPipeline
+                self.pipeline = StableDiffusionXLImg2ImgPipeline.from_pretrained(
+                    self.model_id, torch_dtype=torch.float16 if self.device.type == "cuda" else torch.float32)
+                self.pipeline.to(self.device)
+        return self.pipeline
+
+    def _refine(self, images, prompt, seed):
+        pipeline = self.load()
+        generators = [torch.Generator(self.device).manual_seed(seed + i) for i in range(len(images))]
+        refined = pipeline(prompt=[prompt] * len(images), image=[Image.fromarray(image) for image in images],
+                           generator=generators).images
+        return [np.asarray(image.convert("RGB")) for image in refined]
+
+    def submit(self, images, prompt, seed):
+        """
+        Queue the refinement of uint8 [H, W, 3] `images`.
+        :return: a Future of the refined uint8 images.
+        """
+        return self.worker.submit(self._refine, list(images), prompt, seed)
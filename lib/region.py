@@ -0,0 +1,72 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+import torch
+import torch.nn.functional as F
+
+
+def region_box(hole, margin, multiple=8):
+    """
+    Latent box around the True entries of `hole` ([h, w] bool), grown by `margin` latents on each side and
+    to sides that are multiples of `multiple` (what the UNet needs), shifted to stay inside the latent.
+    :return: (top, bottom, left, right), or None if `hole` is empty.
+    """
+    rows = hole.any(1).nonzero().flatten()
+    cols = hole.any(0).nonzero().flatten()
+    if len(rows) == 0:
+        return None
+
+    def span(lo, hi, size):
+        lo, hi = max(0, lo - margin), min(size, hi + margin)
+        length = min(size, -(-(hi - lo) // multiple) * multiple)
+        lo = min(lo, size - length)
+        return lo, lo + length
+    top, bottom = span(int(rows[0]), int(rows[-1]) + 1, hole.shape[0])
+    left, right = span(int(cols[0]), int(cols[-1]) + 1, hole.shape[1])
+    return top, bottom, left, right
+
+
+def _crop(cond, top, bottom, left, right):
+    if cond is None:
+        return None
+    return {**cond, 'c_concat': [hint[:, :, top * 8:bottom * 8, left * 8:right * 8] for hint in cond['c_concat']]}
+
+
+@torch.no_grad()
+def crop_sample(sampler, hint, hole, cond, uncond, ddim_steps, margin=64, **kwargs):
+    """
+    Inpainting / outpainting that only denoises the region to fill: the bounding box of `hole` plus `margin`
+    pixels of context is sampled with the matching hint crop, the known pixels around the hole are kept
+    through DDIM's mask / x0 blending, and the result is pasted into the latent of the known image.
+    Small holes in large images cost in proportion to the box, not the canvas.
+    :param sampler: DDIMSampler (lib.ddim_hacked) of the ControlLDM.
+    :param hint: [B, 3, H, W] hint in [0, 1]; outside `hole` its pixels are the known image.
+    :param hole: [H, W] bool, True where content is generated.
+    :param kwargs: passed on to sampler.sample (eta, unconditional_guidance_scale, ...).
+    :return: [B, 4, H / 8, W / 8] latents for decode_first_stage.
+    """
+    model = sampler.model
+    batch_size = hint.shape[0]
+    # the posterior mode, not a sample: the kept context is the same on every run
+    x0 = model.scale_factor * model.encode_first_stage(hint[:1] * 2.0 - 1.0).mode()
+    x0 = x0.expand(batch_size, -1, -1, -1)
+    hole = torch.as_tensor(hole, device=hint.device)[None, None].float()
+    hole = F.max_pool2d(hole, 8)[0, 0] > 0
+    box = region_box(hole, margin // 8)
+    if box is None:
+        return x0.clone()
+    top, bottom, left, right = box
+    keep = (~hole[top:bottom, left:right]).float()[None, None].expand(batch_size, 1, -1, -1)
+    samples, _ = sampler.sample(ddim_steps, batch_size, (model.channels, bottom - top, right - left),
+                                _crop(cond, *box), verbose=False, mask=keep, x0=x0[:, :, top:bottom, left:right],
+                                unconditional_conditioning=_crop(uncond, *box), **kwargs)
+    out = x0.clone()
+    out[:, :, top:bottom, left:right] = samples
+    return out
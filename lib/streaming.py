@@ -0,0 +1,144 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+from contextlib import nullcontext
+from functools import partial
+
+import torch
+
+
+class WeightStreamer(object):
+    """
+    Keep the weights of a list of blocks in host memory and stream them to the
+    compute device just before each block runs.
+
+    `cycle` blocks run in a fixed, repeating order (one denoiser step). When block
+    i starts, blocks i .. i + window - 1 are kept resident: the following ones are
+    prefetched on a copy stream and everything behind is evicted. `on_demand`
+    blocks (text encoder, VAE) are loaded when called and evicted right after.
+
+    :param device: the compute device.
+    :param cycle: blocks in execution order.
+    :param on_demand: blocks that run outside the cycle.
+    :param window: number of cycle blocks resident at once.
+    :param pin_memory: keep the host copies in pinned memory for asynchronous
+                       copies. Otherwise the existing host tensors are used as is
+                       (e.g. memory-mapped checkpoint tensors).
+    """
+
+    def __init__(self, device, cycle, on_demand=(), window=4, pin_memory=True):
+        self.device = torch.device(device)
+        self.blocks = list(cycle) + list(on_demand)
+        self.num_cycle = len(cycle)
+        self.window = max(1, min(window, self.num_cycle))
+        pin_memory = pin_memory and self.device.type == 'cuda'
+        self.copy_stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.host = [self._offload(block, pin_memory) for block in self.blocks]
+        self.loaded = {}  # block index -> copy event (None once the compute stream waited on it)
+        self.handles = []
+        for i, block in enumerate(self.blocks):
+            if i < self.num_cycle:
+                self.handles.append(block.register_forward_pre_hook(partial(self._pre_cycle, i)))
+            else:
+                self.handles.append(block.register_forward_pre_hook(partial(self._pre_on_demand, i)))
+                self.handles.append(block.register_forward_hook(partial(self._post_on_demand, i)))
+
+    @staticmethod
+    def _offload(block, pin_memory):
+        entries, seen = [], set()
+        for module in block.modules():
+            for name, p in module._parameters.items():
+                if p is None or id(p) in seen:
+                    continue
+                seen.add(id(p))
+                p.data = WeightStreamer._to_host(p.data, pin_memory)
+                entries.append((p, None, None, p.data))
+            for name, b in module._buffers.items():
+                if b is None:
+                    continue
+                host = WeightStreamer._to_host(b, pin_memory)
+                module._buffers[name] = host
+                entries.append((None, module, name, host))
+        return entries
+
+    @staticmethod
+    def _to_host(tensor, pin_memory):
+        tensor = tensor.cpu()
+        if pin_memory and not tensor.is_pinned():
+            tensor = torch.empty_like(tensor, pin_memory=True).copy_(tensor)
+        return tensor
+
+    @staticmethod
+    def _assign(entry, tensor):
+        param, module, name, _ = entry
+        if param is not None:
+            param.data = tensor
+        else:
+            module._buffers[name] = tensor
+
+    def _device_tensor(self, entry):
+        param, module, name, _ = entry
+        return param.data if param is not None else module._buffers[name]
+
+    def _load(self, i):
+        if i in self.loaded:
+            return
+        context = torch.cuda.stream(self.copy_stream) if self.copy_stream is not None else nullcontext()
+        with context:
+            for entry in self.host[i]:
+                self._assign(entry, entry[3].to(self.device, non_blocking=True))
+            event = None
+            if self.copy_stream is not None:
+                event = torch.cuda.Event()
+                event.record(self.copy_stream)
+        self.loaded[i] = event
+
+    def _wait(self, i):
+        event = self.loaded[i]
+        if event is None:
+            return
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(event)
+        # the weights were allocated on the copy stream but are used here
+        for entry in self.host[i]:
+            self._device_tensor(entry).record_stream(stream)
+        self.loaded[i] = None
+
+    def _evict(self, i):
+        for entry in self.host[i]:
+            self._assign(entry, entry[3])
+        del self.loaded[i]
+
+    def _pre_cycle(self, i, module, args):
+        keep = [(i + k) % self.num_cycle for k in range(self.window)]
+        for j in [j for j in self.loaded if j < self.num_cycle and j not in keep]:
+            self._evict(j)
+        self._load(i)
+        self._wait(i)
+        for j in keep[1:]:
+            self._load(j)
+
+    def _pre_on_demand(self, i, module, args):
+        self._load(i)
+        self._wait(i)
+
+    def _post_on_demand(self, i, module, args, output):
+        self._evict(i)
+
+    def resident_bytes(self):
+        return sum(entry[3].numel() * entry[3].element_size() for i in self.loaded for entry in self.host[i])
+
+    def remove(self):
+        """Unregister the hooks and put every streamed block back on the host."""
+        for handle in self.handles:
+            handle.remove()
+        for i in list(self.loaded):
+            self._evict(i)
+        self.handles = []
@@ -0,0 +1,145 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+import hashlib
+
+import torch
+import torch.nn as nn
+
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+from utils import load_state_dict
+
+
+def tensor_hash(tensor):
+    """Content hash of a tensor: dtype, shape and raw bytes."""
+    tensor = tensor.detach().cpu().contiguous()
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{tensor.dtype}{tuple(tensor.shape)}'.encode())
+    h.update(tensor.reshape(-1).view(torch.uint8).numpy().data)
+    return h.hexdigest()
+
+
+class TensorStore(object):
+    """
+    Content-addressed store for the weights of several checkpoints of the same architecture
+    (e.g. UniControl v1.0 / v1.1 and fine-tunes). Identical tensors are kept once and shared
+    by every variant, only differing tensors are materialized per variant.
+
+    `bind(model, name)` points the parameters and buffers of a model at the tensors of a
+    variant, so switching variants per request is a pointer swap and not a reload. Tensors are
+    converted to the model's dtype / device / memory format once and the result is cached.
+    Bound tensors are shared between variants: do not modify them in place.
+    Not available with weight streaming or int8 quantization.
+    """
+
+    def __init__(self):
+        self.tensors = {}   # hash -> tensor as loaded, or the adopted model's own tensor
+        self.variants = {}  # variant name -> {state dict key: hash}
+        self.bound = {}     # (hash, dtype, device, memory format, is parameter) -> converted tensor / Parameter
+        self.current = {}   # id(model) -> bound variant name
+
+    def add(self, name, state_dict, base=None):
+        """
+        Register a state dict as variant `name`. Keys missing from it are taken from variant `base`.
+        :return: the number of tensors that were new to the store.
+        """
+        keys = dict(self.variants[base]) if base is not None else {}
+        new = 0
+        for key, tensor in state_dict.items():
+            digest = tensor_hash(tensor)
+            if digest not in self.tensors:
+                self.tensors[digest] = tensor.detach()
+                new += 1
+            keys[key] = digest
+        self.variants[name] = keys
+        print(f'TensorStore: variant [{name}] has {len(keys)} tensors, {new} new '
+              f'({self.nbytes() / 2 ** 30:.2f} GiB unique in store)')
+        return new
+
+    def add_checkpoint(self, name, ckpt_path, base=None):
+        return self.add(name, load_state_dict(ckpt_path), base=base)
+
+    @staticmethod
+    def _check_model(model):
+        if getattr(model, 'weight_streamer', None) is not None:
+            raise RuntimeError('variants cannot be swapped on a model with weight streaming enabled')
+        quantized = [name for name, module in model.named_modules() if isinstance(module, DynamicQuantizedLinear)]
+        if quantized:
+            raise RuntimeError(f'variants cannot be swapped on a model with int8 quantized linears '
+                               f'({len(quantized)}, e.g. {quantized[0]}), their packed weights are not checkpoint tensors')
+
+    def adopt(self, model, name):
+        """
+        Declare that `model` currently holds variant `name` (loaded from the same checkpoint and already
+        converted / placed), so its tensors are reused for that variant instead of being converted again.
+        The store keeps the model's tensors in place of the checkpoint copies, so the variant costs no
+        host memory beyond the model itself.
+        Keys the checkpoint did not provide (e.g. buffers rebuilt from the config) are added from the model.
+        """
+        self._check_model(model)
+        keys = self.variants[name]
+        for key, tensor in model.state_dict(keep_vars=True).items():
+            if key not in keys:
+                keys[key] = tensor_hash(tensor)
+            self.tensors[keys[key]] = tensor.detach()
+            self.bound[self._bound_key(keys[key], tensor)] = tensor
+        self.current[id(model)] = name
+        return model
+
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.tensors.values())
+
+    @staticmethod
+    def _memory_format(tensor):
+        if tensor.dim() == 4 and not tensor.is_contiguous() and tensor.is_contiguous(memory_format=torch.channels_last):
+            return torch.channels_last
+        return torch.contiguous_format
+
+    def _bound_key(self, digest, like):
+        return digest, like.dtype, like.device, self._memory_format(like), isinstance(like, nn.Parameter)
+
+    def _get_bound(self, digest, like):
+        key = self._bound_key(digest, like)
+        if key not in self.bound:
+            tensor = self.tensors[digest]
+            if tensor.is_floating_point():
+                tensor = tensor.to(like.dtype)
+            tensor = tensor.to(like.device).contiguous(memory_format=key[3])
+            if isinstance(like, nn.Parameter):
+                tensor = nn.Parameter(tensor, requires_grad=False)
+            self.bound[key] = tensor
+        return self.bound[key]
+
+    def bind(self, model, name):
+        """Point the parameters and buffers of `model` at the tensors of variant `name`."""
+        if self.current.get(id(model)) == name:
+            return model
+        self._check_model(model)
+        keys = self.variants[name]
+        current = model.state_dict(keep_vars=True)
+        missing = [key for key in current if key not in keys]
+        if missing:
+            raise ValueError(f'variant [{name}] has no tensor for {len(missing)} keys, e.g. {missing[:5]}')
+        for key, like in current.items():
+            digest = keys[key]
+            if tuple(self.tensors[digest].shape) != tuple(like.shape):
+                raise ValueError(f'variant [{name}]: shape mismatch for {key}, '
+                                 f'{tuple(self.tensors[digest].shape)} vs {tuple(like.shape)}')
+        for key, like in current.items():
+            module_name, _, attr = key.rpartition('.')
+            module = model.get_submodule(module_name)
+            tensor = self._get_bound(keys[key], like)
+            if attr in module._parameters:
+                module._parameters[attr] = tensor
+            else:
+                module._buffers[attr] = tensor
+        self.current[id(model)] = name
+        return model
@@ -0,0 +1,47 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+import torch
+import torch.nn.functional as F
+
+
+REFINE_MODES = ('none', 'latent_upscale', 'sdxl')
+
+
+def _resize_hint(cond, size):
+    if cond is None or cond.get('c_concat') is None:
+        return cond
+    return {**cond, 'c_concat': [F.interpolate(hint, size=size, mode='bilinear', align_corners=False)
+                                 for hint in cond['c_concat']]}
+
+
+@torch.no_grad()
+def latent_upscale(sampler, samples, cond, uncond=None, factor=1.5, strength=0.5, ddim_steps=20, guidance_scale=9.0):
+    """
+    Upscale the DDIM samples of a ControlLDM in latent space and re-denoise them part of the way with the same
+    model and the hint resized to match: no second model, and no VAE decode / encode between the two passes.
+    :param sampler: the DDIMSampler (lib.ddim_hacked) of the ControlLDM that produced `samples`.
+    :param factor: scale of the output, each side rounded to a multiple of 64 pixels.
+    :param strength: fraction of the `ddim_steps` schedule that is re-run, 0 keeps the interpolated latent.
+    :return: the upscaled latents, to be decoded with decode_first_stage.
+    """
+    h, w = samples.shape[2:]
+    size = (max(8, int(round(h * factor / 8)) * 8), max(8, int(round(w * factor / 8)) * 8))
+    z = F.interpolate(samples, size=size, mode='bicubic', align_corners=False)
+    t_enc = int(strength * ddim_steps)
+    if t_enc == 0:
+        return z
+    cond = _resize_hint(cond, (size[0] * 8, size[1] * 8))
+    uncond = _resize_hint(uncond, (size[0] * 8, size[1] * 8))
+    sampler.make_schedule(ddim_steps, ddim_eta=0.0, verbose=False)
+    t = torch.full((z.shape[0],), t_enc - 1, device=z.device, dtype=torch.long)
+    z = sampler.stochastic_encode(z, t)
+    return sampler.decode(z, cond, t_enc, unconditional_guidance_scale=guidance_scale,
+                          unconditional_conditioning=uncond)
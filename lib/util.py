@@ -22,6 +22,7 @@ import os
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 from einops import repeat
 
@@ -228,6 +229,126 @@ class GroupNorm32(nn.GroupNorm):
     def forward(self, x):
         return super().forward(x.float()).type(x.dtype)
 
+
+class LayerNorm32(nn.LayerNorm):
+    def forward(self, x):
+        return super().forward(x.float()).type(x.dtype)
+
+
+def convert_module_to_dtype(l, dtype):
+    """
+    Cast the parameters of a single module to `dtype`, keeping normalization
+    layers in float32. Meant to be used with `module.apply`.
+    """
+    if isinstance(l, (nn.GroupNorm, nn.LayerNorm)):
+        l.float()
+    elif isinstance(l, (nn.Conv1d, nn.Conv2d, nn.Conv3d, nn.Linear)):
+        l.to(dtype)
+
+
+def _group_norm_silu(x, num_groups, weight, bias, eps):
+    h = F.group_norm(x.float(), num_groups, weight, bias, eps)
+    return F.silu(h).to(x.dtype)
+
+
+try:
+    from torch._dynamo.exc import BackendCompilerFailed
+except ImportError:  # torch < 2.0, no torch.compile
+    BackendCompilerFailed = None
+
+_group_norm_silu_compiled = None
+_group_norm_silu_eager = set()  # device types the fused kernel failed to build for
+
+
+def group_norm_silu(x, num_groups, weight=None, bias=None, eps=1e-5):
+    """
+    silu(group_norm(x)) computed in float32 and returned in the dtype of x, as a single torch.compile'd
+    function: inductor turns it into one reduction for the group statistics and one elementwise pass that
+    normalizes, applies the affine and the SiLU and casts back, with no float32 copy of x or of the
+    normalized tensor written to memory. Runs the eager ops without torch.compile, and on the device
+    types the kernel fails to build for (e.g. no C++ compiler for CPU, no triton for CUDA).
+    """
+    global _group_norm_silu_compiled
+    if BackendCompilerFailed is not None and x.device.type not in _group_norm_silu_eager:
+        if _group_norm_silu_compiled is None:
+            _group_norm_silu_compiled = torch.compile(_group_norm_silu, dynamic=True)
+        try:
+            return _group_norm_silu_compiled(x, num_groups, weight, bias, eps)
+        except BackendCompilerFailed as e:
+            print(f"fused GroupNorm+SiLU unavailable on {x.device.type} ({e}), using the eager ops")
+            _group_norm_silu_eager.add(x.device.type)
+    return _group_norm_silu(x, num_groups, weight, bias, eps)
+
+
+class GroupNormSiLU(nn.GroupNorm):
+    """
+    GroupNorm followed by SiLU, run as the fused group_norm_silu kernel.
+    """
+    def forward(self, x):
+        return group_norm_silu(x, self.num_groups, self.weight, self.bias, self.eps)
+
+
+# (dtype, atol): fp16 / bf16 outputs of the fused kernel and of GroupNorm32 + SiLU differ by their rounding
+FUSE_CHECK_DTYPES = ((torch.float32, 1e-4), (torch.float16, 4e-3), (torch.bfloat16, 3e-2))
+_fuse_checked = set()
+
+
+def check_norm_silu(norm, device=None, size=64):
+    """
+    Compare group_norm_silu against norm + SiLU on a random [1, C, size, size] input (the latent size of a
+    512x512 image) in float32, float16 and bfloat16, and raise if they disagree. Run once per norm
+    configuration and device.
+    :param device: device the model runs on, defaults to the one of the norm parameters.
+    """
+    if device is None:
+        param = next(norm.parameters(), None)
+        device = param.device if param is not None else 'cpu'
+    device = torch.device(device)
+    key = (norm.num_groups, norm.num_channels, norm.eps, norm.affine, device, size)
+    if device.type == 'meta' or key in _fuse_checked:
+        return
+    weight, bias = (None, None) if not norm.affine else (norm.weight.to(device), norm.bias.to(device))
+    with torch.no_grad():
+        x = torch.randn(1, norm.num_channels, size, size, device=device)
+        for dtype, atol in FUSE_CHECK_DTYPES:
+            ref = F.silu(F.group_norm(x.to(dtype).float(), norm.num_groups, weight, bias, norm.eps))
+            out = group_norm_silu(x.to(dtype), norm.num_groups, weight, bias, norm.eps)
+            if out.dtype != dtype or not torch.allclose(ref, out.float(), atol=atol, rtol=atol):
+                raise RuntimeError(f"fused GroupNorm+SiLU mismatch in {dtype} on {device}: "
+                                   f"max abs err {(ref - out.float()).abs().max().item()}")
+    _fuse_checked.add(key)
+
+
+def fuse_norm_silu(norm, check=True, device=None):
+    """
+    Build a GroupNormSiLU sharing the parameters of an existing GroupNorm.
+    :param norm: the nn.GroupNorm (or GroupNorm32) being replaced.
+    :param check: if True, compare the fused module against norm + SiLU (check_norm_silu) and raise if
+                  they disagree.
+    :param device: device the check runs on, defaults to the one of the norm parameters.
+    :return: the fused module.
+    """
+    fused = GroupNormSiLU(norm.num_groups, norm.num_channels, eps=norm.eps, affine=norm.affine)
+    fused.weight, fused.bias = norm.weight, norm.bias
+    if check:
+        check_norm_silu(norm, device=device)
+    return fused
+
+
+def to_channels_last(x):
+    """
+    Convert 4-D tensors to channels-last, recursing into the lists and dicts
+    used for conditioning. Everything else is returned unchanged.
+    """
+    if isinstance(x, torch.Tensor):
+        return x.contiguous(memory_format=torch.channels_last) if x.dim() == 4 else x
+    if isinstance(x, dict):
+        return {k: to_channels_last(v) for k, v in x.items()}
+    if isinstance(x, list):
+        return [to_channels_last(v) for v in x]
+    return x
+
+
 def conv_nd(dims, *args, **kwargs):
     """
     Create a 1D, 2D, or 3D convolution module.
@@ -18,13 +18,18 @@ from lib.util import (
     linear,
     zero_module,
     timestep_embedding,
+    convert_module_to_dtype,
 )
 
 from einops import rearrange, repeat
 from torchvision.utils import make_grid
-from lib.attention import SpatialTransformer
+from lib.attention import SpatialTransformer, CrossAttention, MemoryEfficientCrossAttention, FeedForward
 from lib.openaimodel import UNetModel, TimestepEmbedSequential, ResBlock, Downsample, AttentionBlock
 from lib.ddpm_multi import LatentDiffusion
+from lib.placement import stream_blocks
+from lib.streaming import WeightStreamer
+from lib.compile import BucketedCompile, enable_compile_cache
+from lib.pruning import apply_widths
 from utils import log_txt_as_img, exists, instantiate_from_config
 from lib.ddim_multi import DDIMSampler
 
@@ -43,36 +48,105 @@ def modulated_conv2d(
     """
     https://github.com/NVlabs/stylegan3/blob/407db86e6fe432540a22515310188288687858fa/training/networks_stylegan3.py
     """
-#     with misc.suppress_tracer_warnings(): # this value will be treated as a constant
-    batch_size = int(x.shape[0])
-    out_channels, in_channels, kh, kw = w.shape
+    # Without demodulation, scaling the weights per input channel is the same as
+    # scaling the input channels, so the per-sample grouped convolution reduces to
+    # one ordinary convolution with the shared weight. This also keeps the input's
+    # memory format instead of forcing an NCHW copy through the grouped reshape.
+    assert not demodulate, 'demodulation is not supported'
+    x = x * s.to(x.dtype)[:, :, None, None]
+    return torch.nn.functional.conv2d(input=x, weight=w.to(x.dtype), bias=bias, stride=stride, padding=padding, dilation=dilation)
 
-    # Modulate weights.
-    w = w.unsqueeze(0) # [NOIkk]
-    w = (w * s.unsqueeze(1).unsqueeze(3).unsqueeze(4)) # [NOIkk]
-    # Execute as one fused op using grouped convolution.
-    x = x.reshape(1, -1, *x.shape[2:])
-    w = w.reshape(-1, in_channels, kh, kw)
 
-    x = torch.nn.functional.conv2d(input=x, weight=w.to(x.dtype), bias=bias, stride=stride, padding=padding, dilation=dilation, groups=batch_size)
-    x = x.reshape(batch_size, -1, *x.shape[2:])
 
-    return x
+_side_executor = None
+_side_streams = {}
 
 
+def run_concurrently(fn_side, fn_main, device):
+    """
+    Run two independent callables concurrently and return (fn_side(), fn_main()).
+    On CUDA fn_side is issued on a second stream; elsewhere it runs on a worker
+    thread while fn_main runs on the calling thread (torch ops release the GIL).
+    """
+    global _side_executor
+    device = torch.device(device)
+    if device.type == 'cuda':
+        main = torch.cuda.current_stream(device)
+        if device not in _side_streams:
+            _side_streams[device] = torch.cuda.Stream(device)
+        side = _side_streams[device]
+        side.wait_stream(main)
+        with torch.cuda.stream(side):
+            out_side = fn_side()
+        out_main = fn_main()
+        main.wait_stream(side)
+        for tensor in out_side if isinstance(out_side, (list, tuple)) else [out_side]:
+            tensor.record_stream(main)
+        return out_side, out_main
+
+    if _side_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _side_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='controlnet')
+    grad_enabled = torch.is_grad_enabled()  # grad mode is thread local
+
+    def run_side():
+        with torch.set_grad_enabled(grad_enabled):
+            return fn_side()
+
+    future = _side_executor.submit(run_side)
+    out_main = fn_main()
+    return future.result(), out_main
+
+
+def used_context_length(lengths, max_length, multiple=8):
+    """
+    Number of text tokens the cross attention needs for prompts of `lengths` tokens (BOS and EOS included):
+    the longest one, rounded up to `multiple` to limit the number of distinct shapes. The text encoder is
+    causal, so the kept tokens are unchanged by the truncation. Shorter prompts of the batch keep some of
+    their padding tokens, which they would attend to without truncation as well, so no mask is needed.
+    """
+    return min(max_length, -(-int(lengths.max()) // multiple) * multiple)
+
+
+def task_key(task):
+    """Name of the task of a conditioning, or the tuple of names for several conditions."""
+    return tuple(t['name'] for t in task) if isinstance(task, (list, tuple)) else task['name']
+
+
+def condition_strengths(tasks, device):
+    """
+    The 'strength' of each task of a multi-condition conditioning (float or 0-dim tensor, 1 if missing) as one
+    float32 tensor on `device`.
+    """
+    strengths = [task.get('strength', 1.0) for task in tasks]
+    if all(isinstance(strength, torch.Tensor) for strength in strengths):
+        return torch.stack(strengths).to(device, torch.float32)
+    return torch.tensor([float(strength) for strength in strengths], device=device)
+
 
 class ControlledUnetModel(UNetModel):
     def forward(self, x, timesteps=None, context=None, control=None, only_mid_control=False, **kwargs):
+        h, hs, emb = self.encode(x, timesteps=timesteps, context=context)
+        return self.decode(x, h, hs, emb, context=context, control=control, only_mid_control=only_mid_control)
+
+    def encode(self, x, timesteps=None, context=None):
+        """
+        Run the (frozen) input and middle blocks. These do not depend on the
+        control residuals, so they can run alongside the ControlNet.
+        :return: the middle block output, the skip connections and the timestep embedding.
+        """
         hs = []
         with torch.no_grad():
             t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-            emb = self.time_embed(t_emb)
+            emb = self.time_embed(t_emb.type(self.dtype))
             h = x.type(self.dtype)
             for module in self.input_blocks:
                 h = module(h, emb, context)
                 hs.append(h)
             h = self.middle_block(h, emb, context)
+        return h, hs, emb
 
+    def decode(self, x, h, hs, emb, context=None, control=None, only_mid_control=False):
         if control is not None:
             h += control.pop()
 
@@ -83,8 +157,7 @@ class ControlledUnetModel(UNetModel):
                 h = torch.cat([h, hs.pop() + control.pop()], dim=1)
             h = module(h, emb, context)
 
-        h = h.type(x.dtype)
-        return self.out(h)
+        return self.out(h).type(x.dtype)
 
 
 class ControlNet(nn.Module):
@@ -118,6 +191,9 @@ class ControlNet(nn.Module):
             disable_middle_self_attn=False,
             use_linear_in_transformer=False,
             all_tasks_num = 13,
+            tasks=None,
+            fold_task_scales=False,
+            pruned_widths=None,
     ):
         super().__init__()
         if use_spatial_transformer:
@@ -140,6 +216,11 @@ class ControlNet(nn.Module):
 
         self.all_tasks_num = all_tasks_num
         self.tasks_to_id = {"control_hed":0, "control_canny":1, "control_seg":2, "control_depth":3, "control_normal":4,"control_openpose":5, "control_img":6, "control_hedsketch":7, "control_bbox":8, "control_outpainting":9,  "control_grayscale":10,  "control_blur":11, "control_inpainting":12}
+        if tasks is not None:
+            # task-pruned model: one hint expert per listed task (see tool_export_tasks.py)
+            self.tasks_to_id = {name: i for i, name in enumerate(tasks)}
+            self.all_tasks_num = len(tasks)
+        self.fold_task_scales = fold_task_scales
 
 
         self.dims = dims
@@ -348,6 +429,45 @@ class ControlNet(nn.Module):
         self.middle_block_out = self.make_zero_conv(ch)
         self._feature_size += ch
         self.task_id_layernet = nn.ModuleList(self.task_id_layernet)
+        if pruned_widths:
+            # channel-pruned model, see tool_prune_control.py
+            apply_widths(self, dict(pruned_widths))
+        if fold_task_scales:
+            # the zero conv modulations only depend on the task, so a task-pruned model stores them
+            # per task instead of the hypernet and layernets that compute them from the task feature
+            self.task_scale_channels = [self.task_id_layernet_zeroconv_0.out_features,
+                                        self.task_id_layernet_zeroconv_1.out_features] + \
+                                       [l.out_features for l in self.task_id_layernet]
+            del self.task_id_hypernet, self.task_id_layernet_zeroconv_0, self.task_id_layernet_zeroconv_1
+            del self.task_id_layernet
+            self.register_buffer('task_scales', th.ones(self.all_tasks_num, sum(self.task_scale_channels)))
+        if use_fp16:
+            self.convert_to_dtype(th.float16)
+
+    def convert_to_dtype(self, dtype):
+        """
+        Convert the model to `dtype`, keeping normalization layers in float32.
+        The control residuals are produced in `dtype`.
+        """
+        self.apply(lambda l: convert_module_to_dtype(l, dtype))
+        self.dtype = dtype
+
+    def fuse_norm_act(self, check=True, device=None):
+        for module in self.modules():
+            if isinstance(module, ResBlock):
+                module.fuse_norm_act(check=check, device=device)
+
+    def get_task_scales(self, task_id, task_feature=None):
+        """
+        The per-input-channel modulation of every zero conv for a task.
+        :return: scales for input_hint_block_zeroconv_0, input_hint_block_zeroconv_1
+                 and each of the zero convs, every one of shape [1, channels].
+        """
+        if self.fold_task_scales:
+            return th.split(self.task_scales[task_id:task_id + 1], self.task_scale_channels, dim=1)
+        task_id_emb = self.task_id_hypernet(task_feature.squeeze(0).to(self.task_id_hypernet[0].weight.device, self.dtype))
+        layernets = [self.task_id_layernet_zeroconv_0, self.task_id_layernet_zeroconv_1] + list(self.task_id_layernet)
+        return [layernet(task_id_emb).detach() for layernet in layernets]
 
     def make_zero_conv(self, channels):
         return TimestepEmbedSequential(zero_module(conv_nd(self.dims, channels, channels, 1, padding=0)))
@@ -361,26 +481,37 @@ class ControlNet(nn.Module):
         '''
         BS_Real = x.shape[0]
         if kwargs is not None:
-            task_name = kwargs['task']['name']
-            task_id = self.tasks_to_id[task_name]
-            task_feature = kwargs['task']['feature']
-            task_id_emb = self.task_id_hypernet(task_feature.squeeze(0))
+            # several conditions: `task` is a list of task dicts and `hint` the list of their hints; they run
+            # as one batch of len(tasks) * BS_Real, condition-major, with per-sample task scales
+            tasks = kwargs['task'] if isinstance(kwargs['task'], (list, tuple)) else [kwargs['task']]
+            hints = hint if isinstance(hint, (list, tuple)) else [hint]
+            task_ids = [self.tasks_to_id[task['name']] for task in tasks]
+            task_scales = [self.get_task_scales(task_id, task.get('feature')) for task_id, task in zip(task_ids, tasks)]
+            if len(tasks) == 1:
+                scale_0, scale_1, *scales = task_scales[0]
+            else:
+                scale_0, scale_1, *scales = [th.cat([s.expand(BS_Real, -1) for s in layer_scales])
+                                             for layer_scales in zip(*task_scales)]
 
         t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-        emb = self.time_embed(t_emb)
-        guided_hint = self.input_hint_block_list_moe[task_id](hint, emb, context)
-
-        guided_hint = modulated_conv2d(guided_hint, self.input_hint_block_zeroconv_0[0].weight, self.task_id_layernet_zeroconv_0(task_id_emb).repeat(BS_Real, 1).detach(), padding=1)
+        emb = self.time_embed(t_emb.type(self.dtype))
+        guided_hint = [self.input_hint_block_list_moe[task_id](hint.type(self.dtype), emb, context)
+                       for task_id, hint in zip(task_ids, hints)]
+        guided_hint = guided_hint[0] if len(guided_hint) == 1 else th.cat(guided_hint)
+        if len(tasks) > 1:
+            x, emb, context = x.repeat(len(tasks), 1, 1, 1), emb.repeat(len(tasks), 1), context.repeat(len(tasks), 1, 1)
+
+        guided_hint = modulated_conv2d(guided_hint, self.input_hint_block_zeroconv_0[0].weight, scale_0, padding=1)
         guided_hint += self.input_hint_block_zeroconv_0[0].bias.unsqueeze(0).unsqueeze(2).unsqueeze(3)
 
         guided_hint = self.input_hint_block_share(guided_hint, emb, context)
 
-        guided_hint = modulated_conv2d(guided_hint, self.input_hint_block_zeroconv_1[0].weight, self.task_id_layernet_zeroconv_1(task_id_emb).repeat(BS_Real, 1).detach(), padding=1)
+        guided_hint = modulated_conv2d(guided_hint, self.input_hint_block_zeroconv_1[0].weight, scale_1, padding=1)
         guided_hint += self.input_hint_block_zeroconv_1[0].bias.unsqueeze(0).unsqueeze(2).unsqueeze(3)
 
         outs = []
         h = x.type(self.dtype)
-        for module, zero_conv, task_hyperlayer in zip(self.input_blocks, self.zero_convs, self.task_id_layernet):
+        for module, zero_conv, scale in zip(self.input_blocks, self.zero_convs, scales):
             if guided_hint is not None:
                 h = module(h, emb, context)
                 try:
@@ -391,7 +522,7 @@ class ControlNet(nn.Module):
             else:
                 h = module(h, emb, context)
 
-            outs.append(modulated_conv2d(h, zero_conv[0].weight, task_hyperlayer(task_id_emb).repeat(BS_Real, 1).detach()) + zero_conv[0].bias.unsqueeze(0).unsqueeze(2).unsqueeze(3))
+            outs.append(modulated_conv2d(h, zero_conv[0].weight, scale) + zero_conv[0].bias.unsqueeze(0).unsqueeze(2).unsqueeze(3))
 
         h = self.middle_block(h, emb, context)
         outs.append(self.middle_block_out(h, emb, context))
@@ -411,6 +542,8 @@ class ControlLDM(LatentDiffusion):
         self.control_key = control_key
         self.only_mid_control = only_mid_control
         self.control_scales = [1.0] * 13
+        self.channels_last = False
+        self.parallel_control = False
 
     @torch.no_grad()
     def get_input(self, batch, k, bs=None, *args, **kwargs):
@@ -443,22 +576,95 @@ class ControlLDM(LatentDiffusion):
         task_dic['feature'] = c_task
         return x, dict(c_crossattn=[c], c_concat=[control], task=task_dic)
 
+    @property
+    def control_scales(self):
+        return self._control_scales
+
+    @control_scales.setter
+    def control_scales(self, scales):
+        # set once per request; apply_model moves them to the device as one tensor on first use
+        self._control_scales = list(scales)
+        self._control_scales_tensor = None
+
+    def control_scales_tensor(self, device):
+        """`control_scales` as a float32 tensor on `device`, built once per assignment of `control_scales`."""
+        scales = self._control_scales_tensor
+        if scales is None or scales.device != torch.device(device):
+            if all(isinstance(s, torch.Tensor) for s in self._control_scales):
+                scales = torch.stack(self._control_scales).to(device, torch.float32)
+            else:
+                scales = torch.tensor([float(s) for s in self._control_scales], device=device)
+            self._control_scales_tensor = scales
+        return scales
+
+    def condition_strengths_tensor(self, task, device):
+        """
+        The strengths of a multi-condition `task` list as a tensor on `device` (None without any 'strength'),
+        built once per request: the sampler passes the same list at every step.
+        """
+        if not isinstance(task, (list, tuple)) or not any('strength' in condition for condition in task):
+            return None
+        cached = getattr(self, '_condition_strengths', None)
+        if cached is None or cached[0] is not task or cached[1].device != torch.device(device):
+            cached = self._condition_strengths = (task, condition_strengths(task, device))
+        return cached[1]
+
     def apply_model(self, x_noisy, t, cond, *args, **kwargs):
         assert isinstance(cond, dict)
-        task_name = cond['task'] # dict['name', 'feature']
         diffusion_model = self.model.diffusion_model # -> ControlledUnetModel
 
-        cond_txt = torch.cat(cond['c_crossattn'], 1)
+        cond_txt = torch.cat(cond['c_crossattn'], 1).to(x_noisy.device, diffusion_model.dtype)
+        if cond.get('context_lengths') is not None and len(cond['c_crossattn']) == 1:
+            cond_txt = cond_txt[:, :used_context_length(cond['context_lengths'], cond_txt.shape[1])]
+
+        return self.denoise(x_noisy, t, cond_txt, cond['c_concat'], cond['task'],
+                            self.control_scales_tensor(x_noisy.device),
+                            self.condition_strengths_tensor(cond['task'], x_noisy.device))
+
+    def denoise(self, x_noisy, t, cond_txt, c_concat, task, control_scales, strengths=None):
+        """
+        The ControlNet + UNet evaluation of apply_model on prepared inputs: the (truncated) text context, the
+        control scales and the condition strengths as tensors. This is what enable_compile compiles, so none of
+        the per-request values is read from the model, where torch.compile would specialize the graph on them.
+        :param task: dict['name', 'feature'], or a list of them with one hint each in `c_concat`.
+        :param strengths: [len(task)] weights of the conditions of a task list, None for equal weights.
+        """
+        diffusion_model = self.model.diffusion_model # -> ControlledUnetModel
 
-        if cond['c_concat'] is None:
+        if c_concat is None:
             eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=None, only_mid_control=self.only_mid_control)
         else:
-            control = self.control_model(x=x_noisy, hint=torch.cat(cond['c_concat'], 1), timesteps=t, context=cond_txt, task=task_name)
-            control = [c * scale for c, scale in zip(control, self.control_scales)]
-            eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=control, only_mid_control=self.only_mid_control)
+            multi = isinstance(task, (list, tuple))
+            hint = list(c_concat) if multi else torch.cat(c_concat, 1)
+            run_control = lambda: self.control_model(x=x_noisy, hint=hint, timesteps=t, context=cond_txt, task=task)
+            run_encoder = lambda: diffusion_model.encode(x_noisy, timesteps=t, context=cond_txt)
+            if self.parallel_control:
+                control, (h, hs, emb) = run_concurrently(run_control, run_encoder, x_noisy.device)
+            else:
+                control = run_control()
+                h, hs, emb = run_encoder()
+            if multi:
+                # sum the residuals of the conditions, each weighted by its task's 'strength', into one UNet pass
+                control = [c.unflatten(0, (len(task), -1)) for c in control]
+                if strengths is not None:
+                    control = [c * strengths.view(-1, 1, 1, 1, 1).to(c.dtype) for c in control]
+                control = [c.sum(0) for c in control]
+            control = [c * scale.to(c.dtype) for c, scale in zip(control, control_scales.unbind(0))]
+            eps = diffusion_model.decode(x_noisy, h, hs, emb, context=cond_txt, control=control, only_mid_control=self.only_mid_control)
 
         return eps
 
+    def get_context_lengths(self, texts):
+        """
+        Token lengths of the prompts of a conditioning. Passed as cond['context_lengths'], the cross attention
+        of the UNet and ControlNet only attends to the tokens used by the longest prompt instead of all 77.
+        """
+        return self.cond_stage_model.token_lengths(texts)
+
+    def enable_cond_cache(self, max_size=256, table_path=None):
+        """Cache text conditioning (see LatentDiffusion.enable_cond_cache), with the task instructions pinned."""
+        return super().enable_cond_cache(max_size, pinned=list(self.mapping_task.values()), table_path=table_path)
+
     @torch.no_grad()
     def get_unconditional_conditioning(self, N):
         return self.get_learned_conditioning([""] * N)
@@ -581,14 +787,147 @@ class ControlLDM(LatentDiffusion):
         opt = torch.optim.AdamW(params, lr=lr)
         return opt
 
-    def low_vram_shift(self, is_diffusing):
-        if is_diffusing:
-            self.model = self.model.cuda()
-            self.control_model = self.control_model.cuda()
-            self.first_stage_model = self.first_stage_model.cpu()
-            self.cond_stage_model = self.cond_stage_model.cpu()
-        else:
-            self.model = self.model.cpu()
-            self.control_model = self.control_model.cpu()
-            self.first_stage_model = self.first_stage_model.cuda()
-            self.cond_stage_model = self.cond_stage_model.cuda()
+    def fuse_norm_act(self, check=True, device=None):
+        """
+        Swap GroupNorm + SiLU pairs in the UNet, ControlNet and VAE (resnet blocks and norm_out) for the
+        fused GroupNormSiLU. Each norm configuration is checked against the original modules.
+        :param device: device the model runs on; call after placement so the kernel is checked there.
+        """
+        self.model.diffusion_model.fuse_norm_act(check=check, device=device)
+        self.control_model.fuse_norm_act(check=check, device=device)
+        self.first_stage_model.encoder.fuse_norm_act(check=check, device=device)
+        self.first_stage_model.decoder.fuse_norm_act(check=check, device=device)
+
+    def convert_to_dtype(self, dtype):
+        """
+        Cast the UNet, ControlNet, VAE and text encoder to `dtype`. Normalization
+        layers and attention softmax stay in float32; the sampler keeps working
+        in float32 and each submodule casts its inputs and outputs.
+        """
+        self.model.diffusion_model.convert_to_dtype(dtype)
+        self.control_model.convert_to_dtype(dtype)
+        self.first_stage_model.apply(lambda l: convert_module_to_dtype(l, dtype))
+        self.cond_stage_model.to(dtype)
+        return self
+
+    def quantize_int8(self):
+        """
+        Dynamically quantize the text encoder and the attention / feed-forward
+        linears of the UNet and ControlNet to int8 with per-channel weights.
+        Activations are quantized on the fly, so this only runs on CPU in float32.
+        """
+        from torch.ao.quantization import quantize_dynamic, per_channel_dynamic_qconfig
+        if self.device.type != 'cpu':
+            raise RuntimeError(f'int8 dynamic quantization is CPU only, the model is on {self.device}')
+        if self.model.diffusion_model.dtype != torch.float32:
+            raise ValueError(f'int8 dynamic quantization needs a float32 model, not {self.model.diffusion_model.dtype}')
+        qconfig_spec = {nn.Linear: per_channel_dynamic_qconfig}
+        quantize_dynamic(self.cond_stage_model, qconfig_spec, dtype=torch.qint8, inplace=True)
+        for diffusion_model in (self.model.diffusion_model, self.control_model):
+            targets = [m for m in diffusion_model.modules()
+                       if isinstance(m, (CrossAttention, MemoryEfficientCrossAttention, FeedForward))]
+            for module in targets:
+                quantize_dynamic(module, qconfig_spec, dtype=torch.qint8, inplace=True)
+        return self
+
+    def to_channels_last(self):
+        """
+        Convert the conv-heavy submodules (UNet, ControlNet, VAE) to channels-last.
+        Samplers check `self.channels_last` and convert their inputs once.
+        """
+        self.channels_last = True
+        for module in (self.model, self.control_model, self.first_stage_model):
+            module.to(memory_format=torch.channels_last)
+        return self
+
+    def apply_placement(self, placement, device, window=4, pin_memory=True):
+        """
+        Place the submodules on `device` following a plan (see lib.placement.plan_placement).
+        :param placement: dict from submodule name to
+                          "resident" - kept on the device,
+                          "stream"   - ControlNet / UNet blocks streamed from host memory, `window` at a time,
+                          "offload"  - text encoder / VAE encoder / VAE decoder loaded only while they run,
+                          "cpu"      - text encoder run on the CPU.
+        Everything not listed (embeddings, zero convs, hint blocks, ...) is resident.
+        """
+        allowed = {"control_model": ("resident", "stream"), "model.diffusion_model": ("resident", "stream"),
+                   "cond_stage_model": ("resident", "offload", "cpu"),
+                   "first_stage_model.encoder": ("resident", "offload"),
+                   "first_stage_model.decoder": ("resident", "offload")}
+        for name, where in placement.items():
+            if where not in allowed.get(name, ()):
+                raise ValueError(f"cannot place '{name}' as '{where}'")
+        cycle = [block for name in ("control_model", "model.diffusion_model") if placement.get(name) == "stream"
+                 for block in stream_blocks(self, name)]
+        on_demand = [self.get_submodule(name) for name, where in placement.items() if where == "offload"]
+        on_host = cycle + on_demand + [self.get_submodule(name) for name, where in placement.items() if where == "cpu"]
+        host = {id(t) for module in on_host for t in list(module.parameters()) + list(module.buffers())}
+        for module in self.modules():
+            for p in module._parameters.values():
+                if p is not None and id(p) not in host:
+                    p.data = p.data.to(device)
+            for name, b in module._buffers.items():
+                if b is not None and id(b) not in host:
+                    module._buffers[name] = b.to(device)
+        self._device = torch.device(device)  # keep LightningModule.device in sync, the model is not moved by .to()
+        if cycle or on_demand:
+            self.weight_streamer = WeightStreamer(device, cycle, on_demand, window=window, pin_memory=pin_memory)
+        return self
+
+    def enable_weight_streaming(self, device, window=4, pin_memory=True):
+        """
+        Place the model on `device` without holding all weights there: the UNet and
+        ControlNet blocks stream in from host memory a `window` of blocks at a time,
+        the text encoder and VAE encoder/decoder are loaded only while they run.
+        """
+        placement = {"cond_stage_model": "offload", "first_stage_model.encoder": "offload",
+                     "first_stage_model.decoder": "offload", "control_model": "stream", "model.diffusion_model": "stream"}
+        return self.apply_placement(placement, device, window=window, pin_memory=pin_memory)
+
+    def enable_compile(self, buckets=(), tasks=("control_hedsketch",), cache_dir=None, max_buckets=8, **compile_kwargs):
+        """
+        Run the denoiser (`denoise`, under apply_model) and the VAE decoder through torch.compile, one static-shape
+        graph per (batch, resolution, text context length) bucket; shapes beyond `max_buckets` run eagerly.
+        The control scales reach the graph as a tensor, so new strengths or guess mode do not recompile.
+        Warmup compiles the full 77-token context only: truncated contexts (cond['context_lengths']) compile one
+        graph per rounded length and use up the buckets, do not combine them with compilation.
+        This sets process-wide dynamo options: `automatic_dynamic_shapes` is turned off (a new shape is a new
+        bucket, never a dynamic-shape recompile) and `cache_size_limit` is raised to the number of buckets.
+        :param buckets: (num_samples, height, width) to compile now, height and width multiples of 64.
+                        The denoiser is warmed up at the classifier-free guidance batch of 2 * num_samples.
+        :param tasks: task names to warm up, the task selects the hint expert so each gets its own graph.
+        :param cache_dir: directory for the persistent inductor cache, so restarts load instead of recompiling.
+        """
+        import torch._dynamo.config as dynamo_config
+        if getattr(self, "weight_streamer", None) is not None:
+            raise RuntimeError("torch.compile is not supported together with weight streaming")
+        for num_samples, h, w in buckets:
+            if h % 64 or w % 64:
+                raise ValueError(f"bucket {(num_samples, h, w)}: height and width must be multiples of 64")
+        if cache_dir is not None:
+            enable_compile_cache(cache_dir)
+        denoise_buckets = max_buckets * max(len(tasks), 1)
+        dynamo_config.automatic_dynamic_shapes = False
+        dynamo_config.cache_size_limit = max(dynamo_config.cache_size_limit, denoise_buckets, max_buckets)
+        self.parallel_control = False  # side-stream threads cannot be traced
+        self.denoise = BucketedCompile(
+            type(self).denoise.__get__(self),
+            lambda x, t, cond_txt, c_concat, task, *args: (tuple(x.shape), cond_txt.shape[1], task_key(task)),
+            max_buckets=denoise_buckets, **compile_kwargs)
+        self.first_stage_model.decode = BucketedCompile(
+            type(self.first_stage_model).decode.__get__(self.first_stage_model), lambda z, *args, **kwargs: tuple(z.shape),
+            max_buckets=max_buckets, **compile_kwargs)
+
+        with torch.no_grad():
+            for num_samples, h, w in buckets:
+                x = torch.randn(2 * num_samples, self.channels, h // 8, w // 8, device=self.device)
+                t = torch.full((2 * num_samples,), self.num_timesteps - 1, device=self.device, dtype=torch.long)
+                context = self.get_learned_conditioning([""] * 2 * num_samples)
+                hint = torch.zeros(2 * num_samples, 3, h, w, device=self.device)
+                for task in tasks:
+                    feature = self.get_learned_conditioning([self.mapping_task[task]])[:, :1, :]
+                    cond = dict(c_crossattn=[context], c_concat=[hint], task=dict(name=task, feature=feature))
+                    self.apply_model(x, t, cond)
+                self.decode_first_stage(x[:num_samples])
+                print(f"Compiled bucket {num_samples} x {h} x {w}")
+        return self
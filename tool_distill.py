@@ -0,0 +1,116 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+# Distill a UniControl checkpoint for few-step sampling without classifier-free guidance (see lib/distill.py):
+#  1. guidance distillation: a single conditional pass learns the --scale guided prediction,
+#  2. progressive distillation: rounds halving the DDIM steps from --teacher_steps / 2 down to --steps.
+# Training pairs are read from a ControlNet style prompt file, one JSON object per line:
+#   {"source": "source/0.png", "target": "target/0.png", "prompt": "..."}
+# with paths relative to the file's directory; sources are hints for --task, targets the images.
+#
+#   python tool_distill.py --data ./training/hedsketch/prompt.json --task control_hedsketch --steps 8
+#
+# The student has the architecture of the teacher and loads with the same config; sample it with
+# config.distilled_steps = 8, which runs 8 DDIM steps (eta 0) of a single conditional pass.
+
+import argparse
+import json
+import os
+import random
+
+import cv2
+import numpy as np
+import torch
+
+from annotator.util import HWC3, resize_image, get_device
+from lib.distill import DistillationTrainer, frozen_copy
+from utils import create_model, save_inference_checkpoint, PRECISIONS
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', default='./models/cldm_v15_unicontrol.yaml')
+parser.add_argument('--ckpt', default='./unicontrol_v1.1.st')
+parser.add_argument('--data', required=True, help='prompt file of source / target / prompt lines')
+parser.add_argument('--task', default='control_hedsketch')
+parser.add_argument('--resolution', type=int, default=512)
+parser.add_argument('--batch_size', type=int, default=4)
+parser.add_argument('--scale', type=float, default=9.0, help='guidance scale folded into the student')
+parser.add_argument('--teacher_steps', type=int, default=32)
+parser.add_argument('--steps', type=int, default=8, help='DDIM steps of the final student')
+parser.add_argument('--guidance_iters', type=int, default=2000)
+parser.add_argument('--iters_per_round', type=int, default=2000)
+parser.add_argument('--lr', type=float, default=1e-5)
+parser.add_argument('--sd_locked', action='store_true', help='train the ControlNet only, not the UNet decoder')
+parser.add_argument('--dtype', default='fp16', choices=list(PRECISIONS))
+parser.add_argument('--device', default=None)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--out', default=None)
+args = parser.parse_args()
+out = args.out or os.path.splitext(args.ckpt)[0] + f'_distilled_{args.steps}steps.safetensors'
+
+torch.manual_seed(args.seed)
+random.seed(args.seed)
+np.random.seed(args.seed)
+device = get_device(args.device)
+model = create_model(args.config, device=device, ckpt_path=args.ckpt).to(device)
+if args.task not in model.control_model.tasks_to_id:
+    raise ValueError(f"unknown task '{args.task}', expected one of {list(model.control_model.tasks_to_id)}")
+root = os.path.dirname(os.path.abspath(args.data))
+with open(args.data) as f:
+    items = [json.loads(line) for line in f if line.strip()]
+
+
+def load_image(path):
+    image = cv2.imread(os.path.join(root, path))
+    image = resize_image(HWC3(image[:, :, ::-1].copy()), args.resolution)
+    return torch.from_numpy(image.copy()).float().permute(2, 0, 1)
+
+
+def batches():
+    with torch.no_grad():
+        feature = model.get_learned_conditioning([model.mapping_task[args.task]])[:, :1, :]
+        uncond_txt = model.get_learned_conditioning([''] * args.batch_size)
+    task = {'name': args.task, 'feature': feature}
+    while True:
+        chunk = random.sample(items, args.batch_size)
+        with torch.no_grad():
+            hint = torch.stack([load_image(item['source']) for item in chunk]).to(device) / 255.0
+            image = torch.stack([load_image(item['target']) for item in chunk]).to(device) / 127.5 - 1.0
+            z0 = model.get_first_stage_encoding(model.encode_first_stage(image))
+            txt = model.get_learned_conditioning([item['prompt'] for item in chunk])
+        yield z0, {'c_concat': [hint], 'c_crossattn': [txt], 'task': task}, \
+            {'c_concat': [hint], 'c_crossattn': [uncond_txt]}
+
+
+def train(step, iters, name):
+    data = batches()
+    for i in range(iters):
+        loss = step(*next(data))
+        if i % 100 == 0 or i == iters - 1:
+            print(f'{name} iter {i}: loss {loss:.4f}')
+
+
+trainer = DistillationTrainer(frozen_copy(model), model, guidance_scale=args.scale, num_steps=args.teacher_steps // 2,
+                              learning_rate=args.lr, train_unet=not args.sd_locked)
+model.train()
+if args.guidance_iters:
+    train(trainer.guidance_step, args.guidance_iters, f'guidance distillation (scale {args.scale})')
+    trainer.next_round(trainer.num_steps)
+while True:
+    train(trainer.progressive_step, args.iters_per_round,
+          f'progressive distillation {2 * trainer.num_steps} -> {trainer.num_steps} steps')
+    if trainer.num_steps <= args.steps:
+        break
+    trainer.next_round(trainer.num_steps // 2)
+model.eval()
+
+save_inference_checkpoint(model, out, PRECISIONS[args.dtype],
+                          metadata={'ddim_steps': str(trainer.num_steps), 'guidance_scale': str(args.scale)})
+print(f'wrote [{out}], sample it with {trainer.num_steps} DDIM steps and config.distilled_steps = {trainer.num_steps}')
@@ -0,0 +1,71 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+# Export the classifier-free guided denoiser step (ControlNet + UNet + CFG) for one task to ONNX,
+# then check onnxruntime against eager PyTorch on CPU and compare their latency.
+#
+#   python tool_export_onnx.py --task control_hedsketch --out ./unicontrol_hedsketch.onnx
+#
+# and serve it with DDIMSampler(model, denoiser=OnnxDenoiser('./unicontrol_hedsketch.onnx')).
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from utils import create_model
+from lib.onnx_denoiser import export_onnx, OnnxDenoiser, INPUT_NAMES
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', default='./models/cldm_v15_unicontrol.yaml')
+parser.add_argument('--ckpt', default='./unicontrol_v1.1.st')
+parser.add_argument('--task', default='control_hedsketch')
+parser.add_argument('--out', default=None)
+parser.add_argument('--resolution', type=int, default=512)
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--opset', type=int, default=17)
+parser.add_argument('--threads', type=int, default=None)
+parser.add_argument('--runs', type=int, default=3)
+args = parser.parse_args()
+out = args.out or f"./unicontrol_{args.task.replace('control_', '')}.onnx"
+
+model = create_model(args.config, ckpt_path=args.ckpt).eval()
+with torch.no_grad():
+    task_feature = model.get_learned_conditioning([model.mapping_task[args.task]])[:, :1, :]
+inputs, reference = export_onnx(model, out, args.task, task_feature, batch_size=args.batch_size,
+                                resolution=args.resolution, opset_version=args.opset)
+print(f'wrote [{out}]')
+
+runner = OnnxDenoiser(out, num_threads=args.threads)
+feed = {name: tensor.numpy() for name, tensor in zip(INPUT_NAMES, inputs)}
+
+
+def timed(fn):
+    fn()  # warmup
+    times = []
+    for _ in range(args.runs):
+        t = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t)
+    return result, float(np.median(times))
+
+
+if args.threads is not None:
+    torch.set_num_threads(args.threads)
+with torch.no_grad():
+    _, t_torch = timed(lambda: model.apply_model(torch.cat([inputs[0]] * 2), torch.cat([inputs[1]] * 2), {
+        'c_crossattn': [torch.cat([inputs[3], inputs[2]])], 'c_concat': [torch.cat([inputs[5], inputs[4]])],
+        'task': {'name': args.task, 'feature': task_feature}}))
+(output,), t_onnx = timed(lambda: runner.session.run(['model_output'], feed))
+diff = np.abs(output - reference.numpy())
+print(f'max abs diff {diff.max():.2e}, mean abs diff {diff.mean():.2e}')
+print(f'denoiser step: torch {t_torch * 1e3:.0f} ms, onnxruntime {t_onnx * 1e3:.0f} ms ({t_torch / t_onnx:.2f}x)')
@@ -0,0 +1,79 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+# Export an inference-only UniControl checkpoint restricted to a subset of tasks:
+# only their MoE hint experts are kept, the task hypernet and layernets are folded
+# into per-task zero conv scales, and training / derivable state is dropped.
+#
+#   python tool_export_tasks.py --tasks control_hedsketch
+#
+# then load it with the written config:
+#
+#   model = create_model('./models/cldm_v15_unicontrol_hedsketch.yaml',
+#                        ckpt_path='./unicontrol_v1.1_hedsketch.safetensors')
+
+import argparse
+import os
+
+import torch
+from omegaconf import OmegaConf
+
+from utils import create_model, save_inference_checkpoint, PRECISIONS
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', default='./models/cldm_v15_unicontrol.yaml')
+parser.add_argument('--ckpt', default='./unicontrol_v1.1.st')
+parser.add_argument('--tasks', nargs='+', default=['control_hedsketch'])
+parser.add_argument('--dtype', default='fp16', choices=list(PRECISIONS))
+parser.add_argument('--out', default=None)
+parser.add_argument('--out_config', default=None)
+args = parser.parse_args()
+
+suffix = '_'.join(task.replace('control_', '') for task in args.tasks)
+out = args.out or os.path.splitext(args.ckpt)[0] + f'_{suffix}.safetensors'
+out_config = args.out_config or os.path.splitext(args.config)[0] + f'_{suffix}.yaml'
+
+model = create_model(args.config, ckpt_path=args.ckpt).eval()
+control = model.control_model
+for task in args.tasks:
+    if task not in control.tasks_to_id or task not in model.mapping_task:
+        raise ValueError(f"unknown task '{task}', expected one of {list(control.tasks_to_id)}")
+if control.fold_task_scales:
+    raise ValueError(f'[{args.ckpt}] is already a task-pruned checkpoint')
+
+with torch.no_grad():
+    # the task feature is the CLIP embedding of the fixed task instruction, so its modulation is a constant
+    task_scales = []
+    for task in args.tasks:
+        feature = model.get_learned_conditioning([model.mapping_task[task]])[:, :1, :]
+        task_scales.append(torch.cat(control.get_task_scales(None, feature), dim=1))
+    task_scales = torch.cat(task_scales, dim=0)
+
+dtype = PRECISIONS[args.dtype]
+extra = {'control_model.task_scales': task_scales.float()}
+for new_id, task in enumerate(args.tasks):
+    for key, tensor in control.input_hint_block_list_moe[control.tasks_to_id[task]].state_dict().items():
+        extra[f'control_model.input_hint_block_list_moe.{new_id}.{key}'] = tensor.to(dtype)
+state_dict = save_inference_checkpoint(model, out, dtype, metadata={'tasks': ','.join(args.tasks)},
+                                       exclude=('control_model.task_id_hypernet.', 'control_model.task_id_layernet',
+                                                'control_model.input_hint_block_list_moe.'),
+                                       extra=extra)
+
+config = OmegaConf.load(args.config)
+config.model.params.use_ema = False
+config.model.params.control_stage_config.params.tasks = list(args.tasks)
+config.model.params.control_stage_config.params.fold_task_scales = True
+OmegaConf.save(config, out_config)
+
+size = lambda sd: sum(t.numel() * t.element_size() for t in sd.values())
+print(f'tasks {args.tasks}: {size(model.state_dict()) / 2 ** 20:.0f} MiB -> {size(state_dict) / 2 ** 20:.0f} MiB '
+      f'({args.dtype}), {len(model.state_dict())} -> {len(state_dict)} tensors')
+print(f'wrote [{out}] and [{out_config}]')
@@ -0,0 +1,96 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+# Compare the fp32 model against its int8 dynamically quantized copy on CPU:
+# text-encoder latency and embedding drift, then per-request latency and image drift.
+#
+#   python tool_int8_benchmark.py --ckpt ./unicontrol_v1.1.st --steps 20 --runs 3
+
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+
+from utils import create_model
+from lib.ddim_hacked import DDIMSampler
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', default='./models/cldm_v15_unicontrol.yaml')
+parser.add_argument('--ckpt', default='./unicontrol_v1.1.st')
+parser.add_argument('--prompt', default='a house by the lake, best quality, extremely detailed')
+parser.add_argument('--n_prompt', default='longbody, lowres, bad anatomy, bad hands, missing fingers, worst quality, low quality')
+parser.add_argument('--task', default='control_hedsketch')
+parser.add_argument('--resolution', type=int, default=512)
+parser.add_argument('--num_samples', type=int, default=1)
+parser.add_argument('--steps', type=int, default=20)
+parser.add_argument('--scale', type=float, default=9.0)
+parser.add_argument('--runs', type=int, default=3)
+parser.add_argument('--threads', type=int, default=None)
+parser.add_argument('--seed', type=int, default=12345)
+args = parser.parse_args()
+
+if args.threads is not None:
+    torch.set_num_threads(args.threads)
+
+
+def timed(fn, runs):
+    fn()  # warmup
+    times = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - t)
+    return out, float(np.median(times))
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+def generate(model, hint):
+    torch.manual_seed(args.seed)
+    sampler = DDIMSampler(model)
+    n = args.num_samples
+    task_dic = {'name': args.task,
+                'feature': model.get_learned_conditioning(model.mapping_task[args.task])[:, :1, :]}
+    cond = {"c_concat": [hint], "c_crossattn": [model.get_learned_conditioning([args.prompt] * n)], "task": task_dic}
+    un_cond = {"c_concat": [hint], "c_crossattn": [model.get_learned_conditioning([args.n_prompt] * n)]}
+    H = W = args.resolution
+    samples, _ = sampler.sample(args.steps, n, (4, H // 8, W // 8), cond, verbose=False, eta=0.,
+                                unconditional_guidance_scale=args.scale, unconditional_conditioning=un_cond,
+                                x_T=torch.randn((n, 4, H // 8, W // 8), generator=torch.Generator().manual_seed(args.seed)))
+    x = model.decode_first_stage(samples)
+    return (x.permute(0, 2, 3, 1) * 127.5 + 127.5).clamp(0, 255).to(torch.uint8).numpy()
+
+
+with torch.no_grad():
+    model = create_model(args.config, ckpt_path=args.ckpt)
+    model.eval()
+    model_int8 = copy.deepcopy(model).quantize_int8()
+
+    prompts = [args.prompt, args.n_prompt, model.mapping_task[args.task]]
+    emb_fp32, t_fp32 = timed(lambda: model.get_learned_conditioning(prompts), args.runs)
+    emb_int8, t_int8 = timed(lambda: model_int8.get_learned_conditioning(prompts), args.runs)
+    cos = torch.nn.functional.cosine_similarity(emb_fp32.flatten(1), emb_int8.flatten(1)).min().item()
+    print(f'text encoder: fp32 {t_fp32 * 1e3:.1f} ms, int8 {t_int8 * 1e3:.1f} ms ({t_fp32 / t_int8:.2f}x), '
+          f'min cosine {cos:.5f}, max abs diff {(emb_fp32 - emb_int8).abs().max().item():.4f}')
+
+    H = W = args.resolution
+    hint = torch.zeros((args.num_samples, 3, H, W))
+    hint[:, :, H // 4:3 * H // 4, W // 4:3 * W // 4] = 1.
+    img_fp32, t_fp32 = timed(lambda: generate(model, hint), args.runs)
+    img_int8, t_int8 = timed(lambda: generate(model_int8, hint), args.runs)
+    print(f'{args.steps} steps @ {H}x{W}: fp32 {t_fp32:.2f} s, int8 {t_int8:.2f} s ({t_fp32 / t_int8:.2f}x), '
+          f'PSNR {psnr(img_fp32, img_int8):.2f} dB, '
+          f'mean abs diff {np.abs(img_fp32.astype(np.float32) - img_int8.astype(np.float32)).mean():.2f}')
@@ -0,0 +1,174 @@
+'''
+ * Copyright (c) 2023 Salesforce, Inc.
+ * All rights reserved.
+ * SPDX-License-Identifier: Apache License 2.0
+ * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
+ * By Can Qin
+ * Modified from ControlNet repo: https://github.com/lllyasviel/ControlNet
+ * Copyright (c) 2023 Lvmin Zhang and Maneesh Agrawala
+'''
+
+# Structured channel pruning of the ControlNet branch (see lib/pruning.py).
+#  1. calibrate: sample each hint in --hints with DDIM and record the ControlNet inputs of every step,
+#  2. score:     first-order importance of every ResBlock group, attention head and feed-forward channel
+#                for the zero conv outputs on the recorded inputs,
+#  3. prune:     keep the --keep fraction of units of each module,
+#  4. fine-tune: --finetune_steps of matching the zero conv outputs of the unpruned ControlNet,
+#                with the optimizer of ControlLDM.configure_optimizers.
+#
+#   python tool_prune_control.py --hints ./calibration/hedsketch --task control_hedsketch --keep 0.5
+#
+# then load it with the written config:
+#
+#   model = create_model('./models/cldm_v15_unicontrol_pruned.yaml',
+#                        ckpt_path='./unicontrol_v1.1_pruned.safetensors')
+
+import argparse
+import copy
+import os
+import random
+import time
+
+import cv2
+import torch
+from omegaconf import OmegaConf
+
+from annotator.util import HWC3, resize_image, get_device
+from lib.ddim_hacked import DDIMSampler
+from lib.pruning import UnitScorer, prune_module, get_widths
+from utils import create_model, save_inference_checkpoint, PRECISIONS
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', default='./models/cldm_v15_unicontrol.yaml')
+parser.add_argument('--ckpt', default='./unicontrol_v1.1.st')
+parser.add_argument('--hints', required=True, help='directory of hint images for --task')
+parser.add_argument('--task', default='control_hedsketch')
+parser.add_argument('--prompt', default='')
+parser.add_argument('--resolution', type=int, default=512)
+parser.add_argument('--ddim_steps', type=int, default=10)
+parser.add_argument('--scale', type=float, default=9.0)
+parser.add_argument('--keep', type=float, default=0.5, help='fraction of groups / heads / channels kept per module')
+parser.add_argument('--finetune_steps', type=int, default=200)
+parser.add_argument('--lr', type=float, default=1e-5)
+parser.add_argument('--dtype', default='fp16', choices=list(PRECISIONS))
+parser.add_argument('--device', default=None)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--out', default=None)
+parser.add_argument('--out_config', default=None)
+args = parser.parse_args()
+out = args.out or os.path.splitext(args.ckpt)[0] + '_pruned.safetensors'
+out_config = args.out_config or os.path.splitext(args.config)[0] + '_pruned.yaml'
+
+torch.manual_seed(args.seed)
+random.seed(args.seed)
+device = get_device(args.device)
+model = create_model(args.config, device=device, ckpt_path=args.ckpt).to(device)
+control = model.control_model
+if args.task not in control.tasks_to_id:
+    raise ValueError(f"unknown task '{args.task}', expected one of {list(control.tasks_to_id)}")
+
+
+# 1. calibration: ControlNet inputs along the actual sampling trajectories
+conds, records = [], []
+sampler = DDIMSampler(model)
+apply_model = model.apply_model
+
+
+def record(x, t, cond, *a, **kw):
+    records.append((x.cpu(), t.cpu(), len(conds) - 1))
+    return apply_model(x, t, cond, *a, **kw)
+
+
+with torch.no_grad():
+    task = {'name': args.task, 'feature': model.get_learned_conditioning([model.mapping_task[args.task]])[:, :1, :]}
+    model.apply_model = record
+    for file in sorted(os.listdir(args.hints)):
+        image = cv2.imread(os.path.join(args.hints, file))
+        if image is None:
+            continue
+        hint = resize_image(HWC3(image[:, :, ::-1].copy()), args.resolution)
+        hint = torch.from_numpy(hint.copy()).float().to(device).permute(2, 0, 1)[None] / 255.0
+        c = {'c_concat': [hint], 'c_crossattn': [model.get_learned_conditioning([args.prompt])], 'task': task}
+        uc = {'c_concat': [hint], 'c_crossattn': [model.get_learned_conditioning([''])]}
+        conds.append({'c_concat': [torch.cat([hint, hint])],
+                      'c_crossattn': [torch.cat([uc['c_crossattn'][0], c['c_crossattn'][0]])], 'task': task})
+        sampler.sample(args.ddim_steps, 1, (4, hint.shape[2] // 8, hint.shape[3] // 8), c, verbose=False,
+                       unconditional_guidance_scale=args.scale, unconditional_conditioning=uc)
+    del model.apply_model
+if not records:
+    raise ValueError(f'no images in [{args.hints}]')
+print(f'calibration: {len(conds)} hints, {len(records)} ControlNet calls')
+
+
+def control_inputs(i):
+    x, t, index = records[i]
+    cond = conds[index]
+    return dict(x=x.to(device), hint=torch.cat(cond['c_concat'], 1), timesteps=t.to(device),
+                context=torch.cat(cond['c_crossattn'], 1), task=cond['task'])
+
+
+def timed_forward(net):
+    inputs = control_inputs(0)
+    with torch.no_grad():
+        net(**inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(3):
+            net(**inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / 3
+
+
+# 2. scoring, without gradient checkpointing so the hooks see the activations of the graph being differentiated
+teacher = copy.deepcopy(control).eval().requires_grad_(False)
+checkpointing = [(m, attr, getattr(m, attr)) for m in control.modules()
+                 for attr in ('use_checkpoint', 'checkpoint') if isinstance(getattr(m, attr, None), bool)]
+for m, attr, _ in checkpointing:
+    setattr(m, attr, False)
+control.requires_grad_(True)
+scorer = UnitScorer(control)
+with torch.enable_grad():
+    for i in range(len(records)):
+        UnitScorer.output_energy(control(**control_inputs(i)), model.control_scales).backward()
+        control.zero_grad(set_to_none=True)
+scorer.remove()
+for m, attr, flag in checkpointing:
+    setattr(m, attr, flag)
+
+# 3. pruning
+params_before = sum(p.numel() for p in control.parameters())
+for name, keep in scorer.select(args.keep).items():
+    prune_module(control.get_submodule(name), keep)
+params_after = sum(p.numel() for p in control.parameters())
+
+# 4. fine-tuning against the unpruned ControlNet
+model.learning_rate = args.lr
+model.sd_locked = True
+optimizer = model.configure_optimizers()
+control.train()
+for step in range(args.finetune_steps):
+    inputs = control_inputs(random.randrange(len(records)))
+    with torch.no_grad():
+        target = teacher(**inputs)
+    loss = sum(torch.nn.functional.mse_loss(o.float(), t.float()) for o, t in zip(control(**inputs), target))
+    optimizer.zero_grad(set_to_none=True)
+    loss.backward()
+    optimizer.step()
+    if step % 20 == 0 or step == args.finetune_steps - 1:
+        print(f'fine-tune step {step}: zero conv mse {loss.item():.3e}')
+control.eval()
+
+t_before, t_after = timed_forward(teacher), timed_forward(control)
+print(f'ControlNet: {params_before / 1e6:.0f}M -> {params_after / 1e6:.0f}M parameters, '
+      f'{t_before * 1e3:.0f} -> {t_after * 1e3:.0f} ms per call')
+
+save_inference_checkpoint(model, out, PRECISIONS[args.dtype], metadata={'keep': str(args.keep)})
+
+config = OmegaConf.load(args.config)
+config.model.params.use_ema = False
+config.model.params.control_stage_config.params.pruned_widths = get_widths(control)
+OmegaConf.save(config, out_config)
+print(f'wrote [{out}] and [{out_config}]')
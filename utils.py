@@ -10,12 +10,15 @@
 
 import os
 import torch
+import torch.nn as nn
 from omegaconf import OmegaConf
 import importlib
+import threading
 import numpy as np
 
 
-from inspect import isfunction
+from contextlib import contextmanager
+from inspect import isfunction, signature
 from PIL import Image, ImageDraw, ImageFont
 
 
@@ -86,8 +89,9 @@ def get_state_dict(d):
 
 def load_state_dict(ckpt_path, location='cpu'):
     _, extension = os.path.splitext(ckpt_path)
-    if extension.lower() == ".safetensors":
+    if extension.lower() in (".safetensors", ".st"):
         import safetensors.torch
+        # safetensors maps the file into memory, tensors are views on the page cache until written
         state_dict = safetensors.torch.load_file(ckpt_path, device=location)
     else:
         state_dict = get_state_dict(torch.load(ckpt_path, map_location=torch.device(location)))
@@ -95,6 +99,30 @@ def load_state_dict(ckpt_path, location='cpu'):
     print(f'Loaded state_dict from [{ckpt_path}]')
     return state_dict
 
+
+def save_inference_checkpoint(model, path, dtype, metadata=None, exclude=(), extra=None):
+    """
+    Write what a model needs for inference to a safetensors file: parameters cast to `dtype`, buffers kept
+    in their dtype, and no top-level buffers (noise schedule, logvar), which are rebuilt from the config.
+    :param exclude: key prefixes left out.
+    :param extra: {key: tensor} written as they are, e.g. replacements for excluded keys.
+    :param metadata: {str: str} stored in the file header.
+    :return: the state dict written.
+    """
+    from safetensors.torch import save_file
+    params = dict(model.named_parameters())
+    state_dict = {}
+    for key, tensor in model.state_dict().items():
+        if '.' not in key or key.startswith(tuple(exclude)):
+            continue
+        if key in params and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        state_dict[key] = tensor.contiguous().cpu()
+    for key, tensor in (extra or {}).items():
+        state_dict[key] = tensor.contiguous().cpu()
+    save_file(state_dict, path, metadata=metadata)
+    return state_dict
+
 def get_obj_from_str(string, reload=False):
     module, cls = string.rsplit(".", 1)
     if reload:
@@ -109,10 +137,114 @@ def instantiate_from_config(config):
         elif config == "__is_unconditional__":
             return None
         raise KeyError("Expected key `target` to instantiate.")
-    return get_obj_from_str(config["target"])(**config.get("params", dict()))
+    cls, params = get_obj_from_str(config["target"]), config.get("params", dict())
+    depth = getattr(_empty_init, "depth", None)
+    if depth is None:
+        return cls(**params)
+    # under init_empty_weights: the top-level model is built normally, the submodules it instantiates on meta
+    _empty_init.depth = depth + 1
+    try:
+        if depth == 0:
+            return cls(**params)
+        with torch.device("meta"):
+            return cls(**params)
+    finally:
+        _empty_init.depth = depth
+
+PRECISIONS = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def get_precision_dtype(precision, device=None):
+    """
+    Resolve a precision name ("fp32", "fp16", "bf16" or "auto") to a torch dtype.
+    "auto" picks bf16 on CPU and fp16 on accelerators.
+    """
+    if precision == "auto":
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        precision = "bf16" if torch.device(device).type == "cpu" else "fp16"
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision '{precision}' unknown, expected one of {list(PRECISIONS)} or 'auto'")
+    return PRECISIONS[precision]
+
+
+_empty_init = threading.local()
+
+
+@contextmanager
+def init_empty_weights():
+    """
+    Within this context (in the calling thread only), the submodules a model instantiates from its config
+    (UNet, ControlNet, VAE, text encoder) are built under torch.device("meta"): nothing is allocated and the
+    random initialisation is a no-op. The top-level model itself is built normally, so its noise schedule
+    buffers are real tensors; the checkpoint is expected to provide every submodule tensor.
+    """
+    previous = getattr(_empty_init, "depth", None)
+    _empty_init.depth = 0
+    try:
+        yield
+    finally:
+        _empty_init.depth = previous
+
+
+def supports_assign_load():
+    return "assign" in signature(nn.Module.load_state_dict).parameters
+
+
+def load_model_weights(model, config, state_dict, ckpt_path=None):
+    """
+    Bind the checkpoint tensors to a model built under `init_empty_weights`. The loaded tensors become
+    the parameters themselves, so weights are neither randomly initialised nor copied a second time.
+    """
+    expected = model.state_dict(keep_vars=True)
+    for key, tensor in state_dict.items():
+        # assign=True keeps the checkpoint dtype: cast what does not match the module (e.g. fp16 norms, kept in
+        # fp32), tensors already in the model's dtype are assigned without a copy
+        if key in expected and tensor.is_floating_point() and tensor.dtype != expected[key].dtype:
+            state_dict[key] = tensor.to(expected[key].dtype)
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    missing = [name for name, p in model.named_parameters() if p.is_meta]
+    if missing and all(name.startswith("cond_stage_model.") for name in missing):
+        # checkpoint without the frozen text encoder, fall back to its pretrained weights
+        model.instantiate_cond_stage(config.model.params.cond_stage_config)
+        missing = []
+    missing += [name for name, b in model.named_buffers() if b.is_meta]
+    if missing:
+        raise RuntimeError(f"checkpoint [{ckpt_path}] is missing {len(missing)} tensors, e.g. {missing[:5]}")
+    return model
+
 
-def create_model(config_path):
+def create_model(config_path, precision="fp32", device=None, ckpt_path=None):
+    """
+    Build the model from a config. With a checkpoint, its submodules are constructed on the meta device and
+    the (memory-mapped) checkpoint tensors are assigned in place of the parameters.
+    :param precision: "fp32", "fp16", "bf16" or "auto"; with assign loading, checkpoint tensors are cast
+                      straight to it (normalization layers stay in fp32).
+    :param device: device used to resolve "auto" precision.
+    :param ckpt_path: optional .ckpt / .safetensors / .st checkpoint.
+    """
     config = OmegaConf.load(config_path)
-    model = instantiate_from_config(config.model).cpu()
-    print(f'Loaded model config from [{config_path}]')
+    dtype = get_precision_dtype(precision, device)
+    if ckpt_path is not None and supports_assign_load():
+        cond_stage_config = config.model.params.cond_stage_config
+        if "target" in cond_stage_config and \
+                "pretrained" in signature(get_obj_from_str(cond_stage_config.target)).parameters:
+            # built on meta, the pretrained text encoder would be read for nothing: its weights come from the
+            # checkpoint, or from the instantiate_cond_stage fallback of load_model_weights
+            cond_stage_config = OmegaConf.merge(cond_stage_config, {"params": {"pretrained": False}})
+        with init_empty_weights():
+            model = instantiate_from_config(OmegaConf.merge(config.model, {"params": {"cond_stage_config": cond_stage_config}}))
+        print(f'Loaded model config from [{config_path}]')
+        # final dtypes before loading, so checkpoint tensors already in them are assigned as they are
+        model.convert_to_dtype(dtype)
+        load_model_weights(model, config, load_state_dict(ckpt_path), ckpt_path)
+    else:
+        model = instantiate_from_config(config.model).cpu()
+        print(f'Loaded model config from [{config_path}]')
+        if ckpt_path is not None:
+            model.load_state_dict(load_state_dict(ckpt_path), strict=False)
+    if dtype != torch.float32:
+        # casts what was built outside the meta path (e.g. the text encoder fallback), a no-op for the rest
+        model.convert_to_dtype(dtype)
+        print(f'Converted model to {dtype}')
     return model